@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the stages of Grapple on synthetic reads, either with the real utilities or with stand-ins that only
+reproduce their latency and output size so the overhead of the pipeline itself can be measured.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import json
+import os.path
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import grapple
+
+# Stand-in for every utility used by the pipeline. The utility being imitated is chosen by the name the stand-in
+# was invoked as, its latency in seconds by GRAPPLE_STUB_LATENCY and the size of its output relative to its input
+# by GRAPPLE_STUB_SCALE.
+STUB_SOURCE = '''
+import os
+import shutil
+import sys
+import time
+import zlib
+
+
+def option(args, flag):
+    """Returns the value following a flag"""
+
+    return args[args.index(flag) + 1] if flag in args else None
+
+
+def scaled_copy(source, destination):
+    """Copy the input to the output, repeated or truncated to the configured scale"""
+
+    scale = float(os.environ.get('GRAPPLE_STUB_SCALE', '1'))
+    data = source.read()
+
+    if data and scale != 1:
+        size = int(len(data) * scale)
+        data = (data * (size // len(data) + 1))[:size]
+
+    destination.write(data)
+
+
+def open_input(path):
+    """Open an input file, where - is stdin"""
+
+    return getattr(sys.stdin, 'buffer', sys.stdin) if path == '-' else open(path, 'rb')
+
+
+def open_output(path):
+    """Open an output file, where None is stdout"""
+
+    return getattr(sys.stdout, 'buffer', sys.stdout) if path is None else open(path, 'wb')
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+
+    time.sleep(float(os.environ.get('GRAPPLE_STUB_LATENCY', '0')))
+
+    if args and args[0] == '--version':
+        print(tool + ' stub')
+
+    elif tool == 'samtools' and args[0] == 'faidx':
+        # Write a FASTA index so regions can be derived from it
+        with open(args[1]) as fasta_handle, open(args[1] + '.fai', 'w') as index_handle:
+            name, length, offset, line_bases = None, 0, 0, 0
+
+            for line in iter(fasta_handle.readline, ''):
+                if line.startswith('>'):
+                    if name is not None:
+                        index_handle.write('%s\\t%d\\t%d\\t%d\\t%d\\n' % (name, length, offset, line_bases,
+                                                                        line_bases + 1))
+
+                    name, length, offset, line_bases = line[1:].split()[0], 0, fasta_handle.tell(), 0
+
+                else:
+                    line_bases = line_bases or len(line.rstrip())
+                    length += len(line.rstrip())
+
+            index_handle.write('%s\\t%d\\t%d\\t%d\\t%d\\n' % (name, length, offset, line_bases, line_bases + 1))
+
+    elif tool == 'samtools' and args[0] == 'merge':
+        # The output precedes the inputs
+        bam_files = [arg for arg in args if arg.endswith('.bam')]
+
+        with open(bam_files[0], 'wb') as ofile_handle:
+            for ifile in bam_files[1:]:
+                with open(ifile, 'rb') as ifile_handle:
+                    shutil.copyfileobj(ifile_handle, ofile_handle)
+
+    elif tool == 'samtools' and args[0] == 'bam2fq':
+        # The stand-in BAM files are the FASTQ reads behind the BAM magic, gzip compressed
+        with open_input(args[-1]) as ifile_handle:
+            data = ifile_handle.read()
+
+        if data[:2] == b'\\x1f\\x8b':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)[4:]
+
+        open_output(None).write(data)
+
+    elif tool == 'samtools' and args[0] == 'index':
+        open(args[-1] + '.bai', 'w').close()
+
+    elif tool == 'samtools':
+        # view, sort and mpileup all transform their last argument
+        ofile = option(args, '-o') or option(args, '-bo')
+
+        with open_input(args[-1]) as ifile_handle, open_output(ofile) as ofile_handle:
+            scaled_copy(ifile_handle, ofile_handle)
+
+    elif tool == 'bowtie2-build':
+        open(args[-1] + '.1.bt2', 'w').close()
+
+    elif tool == 'bowtie2':
+        with open_input(option(args, '-U')) as ifile_handle:
+            scaled_copy(ifile_handle, open_output(None))
+
+    elif tool == 'karect':
+        options = dict(arg.lstrip('-').split('=', 1) for arg in args if '=' in arg)
+        ofile = os.path.join(options['resultdir'], 'karect_' + os.path.basename(options['inputfile']))
+
+        with open(options['inputfile'], 'rb') as ifile_handle, open(ofile, 'wb') as ofile_handle:
+            scaled_copy(ifile_handle, ofile_handle)
+
+    elif tool == 'bcftools' and args[0] in ('call', 'concat'):
+        # Inputs follow the output file, and stdin is read if there are none. No variants are found, so the reference
+        # becomes the consensus.
+        for ifile in args[args.index('-o') + 2:] or ['-']:
+            with open_input(ifile) as ifile_handle:
+                ifile_handle.read()
+
+        with open(option(args, '-o'), 'w') as ofile_handle:
+            ofile_handle.write('##fileformat=VCFv4.2\\n#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL\\tFILTER\\tINFO\\n')
+
+
+if __name__ == '__main__':
+    main()
+'''
+
+STUB_TOOLS = ['samtools', 'bowtie2', 'bowtie2-build', 'karect', 'bcftools']
+
+
+def install_stubs(stub_dir, latency=0.0, scale=1.0):
+    """
+    Place stand-ins for the utilities used by the pipeline first in the PATH
+
+    stub_dir - directory in which the stand-ins are written
+    latency - time in seconds each stand-in waits before running
+    scale - size of the output of each stand-in relative to its input
+    """
+
+    for tool in STUB_TOOLS:
+        stub = os.path.join(stub_dir, tool)
+
+        with open(stub, 'w') as stub_handle:
+            stub_handle.write('#!' + sys.executable + '\n' + STUB_SOURCE)
+
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ['PATH']
+    os.environ['GRAPPLE_STUB_LATENCY'] = str(latency)
+    os.environ['GRAPPLE_STUB_SCALE'] = str(scale)
+
+
+def read_reference(ref_genome_file):
+    """
+    Read a reference genome
+
+    ref_genome_file - reference genome in FASTA format
+
+    Returns a list of (name, sequence) pairs
+    """
+
+    contigs = []
+
+    with open(ref_genome_file) as ref_handle:
+        for line in ref_handle:
+            if line.startswith('>'):
+                contigs.append((line[1:].split()[0], []))
+
+            elif contigs:
+                contigs[-1][1].append(line.strip().upper())
+
+    return [(name, ''.join(sequence)) for name, sequence in contigs]
+
+
+def mutate(sequence, error_rate, rng):
+    """
+    Introduce sequencing errors into a read, split evenly between substitutions, insertions and deletions
+
+    sequence - the error free read
+    error_rate - probability of an error at each base
+    rng - random number generator
+
+    Returns the read with errors
+    """
+
+    bases = []
+
+    for base in sequence:
+        if rng.random() >= error_rate:
+            bases.append(base)
+            continue
+
+        error = rng.randrange(3)
+
+        if error == 0:
+            bases.append(rng.choice([other for other in 'ACGT' if other != base]))
+
+        elif error == 1:
+            bases.append(base + rng.choice('ACGT'))
+
+        # Otherwise the base is deleted
+
+    return ''.join(bases)
+
+
+def simulate_reads(ref_genome_file, read_file, read_length=200, depth=30, error_rate=0.01, seed=0):
+    """
+    Generate single-end reads sampled uniformly from both strands of a reference genome
+
+    ref_genome_file - reference genome in FASTA format
+    read_file - file to write the reads to in FASTQ format
+    read_length - length of the reads before errors are introduced
+    depth - average coverage of the reference by the reads
+    error_rate - probability of a sequencing error at each base
+    seed - seed of the random number generator, so the same reads are generated every time
+
+    Returns the number of reads generated
+    """
+
+    rng = random.Random(seed)
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+    count = 0
+
+    with open(read_file, 'w') as read_handle:
+        for name, sequence in read_reference(ref_genome_file):
+            length = min(read_length, len(sequence))
+
+            for _ in range(int(round(depth * len(sequence) / float(length)))):
+                start = rng.randrange(len(sequence) - length + 1)
+                read = sequence[start:start + length]
+
+                if rng.random() < 0.5:
+                    read = ''.join(complement.get(base, 'N') for base in reversed(read))
+
+                read = mutate(read, error_rate, rng)
+                count += 1
+
+                read_handle.write('@read_' + str(count) + '_' + name + '_' + str(start) + '\n' + read + '\n+\n' +
+                                  'I' * len(read) + '\n')
+
+    return count
+
+
+def fastq_to_bam(read_file, bam_file, stub):
+    """
+    Package the reads as an unaligned BAM file, the input format of the pipeline
+
+    read_file - reads in FASTQ format
+    bam_file - file to write the reads to in BAM format
+    stub - True if the utilities are stand-ins, in which case the FASTQ is gzip compressed behind the BAM magic so
+           it is detected as BAM and the stand-in bam2fq converts it back
+    """
+
+    if stub:
+        with open(read_file, 'rb') as read_handle, gzip.open(bam_file, 'wb') as bam_handle:
+            bam_handle.write(b'BAM\x01')
+            shutil.copyfileobj(read_handle, bam_handle)
+
+    else:
+        subprocess.check_call(['samtools', 'import', '-0', read_file, '-o', bam_file])
+
+
+def median(values):
+    """Returns the median of a list of numbers"""
+
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def calibrate(repeat=5):
+    """
+    Time the start of an empty Python process, which dominates the cost of the stand-ins, so timings taken on
+    different machines can be compared in proportion to it
+
+    repeat - number of processes timed
+
+    Returns the median time in seconds
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', ''])
+        timings.append(time.time() - start)
+
+    return median(timings)
+
+
+def run_benchmark(bam_file, ref_genome_file, arguments, repeat):
+    """
+    Time the whole pipeline and each of its stages
+
+    bam_file - reads in BAM format
+    ref_genome_file - reference genome in FASTA format
+    arguments - command line arguments of grapple, which select the pipeline configuration
+    repeat - number of times the pipeline is run
+
+    Returns a dictionary holding the median wall time of the pipeline and of each stage, and the stage profiles of
+    every run
+    """
+
+    args = vars(grapple.build_parser().parse_args(arguments + ['-r', ref_genome_file, '-i', bam_file]))
+    runs = []
+
+    for _ in range(repeat):
+        stages = grapple.start_profiling()
+
+        # The removal of the workspace is not part of the pipeline's time
+        with grapple.workspace(scratch_dir=args['scratch'], small_dir=args['small_scratch']) as prefix_id:
+            start = time.time()
+            grapple.assemble(bam_file, ref_genome_file, args, prefix_id)
+            wall_time = time.time() - start
+
+        runs.append({'wall_time': wall_time, 'stages': stages})
+
+    stage_names = [stage['stage'] for stage in runs[0]['stages']]
+
+    return {
+        'pipeline': median([run['wall_time'] for run in runs]),
+        'stages': dict((name, median([stage['wall_time'] for run in runs for stage in run['stages']
+                                      if stage['stage'] == name])) for name in stage_names),
+        'runs': runs
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find the timings that regressed against a baseline. When both benchmarks were calibrated, the baseline is scaled
+    by the speed of this machine relative to the one it was taken on.
+
+    results - timings of the current benchmark
+    baseline - timings of an earlier benchmark
+    tolerance - fraction by which a timing may exceed its baseline
+
+    Returns a list of messages describing each regression
+    """
+
+    scale = 1.0
+
+    if results.get('calibration') and baseline.get('calibration'):
+        scale = results['calibration'] / baseline['calibration']
+
+    regressions = []
+    timings = [('pipeline', results['pipeline'], baseline['pipeline'] * scale)]
+    timings += [(name, value, baseline['stages'][name] * scale) for name, value in sorted(results['stages'].items())
+                if name in baseline['stages']]
+
+    for name, value, reference in timings:
+        if value > reference * (1 + tolerance):
+            regressions.append(name + ' took ' + '%.3f' % value + ' s against ' + '%.3f' % reference + ' s')
+
+    return regressions
+
+
+def main(args):
+    """Runs the benchmark according to the user's arguments."""
+
+    work_dir = tempfile.mkdtemp(prefix='grapple_benchmark_')
+
+    try:
+        if args['stub']:
+            install_stubs(work_dir, args['latency'], args['scale'])
+
+        read_file = os.path.join(work_dir, 'reads.fq')
+        bam_file = os.path.join(work_dir, 'reads.bam')
+
+        grapple.status('Simulating reads')
+        count = simulate_reads(args['ref'], read_file, args['length'], args['depth'], args['error_rate'],
+                               args['seed'])
+        fastq_to_bam(read_file, bam_file, args['stub'])
+
+        results = run_benchmark(bam_file, args['ref'], args['grapple_args'].split(), args['repeat'])
+        results['reads'] = count
+        results['calibration'] = calibrate()
+        results['configuration'] = dict((key, value) for key, value in args.items() if key != 'output')
+
+        for name, value in sorted(results['stages'].items()):
+            grapple.status(name + ': ' + '%.3f' % value + ' s')
+
+        grapple.status('pipeline: ' + '%.3f' % results['pipeline'] + ' s')
+
+        if args['output']:
+            with open(args['output'], 'w') as ofile_handle:
+                json.dump(results, ofile_handle, indent=2, sort_keys=True)
+
+        if args['baseline']:
+            with open(args['baseline']) as baseline_handle:
+                regressions = compare(results, json.load(baseline_handle), args['tolerance'])
+
+            if regressions:
+                grapple.error('Performance regressions found:\n' + '\n'.join(regressions))
+
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmark the Grapple pipeline')
+
+    parser.add_argument('-r', '--ref', default=os.path.join('test_files', 'lambda_ref.fa'),
+                        help='Reference genome the reads are simulated from, in FASTA format')
+
+    parser.add_argument('-l', '--length', type=int, default=200, help='Length of the simulated reads')
+
+    parser.add_argument('-d', '--depth', type=float, default=30, help='Average coverage of the simulated reads')
+
+    parser.add_argument('-e', '--error_rate', type=float, default=0.01,
+                        help='Probability of a sequencing error at each base of the simulated reads')
+
+    parser.add_argument('--seed', type=int, default=0, help='Seed used to simulate the reads')
+
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Number of times the pipeline is run')
+
+    parser.add_argument('-g', '--grapple_args', default='',
+                        help='Arguments passed to grapple to select the pipeline configuration, e.g. -g="-d -s"')
+
+    parser.add_argument('-s', '--stub', action='store_true',
+                        help='Replace the utilities with stand-ins to measure the overhead of the pipeline itself')
+
+    parser.add_argument('--latency', type=float, default=0, help='Time in seconds each stand-in waits before running')
+
+    parser.add_argument('--scale', type=float, default=1,
+                        help='Size of the output of each stand-in relative to its input')
+
+    parser.add_argument('-o', '--output', help='File to write the timings to in JSON format')
+
+    parser.add_argument('-b', '--baseline', help='Timings of an earlier benchmark in JSON format to compare against')
+
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='Fraction by which a timing may exceed its baseline before it is reported as a '
+                             'regression')
+
+    main(vars(parser.parse_args()))
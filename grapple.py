@@ -8,16 +8,151 @@ reference assembly in FASTA format.
 from __future__ import print_function
 
 import argparse
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os.path
-import random
+import pty
 import re
+import shutil
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from subprocess import CalledProcessError
 
+import numpy
 import psutil
 
+try:
+    import socketserver
+
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+# Versions of the external utilities, probed once per run
+_tool_versions = {}
+
+# Resources given to this process by the user or, when several samples run concurrently, by the batch. A job can
+# narrow them for itself with resource_budget.
+_resource_limits = {'threads': None, 'memory': None}
+
+# Fastest thread counts the autotuner measured on this machine, loaded on first use
+_tuning = {'threads': None}
+
+# Settings of the job and stage running on the current thread: the workspace and resource budget of the job, the
+# threads granted to the stage when stages of a sample overlap, the set in which the task graph running the stage
+# tracks the processes it starts and the list in which the profile of the stage does. The threads a job starts for its
+# stages inherit them.
+_scope = threading.local()
+
+# Resource usage recorded for each stage when profiling is enabled, the records of the stages being profiled and the
+# lock guarding them
+_profile = {'stages': None, 'running': [], 'lock': threading.Lock()}
+
+# Stages watched while the throughput metrics are exported, by name, and the lock guarding them against the threads
+# of concurrent stages
+_metrics = {'stages': None, 'lock': threading.Lock()}
+
+# Compression of the intermediate files under each encoding policy: the gzip level of the FASTQ files, or None to
+# keep them as plain text, and the BGZF level of the BAM files, or None for the samtools default
+_ENCODINGS = {
+    'plain': {'fastq': None, 'bam': None},
+    'uncompressed': {'fastq': None, 'bam': 0},
+    'fast': {'fastq': 1, 'bam': 1},
+    'gzip': {'fastq': 6, 'bam': None}
+}
+
+# Column of the pileup counts each base is counted in, with every other IUPAC code counted as unknown. The last
+# column counts deletions.
+_PILEUP_COLUMNS = numpy.full(256, 4, dtype=numpy.uint8)
+_PILEUP_COLUMNS[numpy.frombuffer(b'ACGTacgt', dtype=numpy.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+# Length and operation of each element of a CIGAR string
+_CIGAR = re.compile(br'(\d+)([MIDNSHP=X])')
+
+# Peak scratch space needed by the file based stages, as a multiple of the size of the BAM read file
+_SCRATCH_FACTOR = {'convert': 3, 'trim': 3, 'downsample': 3, 'correct': 3, 'chunk': 3, 'align': 5, 'shard': 1,
+                   'sort': 2}
+
+# Most bases of a batch of reads laid out as one matrix while trimming, which bounds the memory of the matrices
+_TRIM_CELLS = 4000000
+
+# Memory Karect needs to correct a FASTQ file, as a multiple of the size of the file
+_KARECT_MEMORY_FACTOR = 10
+
+# Length in bases of the regions a sample update calls again when no region size is given, so a top-up of a
+# single-contig reference does not call the whole contig again
+_UPDATE_REGION_SIZE = 100000
+
+# Utilities used by the pipeline, with the lowest version known to work and the options each of their subcommands
+# must accept
+_TOOLCHAIN = {
+    'samtools': ((1, 3), {'bam2fq': [], 'faidx': [], 'view': ['-b'], 'sort': ['-o', '-m', '-T', '-l'], 'index': [],
+                          'mpileup': ['-u', '-f', '-r'], 'merge': ['-f']}),
+    'bcftools': ((1, 3), {'call': ['-m', '-v', '-O'], 'concat': ['-O'], 'index': [], 'consensus': ['-f']}),
+    'bowtie2': ((2, 0), {}),
+    'bowtie2-build': ((2, 0), {}),
+    'karect': (None, {})
+}
+
+# Seconds a utility is given to print its version or usage before it is stopped
+_PROBE_TIMEOUT = 5
+
+# Throughput metrics exported for each running stage
+_STAGE_METRICS = [
+    ('elapsed_seconds', 'Time since the stage started'),
+    ('input_size_bytes', 'Size of the reads the stage reads'),
+    ('input_read_bytes', 'Bytes of its inputs the stage has read'),
+    ('output_bytes', 'Bytes the stage has written to its outputs'),
+    ('records', 'Records which have flowed through the stage, estimated from the size of the records of its text '
+                'files'),
+    ('records_per_second', 'Rate at which records flow through the stage'),
+    ('bytes_per_second', 'Rate at which the stage reads its inputs'),
+    ('progress_ratio', 'Fraction of the reads the stage has read'),
+    ('eta_seconds', 'Estimated time until the stage has read the reads')
+]
+
+# Number of reads simulated for each input size class the autotuner measures
+_AUTOTUNE_READS = [20000, 200000]
+
+# Message reported when a file or a utility is missing
+_ENVIRONMENT_ERROR = 'An error has occurred. Please ensure the input and reference files exist and all of the ' \
+                     'required utilities are installed in your PATH'
+
+
+# Options of a run taken by configure() and the Pipeline, named after the long command line options. Flags are given
+# as truth values and the other options as values converted like their command line strings.
+_FLAG_OPTIONS = ['disable_ec', 'stream', 'verbose', 'chunked_ec', 'cluster_ec', 'autotune', 'pin_cpus', 'trim',
+                 'skip_preflight', 'progress']
+
+_VALUE_OPTIONS = ['batch', 'cache', 'input', 'jobs', 'output', 'ref', 'profile', 'resume', 'update', 'ploidy', 'mode',
+                  'region_size', 'shards', 'threads', 'memory', 'cache_size', 'trim_window', 'trim_quality',
+                  'min_length', 'max_n', 'engine', 'min_depth', 'min_frequency', 'max_depth', 'seed', 'intermediates',
+                  'scratch', 'small_scratch', 'metrics', 'metrics_interval', 'serve']
+
+
+class PipelineError(Exception):
+    """
+    Raised when the pipeline cannot assemble a sample. The message describes the failure in terms of the pipeline,
+    and the exception behind it is kept as its cause.
+    """
+
+    def __init__(self, message, cause=None):
+        Exception.__init__(self, message)
+        self.cause = cause
+
 
 def error(message):
     """
@@ -56,429 +191,4489 @@ def status(message):
         print(message, file=sys.stderr)
 
 
-def bam_to_fq(read_file, prefix_id='', verbose=False):
+def read_cgroup(controller, v1_name, v2_name, proc_cgroup='/proc/self/cgroup', cgroup_root='/sys/fs/cgroup'):
     """
-    Convert the input file from BAM to FASTQ using samtools.
+    Read a control file of the cgroup this process belongs to, under either cgroup v1 or v2
 
-    read_file - file containing the NGS reads in BAM format
-    prefix_id - prefix of all temp files
-    verbose - verbosity of subprocess
+    controller - name of the cgroup v1 controller holding the file
+    v1_name - name of the file under cgroup v1
+    v2_name - name of the file under cgroup v2
+    proc_cgroup - file listing the cgroups of this process
+    cgroup_root - mount point of the cgroup file systems
 
-    Returns the FASTQ file
+    Returns the stripped contents of the file, or None if the process is not in such a cgroup
     """
 
-    # Ensure that the file passed is in the proper format
-    if os.path.splitext(read_file)[1] != '.bam':
-        raise ValueError('The read file is not in BAM format')
+    try:
+        with open(proc_cgroup) as cgroup_handle:
+            lines = [line.strip().split(':', 2) for line in cgroup_handle if line.count(':') >= 2]
 
-    # Create a temporary output file to place the FASTQ output in
-    ofile = os.path.join(tempfile.gettempdir(), prefix_id + 'bam_to_fq_out.fq')
+    except EnvironmentError:
+        return None
 
-    status('Converting the input from BAM format to FASTQ format')
+    candidates = []
 
-    with open(ofile, 'w') as ofile_handle, open(os.devnull, 'w') as null_handle:
-        err_handle = sys.stderr if verbose else null_handle
+    for _, controllers, path in lines:
+        path = path.lstrip('/')
 
-        # Convert the input from BAM to FASTQ
-        subprocess.check_call(['samtools', 'bam2fq', read_file], stdout=ofile_handle, stderr=err_handle)
+        if controllers == '':
+            # cgroup v2, where a container usually sees its own cgroup as the root
+            candidates += [os.path.join(cgroup_root, path, v2_name), os.path.join(cgroup_root, v2_name)]
 
-    return ofile
+        elif controller in controllers.split(','):
+            for mount in (os.path.join(cgroup_root, controllers), os.path.join(cgroup_root, controller)):
+                candidates += [os.path.join(mount, path, v1_name), os.path.join(mount, v1_name)]
+
+    for candidate in candidates:
+        try:
+            with open(candidate) as control_handle:
+                return control_handle.read().strip()
 
+        except EnvironmentError:
+            continue
 
-def read_correction(read_file, cell_type='haploid', match_type='edit', verbose=False):
+    return None
+
+
+def detect_resources(proc_cgroup='/proc/self/cgroup', cgroup_root='/sys/fs/cgroup'):
     """
-    Correct the raw reads using Karect.
+    Work out the cores and memory this process may actually use, which inside a container can be far less than the
+    host reported by psutil. The CPU affinity mask and the cgroup CPU quota bound the number of threads, and the
+    cgroup memory limit bounds the memory.
 
-    read_file - file containing the NGS reads in FASTQ format
-    cell_type - type of cell the reads are from
-    match_type - correction mode to be used
-    verbose - verbosity of subprocess
+    proc_cgroup - file listing the cgroups of this process
+    cgroup_root - mount point of the cgroup file systems
 
-    Returns the FASTQ corrected file
+    Returns a dictionary holding the number of threads, the memory in GB and the list of CPUs this process may use
     """
 
-    # Ensure the file is in FASTQ format
-    if not re.match(r'\.((fastq)|(fq))', os.path.splitext(read_file)[1]):
-        raise ValueError('The read file is not in FASTQ format')
+    try:
+        cpus = sorted(psutil.Process().cpu_affinity())
 
-    # Ensure the file exists (karect does not return an error code if it does not exist)
-    if not os.path.isfile(read_file):
-        raise ValueError('The read file does not exist')
+    except (AttributeError, psutil.Error):
+        # The platform does not support CPU affinity
+        cpus = list(range(psutil.cpu_count()))
 
-    # Ensure that karect's parameters are valid (karect does not return an error code if they are not)
-    if not re.match(r'(haploid)|(diploid)', cell_type):
-        raise ValueError('The cell type is not a valid value')
+    threads = len(cpus)
 
-    if not re.match(r'(edit)|(hamming)|(insdel)', match_type):
-        raise ValueError('The match type is not a valid value')
+    # cgroup v2 holds "<quota> <period>" and v1 holds the quota and the period in separate files
+    quota = read_cgroup('cpu', 'cpu.cfs_quota_us', 'cpu.max', proc_cgroup, cgroup_root)
+    period = read_cgroup('cpu', 'cpu.cfs_period_us', 'cpu.max', proc_cgroup, cgroup_root)
 
-    # Get system parameters
-    thread_number = psutil.cpu_count()
-    memory_limit = psutil.virtual_memory().available / 1000000000
+    if quota and period:
+        quota, period = quota.split()[0], period.split()[-1]
 
-    status('Correcting the reads')
+        if quota not in ('max', '-1'):
+            threads = min(threads, max(1, int(math.ceil(float(quota) / float(period)))))
 
-    with open(os.devnull, 'w') as null_handle:
-        err_handle = sys.stderr if verbose else null_handle
+    memory = psutil.virtual_memory().available
 
-        # Correct the reads
-        # Note: Karect uses stdout rather than stderr for user information so stdout is redirected to err_handle
-        subprocess.check_call(['karect', '-correct', '-inputfile=' + read_file, '-celltype=' + cell_type,
-                               '-matchtype=' + match_type, '-threads=' + str(thread_number),
-                               '-memory=' + str(memory_limit), '-resultdir=' + tempfile.gettempdir(),
-                               '-tempdir=' + tempfile.gettempdir()], stdout=err_handle, stderr=err_handle)
+    limit = read_cgroup('memory', 'memory.limit_in_bytes', 'memory.max', proc_cgroup, cgroup_root)
+    usage = read_cgroup('memory', 'memory.usage_in_bytes', 'memory.current', proc_cgroup, cgroup_root)
+    stat = read_cgroup('memory', 'memory.stat', 'memory.stat', proc_cgroup, cgroup_root)
 
-    # Return the location of the output file
-    ifile_suffix = os.path.split(read_file)[1]
-    ofile = os.path.join(tempfile.gettempdir(), 'karect_' + ifile_suffix)
+    # The usage includes the page cache, of which the inactive file pages are reclaimed as soon as memory is needed
+    usage = int(usage or 0)
 
-    return ofile
+    if usage and stat:
+        fields = dict(line.split()[:2] for line in stat.splitlines() if len(line.split()) >= 2)
+        inactive_file = fields.get('total_inactive_file', fields.get('inactive_file', '0'))
+        usage = max(0, usage - int(inactive_file))
+
+    # An unlimited cgroup v1 reports a limit larger than the machine's memory, which the minimum takes care of
+    if limit and limit != 'max':
+        memory = min(memory, max(0, int(limit) - usage))
+
+    return {'threads': threads, 'memory': memory / 1000000000.0, 'cpus': cpus}
 
 
-def read_alignment(read_file, ref_genome_file, prefix_id='', verbose=False):
+def limit_resources(threads=None, memory=None, cpu_queue=None):
     """
-    Align the reads to the reference genome using Bowtie2.
+    Restrict the resources the utilities run by this process may use
 
-    read_file - file containing the NGS reads to align in FASTQ format
-    ref_genome_file - file containing the reference genome in FASTA format
-    prefix_id - prefix of all temp files
-    verbose - verbosity of subprocess
+    threads - number of threads, or None for every usable core
+    memory - memory in GB, or None for all of the usable memory
+    cpu_queue - queue from which to take the list of CPUs to pin this process and its children to, or None
+    """
 
-    Returns the aligned FASTQ read file
+    _resource_limits['threads'] = threads
+    _resource_limits['memory'] = memory
+
+    if cpu_queue is not None:
+        psutil.Process().cpu_affinity(cpu_queue.get())
+
+
+@contextlib.contextmanager
+def resource_budget(threads=None, memory=None):
     """
+    Restrict the resources the utilities run by the current job may use, leaving those of other jobs in the process
+    alone
 
-    # Ensure the passed files are in the appropriate formats
-    if not re.match(r'\.((fq)|(fastq))', os.path.splitext(read_file)[1]):
-        raise ValueError('The read file is not in FASTQ format')
+    threads - number of threads, or None for the limit of the process
+    memory - memory in GB, or None for the limit of the process
+    """
 
-    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
-        raise ValueError('The reference genome file is not in FASTA format')
+    previous = getattr(_scope, 'limits', None)
+    _scope.limits = {'threads': threads, 'memory': memory}
 
-    # Get system parameters
-    thread_number = psutil.cpu_count()
+    try:
+        yield
 
-    index_prefix = os.path.join(tempfile.gettempdir(), prefix_id + 'bt2_index')
-    ofile = os.path.join(tempfile.gettempdir(), prefix_id + 'aligned_reads.sam')
+    finally:
+        _scope.limits = previous
 
-    status('Aligning the reads')
 
-    with open(os.devnull, 'w') as null_handle:
-        err_handle = sys.stderr if verbose else null_handle
+def thread_count():
+    """Returns the number of threads the utilities of the current stage may use"""
 
-        # Create an index file from the reference genome
-        subprocess.check_call(['bowtie2-build', ref_genome_file, index_prefix], stdout=null_handle, stderr=err_handle)
+    limits = getattr(_scope, 'limits', None) or {}
 
-        with open(ofile, 'w') as ofile_handle:
-            # Align the reads
-            subprocess.check_call(['bowtie2', '-p', str(thread_number), '-x', index_prefix, '-U', read_file],
-                                  stdout=ofile_handle, stderr=err_handle)
+    return getattr(_scope, 'threads', None) or limits.get('threads') or _resource_limits['threads'] or \
+        detect_resources()['threads']
 
-    return ofile
 
+def memory_limit():
+    """Returns the amount of memory in GB the utilities may use"""
 
-def sam_to_bam(read_file, prefix_id='', verbose=False):
+    limits = getattr(_scope, 'limits', None) or {}
+
+    return limits.get('memory') or _resource_limits['memory'] or detect_resources()['memory']
+
+
+def user_cache_file(name):
     """
-    Convert the input file from SAM format to BAM format
+    Locate a file in the user's cache directory
 
-    read_file - reads in SAM format
-    prefix_id - prefix of all temp files
-    verbose - verbosity of subprocess
+    name - name of the file
 
-    Returns the converted BAM read file
+    Returns the path of the file in the grapple directory of the user's cache directory
     """
 
-    # Ensure the read file is in SAM format
-    if os.path.splitext(read_file)[1] != '.sam':
-        raise ValueError('The read file is not in SAM format')
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
 
-    ofile = os.path.join(tempfile.gettempdir(), prefix_id + 'aligned_reads.bam')
+    return os.path.join(cache_dir, 'grapple', name)
 
-    status('Converting the aligned reads from SAM format to BAM format')
 
-    with open(os.devnull, 'w') as null_handle:
-        err_handle = sys.stderr if verbose else null_handle
+def size_class(path):
+    """
+    Classify the size of a file by its order of magnitude
 
-        # Convert the read file format
-        subprocess.check_call(['samtools', 'view', '-bo', ofile, read_file], stdout=null_handle, stderr=err_handle)
+    path - the file, or - for stdin
 
-    return ofile
+    Returns the number of decimal digits of the size of the file in bytes, or None if the size is unknown
+    """
+
+    if path is None or not os.path.isfile(path):
+        return None
+
+    return len(str(os.path.getsize(path)))
 
 
-def sort_and_index(read_file, prefix_id='', verbose=False):
+def tuned_threads(tool, read_file=None):
     """
-    Sort and index the aligned reads
+    Choose the number of threads of a utility from the fastest setting the autotuner measured on this machine for
+    inputs of the closest size, within the threads the utilities may use
 
-    read_file - aligned reads in SAM format
-    prefix_id - prefix of all temp files
-    verbose - verbosity of subprocess
+    tool - the utility, either bowtie2, samtools sort or karect
+    read_file - the input of the utility, or None if its size is unknown
 
-    Returns the sorted and indexed SAM read file
+    Returns the number of threads
     """
 
-    # Ensure read file is in BAM format
-    if os.path.splitext(read_file)[1] != '.bam':
-        raise ValueError('The read file is not in BAM format')
+    threads = thread_count()
 
-    # Get system parameters
-    thread_number = psutil.cpu_count()
+    if _tuning['threads'] is None:
+        try:
+            with open(user_cache_file('autotune.json')) as profile_handle:
+                _tuning['threads'] = json.load(profile_handle).get(socket.gethostname(), {})
 
-    temp_prefix = os.path.join(tempfile.gettempdir(), prefix_id + 'samtools_sorting')
-    ofile = os.path.join(tempfile.gettempdir(), prefix_id + 'sorted_reads.bam')
+        except (EnvironmentError, ValueError):
+            _tuning['threads'] = {}
 
-    status('Sorting and indexing the reads')
+    classes = _tuning['threads'].get(tool)
 
-    with open(os.devnull, 'w') as null_handle:
-        err_handle = sys.stderr if verbose else null_handle
+    if not classes:
+        return threads
 
-        # Sort the read file
-        subprocess.check_call(['samtools', 'sort', '-o', ofile, '-@', str(thread_number), '-T', temp_prefix, read_file],
-                              stdout=null_handle, stderr=err_handle)
+    # Inputs of unknown size are most likely large, so they take the largest class measured
+    wanted = size_class(read_file) or max(int(size) for size in classes)
+    closest = min(classes, key=lambda size: (abs(int(size) - wanted), -int(size)))
 
-        # Index the sorted reads
-        subprocess.check_call(['samtools', 'index', ofile], stdout=null_handle, stderr=err_handle)
+    return max(1, min(threads, classes[closest]['threads']))
 
-    return ofile
 
+def sort_options(threads=None, memory=None):
+    """
+    Choose the samtools sort options keeping it within the thread and memory budgets
+
+    threads - number of threads of the sort, defaults to the threads the utilities may use
+    memory - memory in GB of the sort, defaults to the memory the utilities may use
 
-def call_variants(read_file, ref_genome_file, prefix_id='', verbose=False):
+    Returns the list of options to pass to samtools sort
     """
-    Call the variants in the read file using the reference genome
 
-    read_file - sorted and indexed reads in BAM format
-    ref_genome_file - reference genome in FASTA format
+    threads = threads or thread_count()
+
+    # The memory option applies to each thread, so split three quarters of the budget between them and leave the
+    # rest for samtools' own overhead
+    memory_per_thread = int((memory or memory_limit()) * 1000 * 0.75 / threads)
+
+    # The thread option counts the threads in addition to the main one
+    return ['-@', str(threads - 1), '-m', str(max(memory_per_thread, 64)) + 'M']
+
+
+def start_process(command, **options):
+    """
+    Start a utility, registering it with the task graph running the current stage so the graph can stop it if
+    another of its tasks fails
+
+    command - argument list of the process
+    options - keyword arguments of subprocess.Popen
+
+    Returns the process
+    """
+
+    process = subprocess.Popen(command, **options)
+    processes = getattr(_scope, 'processes', None)
+
+    if processes is not None:
+        processes.add(process)
+
+    # The profile of the stage only measures the processes the stage started
+    profiled = getattr(_scope, 'profiled', None)
+
+    if profiled is not None:
+        profiled.append(process)
+
+    return process
+
+
+def run_command(command, stdout=None, stderr=None):
+    """
+    Run a utility to completion as subprocess.check_call does, registered like the processes of start_process
+
+    command - argument list of the process
+    stdout - handle receiving the output of the process
+    stderr - handle receiving the diagnostics of the process
+
+    Raises a CalledProcessError if the utility fails
+    """
+
+    process = start_process(command, stdout=stdout, stderr=stderr)
+
+    if process.wait():
+        raise CalledProcessError(process.returncode, command)
+
+
+def inherit_scope():
+    """
+    Capture the settings of the job and stage running on the current thread for a thread about to be started
+
+    Returns a function which gives the thread calling it the captured settings
+    """
+
+    state = dict(_scope.__dict__)
+
+    return lambda: _scope.__dict__.update(state)
+
+
+def stage_pool(threads):
+    """
+    Start a pool of threads for the work of a stage, which share the thread budget and the process registry of the
+    thread starting them
+
+    threads - number of threads in the pool
+
+    Returns the pool
+    """
+
+    return multiprocessing.pool.ThreadPool(threads, inherit_scope())
+
+
+def run_pipeline(commands, stdout, stderr, stdin=None):
+    """
+    Run a chain of commands connected by OS pipes, equivalent to "cmd1 | cmd2 | ...".
+
+    commands - list of argument lists, one per process in the chain
+    stdout - handle receiving the output of the last process
+    stderr - handle receiving the diagnostics of every process
+    stdin - handle feeding the first process, which is closed once the chain has started so the writer sees a broken
+            pipe if the process exits early, or None to inherit stdin
+
+    Raises a CalledProcessError for the process responsible if any process in the chain fails
+    """
+
+    processes = []
+
+    try:
+        for index, command in enumerate(commands):
+            upstream = processes[-1].stdout if processes else stdin
+            downstream = stdout if index == len(commands) - 1 else subprocess.PIPE
+
+            processes.append(start_process(command, stdin=upstream, stdout=downstream, stderr=stderr))
+
+            # Close the parent's copy of the pipe so the upstream process receives SIGPIPE if this one exits early
+            if upstream is not None:
+                upstream.close()
+
+    except EnvironmentError:
+        # Do not leave the writer feeding the chain blocked on a pipe nothing reads
+        if stdin is not None:
+            stdin.close()
+
+        # Do not leave part of the chain running if a later process could not be started
+        for process in processes:
+            process.kill()
+            process.wait()
+
+        raise
+
+    return_codes = [process.wait() for process in processes]
+
+    # A process killed by SIGPIPE is only a victim of a failure further down the chain, so blame the others first
+    failures = [(code, command) for code, command in zip(return_codes, commands) if code != 0]
+    culprits = [(code, command) for code, command in failures if code != -13] or failures
+
+    if culprits:
+        raise CalledProcessError(culprits[0][0], culprits[0][1])
+
+
+def build_index(ref_genome_file, prefix_id='', verbose=False, index_prefix=None):
+    """
+    Build a Bowtie2 index from the reference genome.
+
+    ref_genome_file - file containing the reference genome in FASTA format
     prefix_id - prefix of all temp files
     verbose - verbosity of subprocess
+    index_prefix - prefix of the index files, defaults to a temp file
 
-    Returns the call variants file in VCF format
+    Returns the prefix of the index files
     """
 
-    # Ensure the files are in the appropriate format
-    if os.path.splitext(read_file)[1] != '.bam':
-        raise ValueError('The read file is not in BAM format')
-
+    # Ensure the reference is in the appropriate format
     if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
         raise ValueError('The reference genome file is not in FASTA format')
 
-    pileup = os.path.join(tempfile.gettempdir(), prefix_id + 'pileup.vcf')
-    variants = os.path.join(tempfile.gettempdir(), prefix_id + 'variants.vcf')
-    ofile = os.path.join(tempfile.gettempdir(), prefix_id + 'consensus.fa')
-
-    status('Calling the variants')
+    if index_prefix is None:
+        index_prefix = scratch_file(prefix_id + 'bt2_index')
 
     with open(os.devnull, 'w') as null_handle:
         err_handle = sys.stderr if verbose else null_handle
 
-        # Run mpileup
-        subprocess.check_call(['samtools', 'mpileup', '-uf', ref_genome_file, '-o', pileup, read_file],
-                              stdout=null_handle, stderr=err_handle)
+        # Create an index file from the reference genome
+        run_command(['bowtie2-build', ref_genome_file, index_prefix], stdout=null_handle, stderr=err_handle)
+
+    return index_prefix
 
-        # Call the variants
-        subprocess.check_call(['bcftools', 'call', '-mv', '-Oz', '-o', variants, pileup], stdout=err_handle,
-                              stderr=null_handle)
 
-        # Index the variants
-        subprocess.check_call(['bcftools', 'index', variants], stdout=null_handle, stderr=err_handle)
+def file_digest(path):
+    """
+    Hash the contents of a file
 
-        # Generate a consensus
-        subprocess.check_call(['bcftools', 'consensus', '-f', ref_genome_file, '-o', ofile, variants],
-                              stdout=null_handle, stderr=err_handle)
+    path - the file to hash
 
-    return ofile
+    Returns the hexadecimal SHA-256 digest of the file
+    """
 
+    digest = hashlib.sha256()
 
-def format_consensus(consensus_file, prefix_id=''):
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def directory_size(path):
     """
-    Edit the consenses file to ensure it is formatted correctly
+    Measure the disk usage of a directory
 
-    consensus_file - Consensus file to format
-    prefix_id - prefix of all temp files
+    path - the directory to measure
+
+    Returns the total size in bytes of the files in the directory
     """
 
-    # Ensure the files are in the appropriate format
-    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(consensus_file)[1]):
-        raise ValueError('The consensus file is not in FASTA format')
+    total = 0
 
-    formatted_file = os.path.join(tempfile.gettempdir(), prefix_id + 'formatted_consensus.fa')
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
 
-    status('Formatting the consensus')
+    return total
 
-    # Format the consensus reads
-    with open(consensus_file) as consensus_handle, open(formatted_file, mode='w') as formatted_handle:
-        for line in consensus_handle:
-            if re.match(r'^>', line):
-                formatted_handle.write(line)
 
-            else:
-                formatted_handle.write(line.upper())
+def lock_entry(lock_file, operation):
+    """
+    Lock a cache entry through its lock file. Eviction removes the lock file along with the entry, so a lock taken
+    on a file which has since been removed is taken again on the file now in its place.
 
-    return formatted_file
+    lock_file - the lock file of the entry
+    operation - fcntl.LOCK_SH or fcntl.LOCK_EX
 
+    Returns the open lock file, holding the lock
+    """
 
-def main(args):
-    """Executes the pipeline according to the user's arguments."""
+    while True:
+        entry_lock = open(lock_file, 'a')
+        fcntl.flock(entry_lock, operation)
 
-    try:
-        # Start the pipeline if the user provided a reference genome
-        if args['ref']:
-            # Ensure the reference file exists
-            if not os.path.isfile(args['ref']):
-                raise IOError()
+        try:
+            if os.path.samestat(os.fstat(entry_lock.fileno()), os.stat(lock_file)):
+                return entry_lock
 
-            else:
-                # Generate a random identifier to label the temp files with
-                prefix_id = str(random.getrandbits(32)) + '_'
-
-                # Determine if the user has provided an input file or wishes to use stdin
-                if args['input']:
-                    # Ensure the file exists
-                    if os.path.isfile(args['input']):
-                        ifile = args['input']
-                    else:
-                        raise IOError()
+        except EnvironmentError:
+            pass
 
-                else:
-                    ifile = os.path.join(tempfile.gettempdir(), prefix_id + 'stdin_dump.bam')
-                    with open(ifile, 'wb') as ifile_handle:
-                        for line in sys.stdin:
-                            ifile_handle.write(line)
+        entry_lock.close()
 
-                # Convert the input file containing the reads from BAM to FASTQ format
-                raw_reads = bam_to_fq(ifile, prefix_id, args['verbose'])
 
-                # Correct the reads if error correction has not been disabled
-                if not args['disable_ec']:
-                    # Transform the command line arguments into values Karect can use
-                    ploidy = 'haploid' if args['ploidy'] == 'n' else 'diploid'
+def evict_cache(cache_dir, max_size):
+    """
+    Remove the least recently used references from the cache until it fits within its size cap. References in use
+    by another run are never removed.
 
-                    if args['mode'] == 'equal':
-                        mode = 'edit'
+    cache_dir - directory containing the cached references
+    max_size - maximum size of the cache in bytes
+    """
 
-                    elif args['mode'] == 'indel':
-                        mode = 'insdel'
+    with open(os.path.join(cache_dir, 'cache.lock'), 'w') as cache_lock:
+        # Only one run may evict at a time
+        fcntl.flock(cache_lock, fcntl.LOCK_EX)
 
-                    else:
-                        mode = 'hamming'
+        # Every complete entry is stamped on use, so the stamp's mtime is the time of last use
+        entries = []
 
-                    # Run Karect
-                    corrected_reads = read_correction(raw_reads, ploidy, mode, args['verbose'])
+        for name in os.listdir(cache_dir):
+            stamp = os.path.join(cache_dir, name, 'complete')
 
-                else:
-                    corrected_reads = raw_reads
+            if os.path.isfile(stamp):
+                entries.append((os.path.getmtime(stamp), name, directory_size(os.path.join(cache_dir, name))))
 
-                # Align the reads
-                aligned_reads = read_alignment(corrected_reads, args['ref'], prefix_id, args['verbose'])
+        total = sum(size for _, _, size in entries)
 
-                # Convert the aligned reads to BAM format from SAM format
-                converted_aligned_reads = sam_to_bam(aligned_reads, prefix_id, args['verbose'])
+        for _, name, size in sorted(entries):
+            if total <= max_size:
+                break
 
-                # Sort and index the aligned reads
-                sorted_reads = sort_and_index(converted_aligned_reads, prefix_id, args['verbose'])
+            lock_file = os.path.join(cache_dir, name + '.lock')
 
-                # Call the variants and generate a consensus
-                consensus = call_variants(sorted_reads, args['ref'], prefix_id, args['verbose'])
+            with open(lock_file, 'a') as entry_lock:
+                # Skip entries held by other runs
+                try:
+                    fcntl.flock(entry_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
-                # Clean up the consensus formatting
-                cleaned_consensus = format_consensus(consensus, prefix_id)
+                except EnvironmentError:
+                    continue
 
-                # Determine if the user has provided an output file or wishes to use stdout
-                with open(cleaned_consensus) as consensus_handle:
-                    if args['output']:
-                        with open(args['output'], 'w') as ofile_handle:
-                            for line in consensus_handle:
-                                ofile_handle.write(line)
+                # Remove the stamp first so a partially deleted entry is never considered complete
+                os.remove(os.path.join(cache_dir, name, 'complete'))
+                shutil.rmtree(os.path.join(cache_dir, name))
 
-                    else:
-                        for line in consensus_handle:
-                            sys.stdout.write(line)
+                # Remove the lock file while still holding it, so runs waiting on it take the lock again on a new one
+                os.remove(lock_file)
+                total -= size
 
-                status('The reference genome has been successfully assembled!')
 
-        else:
-            # Raise an exception since no reference was provided
-            raise ValueError('A reference genome was not provided so the pipeline cannot execute')
+@contextlib.contextmanager
+def cached_reference(ref_genome_file, cache_dir, max_size=10 * 1000000000, verbose=False):
+    """
+    Retrieve a prepared copy of the reference genome from a persistent cache, building its Bowtie2 index and FASTA
+    index on a miss. The reference is locked for the duration of the context so it cannot be evicted while in use.
 
-    except KeyboardInterrupt:
-        # Exit the script cleanly if interrupted by user
-        error('')
+    ref_genome_file - file containing the reference genome in FASTA format
+    cache_dir - directory containing the cached references
+    max_size - maximum size of the cache in bytes
+    verbose - verbosity of subprocess
 
-    except ValueError as e:
-        # Print the error message before exiting the script
-        error(e)
+    Yields the cached reference genome file and the prefix of its Bowtie2 index
+    """
 
-    except EnvironmentError:
-        # Inform the user something is wrong with the execution environment
-        error('An error has occurred. Please ensure the input and reference files exist and all of the '
-              'required utilities are installed in your PATH')
+    # Ensure the reference is in the appropriate format
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
 
-    except CalledProcessError as e:
-        # Print an error message depending on which process failed
-        if e.cmd[0] == 'samtools':
-            if e.cmd[1] == 'bam2fq':
-                error('The reads could not be converted from BAM to FASTQ format')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
 
-            elif e.cmd[1] == 'view':
-                error('The reads could not be converted from SAM format to BAM format')
+    # Entries are keyed by content so renamed or copied references share an index
+    key = file_digest(ref_genome_file)
+    entry = os.path.join(cache_dir, key)
+    reference = os.path.join(entry, 'reference.fa')
+    index_prefix = os.path.join(entry, 'bt2_index')
+    stamp = os.path.join(entry, 'complete')
 
-            elif e.cmd[1] == 'sort':
-                error('The read file could not be sorted')
+    lock_file = os.path.join(cache_dir, key + '.lock')
+    entry_lock = lock_entry(lock_file, fcntl.LOCK_SH)
 
-            elif e.cmd[1] == 'index':
-                error('The sorted reads could not be indexed')
+    try:
+        if os.path.isfile(stamp):
+            status('Using the cached reference genome index')
 
-            elif e.cmd[1] == 'mpileup':
-                error('The reads could not be processed by mpileup before being called')
+        else:
+            # Take an exclusive lock and check again since another run may have built the entry meanwhile
+            entry_lock.close()
+            entry_lock = lock_entry(lock_file, fcntl.LOCK_EX)
 
-        elif e.cmd[0] == 'karect':
-            error('The reads could not be corrected')
+            if not os.path.isfile(stamp):
+                status('Preparing the reference genome for the cache')
 
-        elif e.cmd[0] == 'bowtie2-build':
-            error('An index could not be constructed from the reference genome provided')
+                if os.path.isdir(entry):
+                    shutil.rmtree(entry)
 
-        elif e.cmd[0] == 'bowtie2':
-            error('The reads could not be aligned to the reference genome')
+                os.makedirs(entry)
+                shutil.copyfile(ref_genome_file, reference)
 
-        elif e.cmd[0] == 'bcftools':
-            if e.cmd[1] == 'call':
-                error('The variants could not be called')
+                build_index(reference, verbose=verbose, index_prefix=index_prefix)
 
-            elif e.cmd[1] == 'index':
-                error('The variant index could not be constructed')
+                with open(os.devnull, 'w') as null_handle:
+                    err_handle = sys.stderr if verbose else null_handle
 
-            elif e.cmd[1] == 'consensus':
-                error('A consensus could not be generated from the variants')
+                    # Create the FASTA index used by samtools and bcftools
+                    run_command(['samtools', 'faidx', reference], stdout=null_handle, stderr=err_handle)
 
+                open(stamp, 'w').close()
 
-if __name__ == '__main__':
-    # Setup a parser object for user args
-    parser = argparse.ArgumentParser(prog='grapple', description='Genome Reference Assembly Pipeline', add_help=False)
+            fcntl.flock(entry_lock, fcntl.LOCK_SH)
 
-    parser.add_argument('-d', '--disable_ec', action='store_true', help='Disable error correction')
+        # Record the use of the entry for the LRU eviction
+        os.utime(stamp, None)
 
-    parser.add_argument('-h', '--help', action='help', help='Display this help screen')
+        evict_cache(cache_dir, max_size)
 
-    parser.add_argument('-i', '--input', help='Specify an input file of NGS reads in BAM format. If this flag is '
-                                              'not present, stdin is used instead')
+        yield reference, index_prefix
 
-    parser.add_argument('-o', '--output', help='Specify an output file for the resulting genome in FASTA format. If '
-                                               'this flag is not present, stdout is used instead')
+    finally:
+        entry_lock.close()
 
-    parser.add_argument('-r', '--ref', help='The reference genome used to align the read in FASTA format')
 
-    parser.add_argument('-V', '--version', action='version', version='Grapple 0.2.3',
-                        help='Show the current version of the software.')
+def file_extension(path):
+    """
+    Find the extension of a file, including the format of a gzip compressed file
 
-    parser.add_argument('-v', '--verbose', action='store_true', help='Output more information about each subprocess '
-                                                                     'being executed')
+    path - the file
 
-    parser.add_argument('--ploidy', choices=['n', '2n'], default='n', help='Specify the ploidy of the cells from which '
-                                                                           'the reads came from. If error correction '
-                                                                           'is disabled, this option is ignored. '
-                                                                           'Default value = n')
+    Returns the extension, such as .fq or .fq.gz
+    """
+
+    root, extension = os.path.splitext(path)
+
+    if extension == '.gz':
+        extension = os.path.splitext(root)[1] + extension
+
+    return extension
 
-    parser.add_argument('--mode', choices=['equal', 'indel', 'subs'], default='equal',
-                        help='Specify the type of errors that should be favoured during read correction '
-                             'The equal option weighs all types of errors equally. If error correction is disabled, '
-                             'this option is ignored. Default value = equal')
 
+def read_format(read_file):
+    """
+    Identify the format of a read file from its first bytes rather than from its extension
+
+    read_file - file containing the NGS reads, or - for stdin, which cannot be inspected without consuming it and is
+                taken to be BAM
+
+    Returns bam, cram, sam, fastq or fastq.gz, or None if the format is not recognized
+    """
+
+    if read_file == '-':
+        return 'bam'
+
+    with open(read_file, 'rb') as read_handle:
+        magic = read_handle.read(4)
+
+    if magic == b'CRAM':
+        return 'cram'
+
+    # BAM files are BGZF blocks, which are gzip members, so both BAM and FASTQ.gz files are told apart by their
+    # decompressed contents
+    if magic[:2] == b'\x1f\x8b':
+        with gzip.open(read_file, 'rb') as read_handle:
+            contents = read_handle.read(4)
+
+        if contents == b'BAM\x01':
+            return 'bam'
+
+        return 'fastq.gz' if contents.startswith(b'@') else None
+
+    # FASTQ records have a separator line, while SAM lines, headers included, are tab separated
+    with open(read_file, 'rb') as read_handle:
+        lines = [read_handle.readline() for _ in range(3)]
+
+    if lines[0].startswith(b'@') and lines[2].startswith(b'+'):
+        return 'fastq'
+
+    return 'sam' if b'\t' in lines[0] else None
+
+
+def typed_reads(read_file, prefix_id=''):
+    """
+    Identify the format of a read file and make sure its extension agrees with it, as the stages rely on extensions
+
+    read_file - file containing the NGS reads, or - for stdin
+    prefix_id - prefix of all temp files
+
+    Returns a tuple of the read file, linked under the extension of its format if its own does not match, and the
+    format
+    """
+
+    file_format = read_format(read_file)
+
+    if file_format is None:
+        raise ValueError('The read file is not in BAM, CRAM, SAM or FASTQ format')
+
+    extensions = {'bam': ['.bam'], 'cram': ['.cram'], 'sam': ['.sam'], 'fastq': ['.fq', '.fastq'],
+                  'fastq.gz': ['.fq.gz', '.fastq.gz']}[file_format]
+
+    if read_file == '-' or file_extension(read_file) in extensions:
+        return read_file, file_format
+
+    link = scratch_file(prefix_id + 'input_reads' + extensions[0])
+
+    if os.path.lexists(link):
+        os.remove(link)
+
+    os.symlink(os.path.abspath(read_file), link)
+
+    return link, file_format
+
+
+def bam_level(encoding, tool):
+    """
+    Choose the compression options of a samtools command writing an intermediate BAM file
+
+    encoding - the intermediate encoding policy
+    tool - the samtools subcommand, either view or sort
+
+    Returns the list of options to pass to the subcommand
+    """
+
+    level = _ENCODINGS[encoding]['bam']
+
+    if level is None:
+        return []
+
+    elif tool == 'view':
+        return ['-u'] if level == 0 else ['-' + str(level)]
+
+    return ['-l', str(level)]
+
+
+def bam_to_fq(read_file, prefix_id='', verbose=False, encoding='plain', ref_genome_file=None):
+    """
+    Convert the input file from BAM, CRAM or SAM to FASTQ using samtools.
+
+    read_file - file containing the NGS reads in BAM, CRAM or SAM format, or - to have samtools read stdin directly
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    encoding - the intermediate encoding policy, which decides whether the FASTQ file is gzip compressed
+    ref_genome_file - reference genome in FASTA format that CRAM reads are decoded against
+
+    Returns the FASTQ file
+    """
+
+    # Ensure that the file passed is in the proper format
+    if read_file != '-' and os.path.splitext(read_file)[1] not in ('.bam', '.cram', '.sam'):
+        raise ValueError('The read file is not in BAM, CRAM or SAM format')
+
+    level = _ENCODINGS[encoding]['fastq']
+
+    # Create a temporary output file to place the FASTQ output in
+    ofile = scratch_file(prefix_id + 'bam_to_fq_out.fq' + ('' if level is None else '.gz'))
+
+    status('Converting the input to FASTQ format')
+
+    command = ['samtools', 'bam2fq'] + (['--reference', ref_genome_file] if ref_genome_file else []) + [read_file]
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        if level is None:
+            with open(ofile, 'wb') as ofile_handle:
+                run_command(command, stdout=ofile_handle, stderr=err_handle)
+
+        else:
+            # Compress the FASTQ on its way to the disk, as the other stages writing FASTQ do
+            process = start_process(command, stdout=subprocess.PIPE, stderr=err_handle)
+
+            try:
+                with gzip.open(ofile, 'wb', level) as ofile_handle:
+                    shutil.copyfileobj(process.stdout, ofile_handle, 1 << 20)
+
+            finally:
+                process.stdout.close()
+
+                if process.wait():
+                    raise CalledProcessError(process.returncode, command)
+
+    return ofile
+
+
+def fastq_batches(read_file, batch_size=100000):
+    """
+    Read a FASTQ file in batches of reads so memory use does not grow with the file
+
+    read_file - file containing the NGS reads in FASTQ format, optionally gzip compressed
+    batch_size - number of reads in each batch
+
+    Yields a tuple of the headers, sequences and quality strings of the reads of each batch as lists of bytes, and
+    the fraction of the file read so far
+    """
+
+    size = os.path.getsize(read_file)
+
+    with (gzip.open if read_file.endswith('.gz') else open)(read_file, 'rb') as read_handle:
+        # The position in a compressed file is measured in the compressed bytes
+        raw_handle = getattr(read_handle, 'fileobj', read_handle)
+
+        while True:
+            lines = [line.rstrip(b'\r\n') for line in itertools.islice(read_handle, 4 * batch_size)]
+
+            if not lines:
+                break
+
+            if len(lines) % 4 or any(not header.startswith(b'@') for header in lines[::4]):
+                raise ValueError('The read file is not in FASTQ format')
+
+            headers, sequences, qualities = lines[::4], lines[1::4], lines[3::4]
+
+            if any(len(sequence) != len(quality) for sequence, quality in zip(sequences, qualities)):
+                raise ValueError('The read file is not in FASTQ format')
+
+            yield headers, sequences, qualities, min(1.0, raw_handle.tell() / float(size or 1))
+
+
+def write_fastq(ofile_handle, headers, sequences, qualities, lengths):
+    """
+    Write the reads of a batch which were kept
+
+    ofile_handle - handle of the FASTQ file to write to
+    headers - list of the headers of the reads
+    sequences - list of the sequences of the reads
+    qualities - list of the quality strings of the reads
+    lengths - array holding the length each read is cut to, with 0 for the reads left out
+
+    Returns the number of reads written
+    """
+
+    kept = numpy.flatnonzero(lengths)
+
+    for number in kept:
+        length = lengths[number]
+        ofile_handle.write(headers[number] + b'\n' + sequences[number][:length] + b'\n+\n' +
+                           qualities[number][:length] + b'\n')
+
+    return len(kept)
+
+
+def trim_batch(sequences, qualities, window=4, min_quality=20, min_length=36, max_n=0.1):
+    """
+    Trim and filter a batch of reads at once. Each read is cut at the start of the first window whose mean quality
+    falls below the threshold, then dropped if it is too short or holds too many unknown bases.
+
+    sequences - list of the sequences of the reads as bytes
+    qualities - list of the Phred+33 quality strings of the reads as bytes
+    window - number of bases averaged by the sliding window
+    min_quality - lowest mean quality of a window kept
+    min_length - shortest read kept after trimming
+    max_n - highest fraction of N bases in a read kept after trimming
+
+    Returns an array holding the trimmed length of each read, with 0 for the reads filtered out
+    """
+
+    lengths = numpy.array([len(sequence) for sequence in sequences], dtype=numpy.int64)
+
+    if not len(lengths) or not lengths.max():
+        return numpy.zeros(len(lengths), dtype=numpy.int64)
+
+    # Trim the batch in blocks of as many reads as fit in the matrix size, so long reads do not inflate the memory
+    rows = max(1, _TRIM_CELLS // int(lengths.max()))
+
+    if len(lengths) > rows:
+        return numpy.concatenate([trim_batch(sequences[start:start + rows], qualities[start:start + rows], window,
+                                             min_quality, min_length, max_n)
+                                  for start in range(0, len(lengths), rows)])
+
+    # Lay the batch out as a matrix with one read per row, padded past the end of each read
+    valid = numpy.arange(lengths.max()) < lengths[:, None]
+    bases = numpy.zeros(valid.shape, dtype=numpy.uint8)
+    scores = numpy.zeros(valid.shape, dtype=numpy.uint8)
+
+    bases[valid] = numpy.frombuffer(b''.join(sequences), dtype=numpy.uint8)
+    scores[valid] = numpy.frombuffer(b''.join(qualities), dtype=numpy.uint8) - 33
+
+    # Sum the qualities of every window, and find the first window of each read below the threshold. Reads shorter
+    # than a window are not trimmed.
+    starts = numpy.arange(max(scores.shape[1] - window + 1, 0))
+    totals = numpy.zeros((len(lengths), len(starts)), dtype=numpy.int32)
+
+    for offset in range(window if len(starts) else 0):
+        totals += scores[:, offset:offset + len(starts)]
+
+    low = (totals < min_quality * window) & (starts + window <= lengths[:, None])
+
+    trimmed = numpy.where(low.any(axis=1), low.argmax(axis=1), lengths) if len(starts) else lengths
+
+    # Filter the reads on their trimmed length and unknown bases
+    unknown = ((bases == ord('N')) & (numpy.arange(valid.shape[1]) < trimmed[:, None])).sum(axis=1)
+    kept = (trimmed >= max(min_length, 1)) & (unknown <= max_n * trimmed)
+
+    return numpy.where(kept, trimmed, 0)
+
+
+def trim_reads(read_file, prefix_id='', verbose=False, encoding='plain', window=4, min_quality=20, min_length=36,
+               max_n=0.1, batch_size=100000):
+    """
+    Trim the low quality tails of the reads and filter out the short and unknown reads before they are corrected
+    and aligned. The reads are processed in batches so memory use does not grow with the read file.
+
+    read_file - file containing the NGS reads in FASTQ format, optionally gzip compressed
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    encoding - the intermediate encoding policy, which decides whether the trimmed FASTQ file is gzip compressed
+    window - number of bases averaged by the sliding window
+    min_quality - lowest mean quality of a window kept
+    min_length - shortest read kept after trimming
+    max_n - highest fraction of N bases in a read kept after trimming
+    batch_size - number of reads trimmed at once
+
+    Returns the trimmed FASTQ file
+    """
+
+    # Ensure the file is in FASTQ format
+    if not re.match(r'\.((fastq)|(fq))', file_extension(read_file)):
+        raise ValueError('The read file is not in FASTQ format')
+
+    if window < 1 or min_quality < 0 or min_length < 0 or not 0 <= max_n <= 1:
+        raise ValueError('The trimming window must be positive and the thresholds must not be negative')
+
+    level = _ENCODINGS[encoding]['fastq']
+    ofile = scratch_file(prefix_id + 'trimmed_reads.fq' + ('' if level is None else '.gz'))
+
+    status('Trimming the reads')
+
+    read_count = kept_count = 0
+
+    with (open(ofile, 'wb') if level is None else gzip.open(ofile, 'wb', level)) as ofile_handle:
+        for headers, sequences, qualities, _ in fastq_batches(read_file, batch_size):
+            lengths = trim_batch(sequences, qualities, window, min_quality, min_length, max_n)
+
+            # Write the surviving reads
+            kept_count += write_fastq(ofile_handle, headers, sequences, qualities, lengths)
+            read_count += len(headers)
+
+    if verbose:
+        status('Kept ' + str(kept_count) + ' of ' + str(read_count) + ' reads')
+
+    return ofile
+
+
+def genome_size(ref_genome_file):
+    """
+    Measure the length of a reference genome without loading it into memory
+
+    ref_genome_file - file containing the reference genome in FASTA format
+
+    Returns the number of bases in every contig of the reference
+    """
+
+    size = 0
+
+    with open(ref_genome_file, 'rb') as ref_handle:
+        for line in ref_handle:
+            if not line.startswith(b'>'):
+                size += len(line.strip())
+
+    return size
+
+
+def downsample_reads(read_file, ref_genome_file, max_depth, prefix_id='', encoding='plain', seed=0,
+                     batch_size=100000):
+    """
+    Randomly keep just enough reads to cover the reference genome to a maximum depth in a single pass over the reads.
+    The rate at which reads are kept is adjusted after each batch from the bases seen so far and the fraction of the
+    file read, so the depth can be capped without counting the reads beforehand.
+
+    read_file - file containing the NGS reads in FASTQ format, optionally gzip compressed
+    ref_genome_file - file containing the reference genome in FASTA format
+    max_depth - mean depth of coverage to keep
+    prefix_id - prefix of all temp files
+    encoding - the intermediate encoding policy, which decides whether the downsampled FASTQ file is gzip compressed
+    seed - seed of the random number generator, so the same reads are kept every time
+    batch_size - number of reads sampled at once
+
+    Returns the downsampled FASTQ file
+    """
+
+    # Ensure the passed files are in the appropriate formats
+    if not re.match(r'\.((fastq)|(fq))', file_extension(read_file)):
+        raise ValueError('The read file is not in FASTQ format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    if max_depth <= 0:
+        raise ValueError('The maximum depth must be positive')
+
+    size = genome_size(ref_genome_file)
+
+    if not size:
+        raise ValueError('The reference genome does not contain any bases')
+
+    level = _ENCODINGS[encoding]['fastq']
+    ofile = scratch_file(prefix_id + 'downsampled_reads.fq' + ('' if level is None else '.gz'))
+
+    status('Downsampling the reads')
+
+    generator = numpy.random.RandomState(seed)
+    budget = max_depth * size
+    seen_bases = kept_bases = read_count = kept_count = 0
+
+    with (open(ofile, 'wb') if level is None else gzip.open(ofile, 'wb', level)) as ofile_handle:
+        for headers, sequences, qualities, progress in fastq_batches(read_file, batch_size):
+            lengths = numpy.array([len(sequence) for sequence in sequences], dtype=numpy.int64)
+            seen_bases += lengths.sum()
+
+            # Spread the remaining budget over this batch and the bases expected in the rest of the file
+            remaining = seen_bases * (1 - progress) / progress if progress > 0 else 0
+            rate = (budget - kept_bases) / float(lengths.sum() + remaining or 1)
+
+            lengths[generator.random_sample(len(lengths)) >= rate] = 0
+
+            kept_count += write_fastq(ofile_handle, headers, sequences, qualities, lengths)
+            kept_bases += lengths.sum()
+            read_count += len(headers)
+
+    status('Kept ' + str(kept_count) + ' of ' + str(read_count) + ' reads for a depth of ' +
+           str(round(kept_bases / float(size), 1)) + 'x')
+
+    return ofile
+
+
+def split_reads(read_file, chunk_size, prefix_id='', cluster=False, prefix_length=4, batch_size=100000):
+    """
+    Split the reads into chunks which can be corrected separately. Optionally, the reads are first clustered by the
+    k-mer they start with so the reads sharing k-mers tend to be corrected together.
+
+    read_file - file containing the NGS reads in FASTQ format, optionally gzip compressed
+    chunk_size - size of each chunk in bytes. A chunk may exceed it by one read, or by a cluster when clustering.
+    prefix_id - prefix of all temp files
+    cluster - whether the reads are clustered by their leading k-mer
+    prefix_length - length of the k-mer the reads are clustered by
+    batch_size - number of reads read at once
+
+    Returns the list of chunk files in order
+    """
+
+    chunk_files = []
+    ofile_handles = []
+
+    def chunk_handle(number):
+        """Returns the handle of a chunk file, creating the chunk files up to it"""
+
+        while len(ofile_handles) <= number:
+            chunk_files.append(scratch_file(prefix_id + 'chunk_' + str(len(chunk_files)) + '.fq'))
+            ofile_handles.append(open(chunk_files[-1], 'wb'))
+
+        return ofile_handles[number]
+
+    def read_clusters(sequences):
+        """Returns the cluster of each read, its leading k-mer as a number, or a cluster of its own if it holds N"""
+
+        kmers = b''.join(sequence[:prefix_length].ljust(prefix_length, b'N') for sequence in sequences)
+        codes = _PILEUP_COLUMNS[numpy.frombuffer(kmers, dtype=numpy.uint8)].reshape(-1, prefix_length)
+        clusters = codes.astype(numpy.int64).dot(4 ** numpy.arange(prefix_length - 1, -1, -1))
+
+        clusters[(codes == 4).any(axis=1)] = 4 ** prefix_length
+
+        return clusters
+
+    try:
+        if cluster:
+            # Measure each cluster, then fill the chunks with whole clusters in k-mer order
+            cluster_sizes = numpy.zeros(4 ** prefix_length + 1, dtype=numpy.int64)
+
+            for headers, sequences, qualities, _ in fastq_batches(read_file, batch_size):
+                sizes = [len(header) + 2 * len(sequence) + 5 for header, sequence in zip(headers, sequences)]
+                cluster_sizes += numpy.bincount(read_clusters(sequences), weights=sizes,
+                                                minlength=len(cluster_sizes)).astype(numpy.int64)
+
+            # Each cluster goes to the chunk in which the running total up to its start falls
+            starts = numpy.concatenate(([0], numpy.cumsum(cluster_sizes)[:-1]))
+            cluster_chunks = starts // max(1, chunk_size)
+
+            for headers, sequences, qualities, _ in fastq_batches(read_file, batch_size):
+                for header, sequence, quality, number in zip(headers, sequences, qualities,
+                                                             cluster_chunks[read_clusters(sequences)]):
+                    chunk_handle(number).write(header + b'\n' + sequence + b'\n+\n' + quality + b'\n')
+
+        else:
+            # Keep the reads in their original order, starting a new chunk once the current one is full
+            number = 0
+            written = 0
+
+            for headers, sequences, qualities, _ in fastq_batches(read_file, batch_size):
+                for header, sequence, quality in zip(headers, sequences, qualities):
+                    if written >= chunk_size:
+                        number += 1
+                        written = 0
+
+                    record = header + b'\n' + sequence + b'\n+\n' + quality + b'\n'
+                    chunk_handle(number).write(record)
+                    written += len(record)
+
+    finally:
+        for ofile_handle in ofile_handles:
+            ofile_handle.close()
+
+    # Chunks left empty by large clusters are not worth a Karect process
+    for chunk_file in chunk_files:
+        if not os.path.getsize(chunk_file):
+            os.remove(chunk_file)
+
+    return [chunk_file for chunk_file in chunk_files if os.path.isfile(chunk_file)]
+
+
+def run_karect(read_file, cell_type, match_type, threads, memory, verbose=False, work_dir=None):
+    """
+    Run Karect on a plain FASTQ file, writing the corrected reads next to the scratch files
+
+    read_file - file containing the NGS reads in FASTQ format
+    cell_type - type of cell the reads are from
+    match_type - correction mode to be used
+    threads - number of threads Karect may use
+    memory - memory in GB Karect may use
+    verbose - verbosity of subprocess
+    work_dir - directory of its own for the temp files and corrected reads of this process, as the names of Karect's
+               temp files do not depend on its input. Defaults to the scratch directory.
+
+    Returns the FASTQ corrected file
+    """
+
+    work_dir = work_dir or scratch_directory()
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        # Correct the reads
+        # Note: Karect uses stdout rather than stderr for user information so stdout is redirected to err_handle
+        run_command(['karect', '-correct', '-inputfile=' + read_file, '-celltype=' + cell_type,
+                     '-matchtype=' + match_type, '-threads=' + str(threads), '-memory=' + str(memory),
+                     '-resultdir=' + work_dir, '-tempdir=' + work_dir],
+                    stdout=err_handle, stderr=err_handle)
+
+    # Return the location of the output file
+    return os.path.join(work_dir, 'karect_' + os.path.split(read_file)[1])
+
+
+def read_correction(read_file, cell_type='haploid', match_type='edit', verbose=False, chunked=False, cluster=False):
+    """
+    Correct the raw reads using Karect. Reads too large for one Karect process to correct within the memory budget
+    can be split into chunks which are corrected in waves of concurrent processes and joined in order.
+
+    read_file - file containing the NGS reads in FASTQ format
+    cell_type - type of cell the reads are from
+    match_type - correction mode to be used
+    verbose - verbosity of subprocess
+    chunked - whether the reads are split into chunks sized against the memory budget
+    cluster - whether the reads are clustered by their leading k-mer before they are split
+
+    Returns the FASTQ corrected file
+    """
+
+    # Ensure the file is in FASTQ format
+    if not re.match(r'\.((fastq)|(fq))', file_extension(read_file)):
+        raise ValueError('The read file is not in FASTQ format')
+
+    # Ensure the file exists (karect does not return an error code if it does not exist)
+    if not os.path.isfile(read_file):
+        raise ValueError('The read file does not exist')
+
+    # Ensure that karect's parameters are valid (karect does not return an error code if they are not)
+    if not re.match(r'(haploid)|(diploid)', cell_type):
+        raise ValueError('The cell type is not a valid value')
+
+    if not re.match(r'(edit)|(hamming)|(insdel)', match_type):
+        raise ValueError('The match type is not a valid value')
+
+    # Get system parameters
+    thread_number = tuned_threads('karect', read_file)
+    memory_number = memory_limit()
+
+    status('Correcting the reads')
+
+    plain_name = os.path.split(read_file)[1][:-3] if read_file.endswith('.gz') else os.path.split(read_file)[1]
+
+    if chunked:
+        # Run a Karect process per four threads, each with its share of the memory, and size the chunks to fit it
+        processes = max(1, thread_number // 4)
+        chunk_size = int(memory_number / processes * 1000000000 / _KARECT_MEMORY_FACTOR)
+
+        # Compressed reads take several times their size once decompressed
+        plain_size = os.path.getsize(read_file) * (4 if read_file.endswith('.gz') else 1)
+
+        if plain_size > chunk_size:
+            chunk_files = split_reads(read_file, chunk_size, plain_name[:-len(file_extension(plain_name))] + '_',
+                                      cluster)
+            processes = max(1, min(processes, len(chunk_files)))
+
+            status('Correcting ' + str(len(chunk_files)) + ' chunks of the reads, ' + str(processes) + ' at a time')
+
+            # Concurrent Karect processes would overwrite each other's temp files, so each chunk gets a directory
+            chunk_dirs = [tempfile.mkdtemp(dir=scratch_directory()) for _ in chunk_files]
+
+            def correct_chunk(job):
+                """Correct the reads of one chunk"""
+
+                chunk_file, chunk_dir = job
+
+                try:
+                    return run_karect(chunk_file, cell_type, match_type, max(1, thread_number // processes),
+                                      memory_number / processes, verbose, chunk_dir)
+
+                finally:
+                    os.remove(chunk_file)
+
+            # The work happens in the subprocesses, so threads are enough to keep the Karect processes running
+            pool = stage_pool(processes)
+
+            try:
+                try:
+                    corrected_files = pool.map(correct_chunk, list(zip(chunk_files, chunk_dirs)))
+
+                finally:
+                    pool.close()
+                    pool.join()
+
+                # Join the corrected chunks in order
+                ofile = scratch_file('karect_' + plain_name)
+
+                with open(ofile, 'wb') as ofile_handle:
+                    for corrected_file in corrected_files:
+                        with open(corrected_file, 'rb') as corrected_handle:
+                            shutil.copyfileobj(corrected_handle, ofile_handle, 1 << 20)
+
+            finally:
+                for chunk_dir in chunk_dirs:
+                    shutil.rmtree(chunk_dir, ignore_errors=True)
+
+            return ofile
+
+    # Karect cannot read compressed reads, so give it a plain copy for the duration of the correction
+    plain_file = read_file
+
+    if read_file.endswith('.gz'):
+        plain_file = scratch_file(plain_name)
+
+        with gzip.open(read_file, 'rb') as read_handle, open(plain_file, 'wb') as plain_handle:
+            shutil.copyfileobj(read_handle, plain_handle, 1 << 20)
+
+    try:
+        return run_karect(plain_file, cell_type, match_type, thread_number, memory_number, verbose)
+
+    finally:
+        if plain_file != read_file:
+            os.remove(plain_file)
+
+
+def read_alignment(read_file, ref_genome_file, prefix_id='', verbose=False, index_prefix=None):
+    """
+    Align the reads to the reference genome using Bowtie2.
+
+    read_file - file containing the NGS reads to align in FASTQ format
+    ref_genome_file - file containing the reference genome in FASTA format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    index_prefix - prefix of a prebuilt index of the reference genome, built on demand if not given
+
+    Returns the aligned FASTQ read file
+    """
+
+    # Ensure the passed files are in the appropriate formats
+    if not re.match(r'\.((fq)|(fastq))', file_extension(read_file)):
+        raise ValueError('The read file is not in FASTQ format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    # Get system parameters
+    thread_number = tuned_threads('bowtie2', read_file)
+
+    ofile = scratch_file(prefix_id + 'aligned_reads.sam')
+
+    status('Aligning the reads')
+
+    # Create an index file from the reference genome unless one was provided
+    if index_prefix is None:
+        index_prefix = build_index(ref_genome_file, prefix_id, verbose)
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        with open(ofile, 'w') as ofile_handle:
+            # Align the reads
+            run_command(['bowtie2', '-p', str(thread_number), '-x', index_prefix, '-U', read_file],
+                        stdout=ofile_handle, stderr=err_handle)
+
+    return ofile
+
+
+def sam_to_bam(read_file, prefix_id='', verbose=False, encoding='plain'):
+    """
+    Convert the input file from SAM format to BAM format
+
+    read_file - reads in SAM format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    encoding - the intermediate encoding policy, which decides the compression level of the BAM file
+
+    Returns the converted BAM read file
+    """
+
+    # Ensure the read file is in SAM format
+    if os.path.splitext(read_file)[1] != '.sam':
+        raise ValueError('The read file is not in SAM format')
+
+    ofile = scratch_file(prefix_id + 'aligned_reads.bam')
+
+    status('Converting the aligned reads from SAM format to BAM format')
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        # Convert the read file format
+        run_command(['samtools', 'view', '-b'] + bam_level(encoding, 'view') + ['-o', ofile, read_file],
+                    stdout=null_handle, stderr=err_handle)
+
+    return ofile
+
+
+def sort_and_index(read_file, prefix_id='', verbose=False, encoding='plain'):
+    """
+    Sort and index the aligned reads
+
+    read_file - aligned reads in SAM format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    encoding - the intermediate encoding policy, which decides the compression level of the sorted BAM file
+
+    Returns the sorted and indexed SAM read file
+    """
+
+    # Ensure read file is in BAM format
+    if os.path.splitext(read_file)[1] != '.bam':
+        raise ValueError('The read file is not in BAM format')
+
+    # Get system parameters
+    options = sort_options(tuned_threads('samtools sort', read_file)) + bam_level(encoding, 'sort')
+
+    temp_prefix = scratch_file(prefix_id + 'samtools_sorting')
+    ofile = scratch_file(prefix_id + 'sorted_reads.bam')
+
+    status('Sorting and indexing the reads')
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        # Sort the read file
+        run_command(['samtools', 'sort', '-o', ofile] + options + ['-T', temp_prefix, read_file],
+                    stdout=null_handle, stderr=err_handle)
+
+        # Index the sorted reads
+        run_command(['samtools', 'index', ofile], stdout=null_handle, stderr=err_handle)
+
+    return ofile
+
+
+def stream_alignment(read_file, ref_genome_file, prefix_id='', verbose=False, index_prefix=None, encoding='plain'):
+    """
+    Align, sort and index the reads with the stages connected by pipes so no intermediate SAM, unsorted BAM or
+    (for BAM input) FASTQ file is written to disk.
+
+    read_file - file containing the NGS reads in BAM or FASTQ format, or - to stream BAM reads from stdin
+    ref_genome_file - file containing the reference genome in FASTA format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    index_prefix - prefix of a prebuilt index of the reference genome, built on demand if not given
+    encoding - the intermediate encoding policy, which decides the compression level of the sorted BAM file
+
+    Returns the sorted and indexed BAM read file
+    """
+
+    # Ensure the passed files are in the appropriate formats
+    read_ext = '.bam' if read_file == '-' else file_extension(read_file)
+
+    if read_ext != '.bam' and not re.match(r'\.((fq)|(fastq))', read_ext):
+        raise ValueError('The read file is not in BAM or FASTQ format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    # Get system parameters
+    thread_number = tuned_threads('bowtie2', read_file)
+
+    temp_prefix = scratch_file(prefix_id + 'samtools_sorting')
+    ofile = scratch_file(prefix_id + 'sorted_reads.bam')
+
+    status('Aligning, sorting and indexing the reads')
+
+    # Create an index file from the reference genome unless one was provided
+    if index_prefix is None:
+        index_prefix = build_index(ref_genome_file, prefix_id, verbose)
+
+    # Feed BAM input through bam2fq so the FASTQ never reaches the disk
+    commands = [['samtools', 'bam2fq', read_file]] if read_ext == '.bam' else []
+    commands.append(['bowtie2', '-p', str(thread_number), '-x', index_prefix,
+                     '-U', '-' if read_ext == '.bam' else read_file])
+    commands.append(['samtools', 'sort', '-o', ofile] + sort_options(tuned_threads('samtools sort', read_file)) +
+                    bam_level(encoding, 'sort') + ['-T', temp_prefix, '-'])
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        # Align and sort the reads
+        run_pipeline(commands, stdout=null_handle, stderr=err_handle)
+
+        # Index the sorted reads
+        run_command(['samtools', 'index', ofile], stdout=null_handle, stderr=err_handle)
+
+    return ofile
+
+
+def shard_alignment(read_file, ref_genome_file, prefix_id='', verbose=False, index_prefix=None, shards=2,
+                    encoding='plain', batch_size=100000):
+    """
+    Align the reads in shards with concurrent Bowtie2 processes, each piped into a sort of its own so the sorting
+    overlaps with the alignment, then merge and index the sorted shards. The reads are dealt from the read file
+    straight into the aligners, so no copy of them is written.
+
+    read_file - file containing the NGS reads in FASTQ format, optionally gzip compressed
+    ref_genome_file - file containing the reference genome in FASTA format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    index_prefix - prefix of a prebuilt index of the reference genome, built on demand if not given
+    shards - number of shards aligned concurrently
+    encoding - the intermediate encoding policy, which decides the compression level of the sorted BAM files
+    batch_size - number of reads dealt into the shards at once
+
+    Returns the sorted and indexed BAM read file
+    """
+
+    # Ensure the passed files are in the appropriate formats
+    if not re.match(r'\.((fq)|(fastq))', file_extension(read_file)):
+        raise ValueError('The read file is not in FASTQ format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    if shards < 1:
+        raise ValueError('The number of shards must be positive')
+
+    # Split the threads and memory between the shards, and the threads of each shard between its aligner and its
+    # sort, which run at the same time
+    shard_threads = max(1, thread_count() // shards)
+    sort_threads = max(1, shard_threads // 4)
+    align_threads = max(1, shard_threads - sort_threads)
+    memory_number = memory_limit() / shards
+
+    ofile = scratch_file(prefix_id + 'sorted_reads.bam')
+
+    status('Aligning, sorting and indexing the reads in ' + str(shards) + ' shards')
+
+    # Create an index file from the reference genome unless one was provided
+    if index_prefix is None:
+        index_prefix = build_index(ref_genome_file, prefix_id, verbose)
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        # Feed each shard's aligner through a pipe of its own
+        pipes = [os.pipe() for _ in range(shards)]
+        ifile_handles = [os.fdopen(read_end, 'rb') for read_end, _ in pipes]
+        ofile_handles = [os.fdopen(write_end, 'wb') for _, write_end in pipes]
+
+        def align_shard(number):
+            """Align and sort the reads of one shard"""
+
+            shard_ofile = scratch_file(prefix_id + 'sorted_shard_' + str(number) + '.bam')
+
+            run_pipeline([['bowtie2', '-p', str(align_threads), '-x', index_prefix, '-U', '-'],
+                          ['samtools', 'sort', '-o', shard_ofile] + sort_options(sort_threads, memory_number) +
+                          bam_level(encoding, 'sort') +
+                          ['-T', scratch_file(prefix_id + 'samtools_sorting_' + str(number)), '-']],
+                         stdout=null_handle, stderr=err_handle, stdin=ifile_handles[number])
+
+            return shard_ofile
+
+        # The work happens in the subprocesses, so threads are enough to keep every shard running
+        pool = stage_pool(shards)
+
+        try:
+            results = pool.map_async(align_shard, range(shards))
+
+            def close_pipes():
+                """Close the pipes into the aligners, which then finish once they have read what was dealt"""
+
+                for ofile_handle in ofile_handles:
+                    try:
+                        ofile_handle.close()
+
+                    except EnvironmentError:
+                        # The aligner has already exited, so the reads still buffered are of no use
+                        pass
+
+            # Deal the reads into the shards in turn so they end up the same size
+            try:
+                turn = 0
+
+                for headers, sequences, qualities, _ in fastq_batches(read_file, batch_size):
+                    dealt = [[] for _ in range(shards)]
+
+                    for header, sequence, quality in zip(headers, sequences, qualities):
+                        dealt[turn].append(header + b'\n' + sequence + b'\n+\n' + quality + b'\n')
+                        turn = (turn + 1) % shards
+
+                    try:
+                        for ofile_handle, reads in zip(ofile_handles, dealt):
+                            ofile_handle.write(b''.join(reads))
+
+                    except EnvironmentError:
+                        # An aligner which exits early breaks its pipe, and its own failure is the one worth
+                        # reporting
+                        close_pipes()
+                        results.get()
+                        raise
+
+            finally:
+                close_pipes()
+
+            sorted_shards = results.get()
+
+        finally:
+            pool.close()
+            pool.join()
+
+        # Merge the sorted shards, which only interleaves them
+        run_command(['samtools', 'merge', '-f', '-@', str(max(0, thread_count() - 1))] +
+                    bam_level(encoding, 'sort') + [ofile] + sorted_shards,
+                    stdout=null_handle, stderr=err_handle)
+
+        for sorted_shard in sorted_shards:
+            os.remove(sorted_shard)
+
+        # Index the sorted reads
+        run_command(['samtools', 'index', ofile], stdout=null_handle, stderr=err_handle)
+
+    return ofile
+
+
+def index_reference(ref_genome_file, verbose=False):
+    """
+    Build the FASTA index of the reference genome if it does not exist yet
+
+    ref_genome_file - reference genome in FASTA format
+    verbose - verbosity of subprocess
+
+    Returns the FASTA index file
+    """
+
+    if not os.path.isfile(ref_genome_file + '.fai'):
+        with open(os.devnull, 'w') as null_handle:
+            err_handle = sys.stderr if verbose else null_handle
+
+            run_command(['samtools', 'faidx', ref_genome_file], stdout=null_handle, stderr=err_handle)
+
+    return ref_genome_file + '.fai'
+
+
+def reference_regions(ref_genome_file, region_size=None, verbose=False):
+    """
+    Split the reference genome into regions using its FASTA index, which is built if it does not exist yet
+
+    ref_genome_file - reference genome in FASTA format
+    region_size - maximum length of a region in bases, or None for one region per contig
+    verbose - verbosity of subprocess
+
+    Returns a list of regions in samtools notation, in reference order
+    """
+
+    regions = []
+
+    with open(index_reference(ref_genome_file, verbose)) as index_handle:
+        for line in index_handle:
+            contig, length = line.split('\t')[:2]
+            length = int(length)
+
+            if region_size is None or length <= region_size:
+                regions.append(contig)
+
+            else:
+                # Regions are 1-based and inclusive
+                for start in range(1, length + 1, region_size):
+                    regions.append(contig + ':' + str(start) + '-' + str(min(start + region_size - 1, length)))
+
+    return regions
+
+
+def apply_variants(variant_file, ref_genome_file, consensus_file, verbose=False, line_width=60, chunk_size=1 << 20):
+    """
+    Generate a consensus by applying the variants to the reference genome in a single pass, writing it upper-cased
+    and in lines of the width bcftools consensus uses. The reference is memory mapped and read through the offsets
+    of its FASTA index while the variants are streamed in reference order. As with bcftools consensus, the first
+    alternate allele of each variant is applied and a variant overlapping one already applied is skipped.
+
+    variant_file - variants sorted in reference order in VCF format, optionally gzip compressed
+    ref_genome_file - reference genome in FASTA format
+    consensus_file - file to write the consensus to in FASTA format
+    verbose - verbosity of subprocess
+    line_width - number of bases on each line of the consensus
+    chunk_size - number of bases of the reference read at a time
+
+    Returns the consensus file
+    """
+
+    index_reference(ref_genome_file, verbose)
+
+    # Each line of the index holds the name, length, offset, bases per line and bytes per line of a contig
+    with open(ref_genome_file + '.fai', 'rb') as index_handle:
+        contigs = [(fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]))
+                   for fields in (line.split(b'\t') for line in index_handle) if len(fields) >= 5]
+
+    order = dict((contig[0], number) for number, contig in enumerate(contigs))
+
+    with open(variant_file, 'rb') as variant_handle:
+        compressed = variant_handle.read(2) == b'\x1f\x8b'
+
+    status('Applying the variants to the reference genome')
+
+    with open(ref_genome_file, 'rb') as ref_handle, open(consensus_file, 'wb') as consensus_handle, \
+            (gzip.open if compressed else open)(variant_file, 'rb') as variant_handle:
+        reference = mmap.mmap(ref_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The bases of the current contig that do not yet fill a line
+        partial_line = [b'']
+
+        def write(sequence):
+            """Write bases of the consensus, breaking them into lines"""
+
+            sequence = partial_line[0] + sequence
+            end = len(sequence) - len(sequence) % line_width
+
+            consensus_handle.write(b''.join(sequence[start:start + line_width] + b'\n'
+                                            for start in range(0, end, line_width)))
+            partial_line[0] = sequence[end:]
+
+        def bases(contig, start, end):
+            """Read the upper-cased bases of a contig between two positions, skipping the line breaks"""
+
+            _, length, offset, line_bases, line_bytes = contig
+            end = min(end, length)
+
+            if end <= start:
+                return b''
+
+            first = offset + start // line_bases * line_bytes + start % line_bases
+            last = offset + (end - 1) // line_bases * line_bytes + (end - 1) % line_bases + 1
+
+            return reference[first:last].translate(_UPPERCASE, b'\r\n')
+
+        try:
+            # Records of contigs missing from the reference are ignored, as bcftools consensus never asks for them
+            records = (line.rstrip(b'\r\n').split(b'\t', 5) for line in variant_handle
+                       if line.strip() and not line.startswith(b'#'))
+            records = (fields for fields in records if fields[0] in order)
+            record = next(records, None)
+
+            for number, contig in enumerate(contigs):
+                name, length, offset = contig[:3]
+
+                # Copy the header line preceding the bases of the contig
+                header_start = reference.rfind(b'\n', 0, offset - 1) + 1
+                consensus_handle.write(reference[header_start:offset].rstrip(b'\r\n') + b'\n')
+
+                position = 0
+
+                while record is not None and order[record[0]] <= number:
+                    if order[record[0]] < number or len(record) < 5:
+                        raise ValueError('The variant file is not sorted in reference order in VCF format')
+
+                    start, ref_allele, alt_allele = int(record[1]) - 1, record[3].upper(), record[4].split(b',')[0]
+
+                    # Missing, spanning deletion and symbolic alleles have no bases to apply
+                    if start >= position and alt_allele not in (b'.', b'*') and not alt_allele.startswith(b'<'):
+                        if bases(contig, start, start + len(ref_allele)) != ref_allele:
+                            raise ValueError('The reference allele of the variant at ' + name.decode('utf-8') + ':' +
+                                             record[1].decode('utf-8') + ' does not match the reference genome')
+
+                        for chunk_start in range(position, start, chunk_size):
+                            write(bases(contig, chunk_start, min(start, chunk_start + chunk_size)))
+
+                        write(alt_allele.upper())
+                        position = start + len(ref_allele)
+
+                    record = next(records, None)
+
+                for chunk_start in range(position, length, chunk_size):
+                    write(bases(contig, chunk_start, chunk_start + chunk_size))
+
+                if partial_line[0]:
+                    consensus_handle.write(partial_line[0] + b'\n')
+                    partial_line[0] = b''
+
+            if record is not None:
+                raise ValueError('The variant file is not sorted in reference order in VCF format')
+
+        finally:
+            reference.close()
+
+    return consensus_file
+
+
+def call_variants(read_file, ref_genome_file, prefix_id='', verbose=False, region_size=None, region_dir=None,
+                  changed=None):
+    """
+    Call the variants in the read file using the reference genome. When the reference holds several contigs or a
+    region size is given, the regions are called concurrently and their variants concatenated in reference order,
+    which produces the same consensus as calling the whole genome at once. The variants are then applied to the
+    reference, giving a consensus that needs no further formatting.
+
+    read_file - sorted and indexed reads in BAM format
+    ref_genome_file - reference genome in FASTA format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    region_size - maximum length in bases of the regions called concurrently, or None for one region per contig
+    region_dir - directory in which the variants of each region are kept between runs, or None
+    changed - numbers of the regions to call again, or None to call every region. The variants of the other regions
+              are taken from the region directory unless they are missing.
+
+    Returns the consensus file in FASTA format
+    """
+
+    # Ensure the files are in the appropriate format
+    if os.path.splitext(read_file)[1] != '.bam':
+        raise ValueError('The read file is not in BAM format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    if region_size is not None and region_size < 1:
+        raise ValueError('The region size must be a positive number of bases')
+
+    pileup = scratch_file(prefix_id + 'pileup.vcf', large=False)
+    variants = scratch_file(prefix_id + 'variants.vcf', large=False)
+    ofile = scratch_file(prefix_id + 'consensus.fa', large=False)
+
+    status('Calling the variants')
+
+    regions = reference_regions(ref_genome_file, region_size, verbose)
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        if len(regions) > 1 or region_dir is not None:
+            region_variants = [os.path.join(region_dir, 'variants_' + str(number) + '.vcf.gz') if region_dir else
+                               scratch_file(prefix_id + 'variants_' + str(number) + '.vcf.gz', large=False)
+                               for number in range(len(regions))]
+
+            jobs = [job for number, job in enumerate(zip(regions, region_variants))
+                    if changed is None or number in changed or not os.path.isfile(job[1])]
+
+            def call_region(job):
+                """Call the variants of one region"""
+
+                region, region_ofile = job
+
+                # Replace the variants of a kept region only once they are complete
+                run_pipeline([['samtools', 'mpileup', '-uf', ref_genome_file, '-r', region, read_file],
+                              ['bcftools', 'call', '-mv', '-Oz', '-o', region_ofile + '.tmp']],
+                             stdout=null_handle, stderr=err_handle)
+
+                os.rename(region_ofile + '.tmp', region_ofile)
+
+            # The work happens in the subprocesses, so threads are enough to keep one region per core running
+            pool = stage_pool(max(1, min(thread_count(), len(jobs))))
+
+            try:
+                pool.map(call_region, jobs)
+
+            finally:
+                pool.close()
+                pool.join()
+
+            # Join the variants of every region in reference order
+            run_command(['bcftools', 'concat', '-Oz', '-o', variants] + region_variants,
+                        stdout=null_handle, stderr=err_handle)
+
+        else:
+            # Run mpileup
+            run_command(['samtools', 'mpileup', '-uf', ref_genome_file, '-o', pileup, read_file],
+                        stdout=null_handle, stderr=err_handle)
+
+            # Call the variants
+            run_command(['bcftools', 'call', '-mv', '-Oz', '-o', variants, pileup], stdout=err_handle,
+                        stderr=null_handle)
+
+    # Generate a consensus
+    return apply_variants(variants, ref_genome_file, ofile, verbose)
+
+
+def split_record(line, field_count):
+    """
+    Split a SAM record into its fields, checking that it holds the fields read from it
+
+    line - SAM record as bytes
+    field_count - number of fields read from the record, after which the rest of the record is left unsplit
+
+    Returns the fields of the record, and its flag and position as integers
+    """
+
+    fields = line.split(b'\t', field_count)
+
+    try:
+        if len(fields) < field_count:
+            raise ValueError()
+
+        return fields, int(fields[1]), int(fields[3])
+
+    except ValueError:
+        raise ValueError('Malformed SAM record: ' + line[:80].rstrip(b'\r\n').decode('utf-8', 'replace'))
+
+
+def overlapping_regions(alignments, regions):
+    """
+    Find the regions overlapped by alignments
+
+    alignments - iterable of alignments in SAM format as bytes
+    regions - list of regions in samtools notation, as returned by reference_regions()
+
+    Returns the set of the numbers of the regions holding at least one aligned read
+    """
+
+    # Bounds of each region, grouped by contig
+    bounds = {}
+
+    for number, region in enumerate(regions):
+        contig, _, span = region.partition(':')
+        start, end = span.split('-') if span else (1, float('inf'))
+        bounds.setdefault(contig.encode(), []).append((int(start), float(end), number))
+
+    touched = set()
+
+    for line in alignments:
+        if line.startswith(b'@'):
+            continue
+
+        fields, flag, start = split_record(line, 6)
+
+        if flag & 0x4:
+            continue
+
+        # The alignment ends after the reference bases consumed by its CIGAR
+        end = start + sum(int(length) for length, operation in _CIGAR.findall(fields[5])
+                          if operation in b'MDN=X') - 1
+
+        for region_start, region_end, number in bounds.get(fields[2], []):
+            if region_start <= end and start <= region_end:
+                touched.add(number)
+
+    return touched
+
+
+def touched_regions(read_file, regions, verbose=False):
+    """
+    Find the regions overlapped by the alignments of a read file
+
+    read_file - aligned reads in BAM format
+    regions - list of regions in samtools notation, as returned by reference_regions()
+    verbose - verbosity of subprocess
+
+    Returns the set of the numbers of the regions holding at least one aligned read
+    """
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        process = start_process(['samtools', 'view', read_file], stdout=subprocess.PIPE, stderr=err_handle)
+        malformed = None
+
+        try:
+            touched = overlapping_regions(process.stdout, regions)
+
+        except ValueError as e:
+            malformed = e
+
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+
+    # samtools is stopped by the pipe closed after a malformed record, which is not a failure of its own
+    if return_code and (malformed is None or return_code != -13):
+        raise CalledProcessError(return_code, ['samtools', 'view', read_file])
+
+    if malformed is not None:
+        raise malformed
+
+    return touched
+
+
+def update_variants(read_file, ref_genome_file, sample_dir, prefix_id='', verbose=False, region_size=None):
+    """
+    Merge newly aligned reads into the reads kept for a sample and call the variants again only in the regions
+    the new reads overlap, so a top-up run costs time in proportion to the new reads rather than to every read of
+    the sample. The kept reads, the variants of each region and the state of the sample are stored in the sample
+    directory, which is started afresh if the reference genome changes.
+
+    read_file - the new reads, sorted and indexed in BAM format
+    ref_genome_file - reference genome in FASTA format
+    sample_dir - directory holding the reads and variants of the sample
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    region_size - maximum length in bases of the regions called concurrently, or None for regions of
+                  _UPDATE_REGION_SIZE bases
+
+    Returns the consensus file in FASTA format
+    """
+
+    # Ensure the files are in the appropriate format
+    if os.path.splitext(read_file)[1] != '.bam':
+        raise ValueError('The read file is not in BAM format')
+
+    if region_size is None:
+        region_size = _UPDATE_REGION_SIZE
+
+    if not os.path.isdir(sample_dir):
+        os.makedirs(sample_dir)
+
+    state_file = os.path.join(sample_dir, 'sample.json')
+
+    try:
+        with open(state_file) as state_handle:
+            state = json.load(state_handle)
+
+    except (EnvironmentError, ValueError):
+        state = {}
+
+    def save_state():
+        """Write the state of the sample atomically"""
+
+        with open(state_file + '.tmp', 'w') as state_handle:
+            json.dump(state, state_handle, indent=2, sort_keys=True)
+
+        os.rename(state_file + '.tmp', state_file)
+
+    status('Merging the new reads into the sample')
+
+    reference = file_digest(ref_genome_file)
+    regions = reference_regions(ref_genome_file, region_size, verbose)
+
+    previous_reads = None
+
+    if state.get('reference') == reference and os.path.isfile(os.path.join(sample_dir, state['reads'])):
+        previous_reads = os.path.join(sample_dir, state['reads'])
+
+    generation = state.get('generation', 0) + 1
+    merged_reads = os.path.join(sample_dir, 'reads_' + str(generation) + '.bam')
+
+    with open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        if previous_reads:
+            # Merge the sorted reads, which keeps them sorted
+            run_command(['samtools', 'merge', '-f', '-@', str(max(0, thread_count() - 1)), merged_reads,
+                         previous_reads, read_file], stdout=null_handle, stderr=err_handle)
+
+            run_command(['samtools', 'index', merged_reads], stdout=null_handle, stderr=err_handle)
+
+        else:
+            shutil.copyfile(read_file, merged_reads)
+            shutil.copyfile(read_file + '.bai', merged_reads + '.bai')
+
+    # Only the regions with new reads need to be called again, unless the regions themselves changed or an earlier
+    # update did not finish calling them
+    if previous_reads and state.get('regions') == regions:
+        changed = touched_regions(read_file, regions, verbose) | set(state.get('pending', []))
+
+    else:
+        changed = set(range(len(regions)))
+
+    # Switch to the merged reads before calling, recording the regions left to call in case the run is interrupted
+    state = {'reference': reference, 'regions': regions, 'reads': os.path.basename(merged_reads),
+             'generation': generation, 'pending': sorted(changed)}
+    save_state()
+
+    for stale_file in (previous_reads, previous_reads and previous_reads + '.bai'):
+        if stale_file and os.path.isfile(stale_file):
+            os.remove(stale_file)
+
+    status('Calling the variants again in ' + str(len(changed)) + ' of ' + str(len(regions)) + ' regions')
+
+    consensus = call_variants(merged_reads, ref_genome_file, prefix_id, verbose, region_size, sample_dir, changed)
+
+    state['pending'] = []
+    save_state()
+
+    return consensus
+
+
+def read_reference(ref_genome_file):
+    """
+    Load the contigs of a reference genome
+
+    ref_genome_file - file containing the reference genome in FASTA format
+
+    Returns a list of tuples of the name, header line and bases of each contig, the bases as an array of bytes
+    """
+
+    contigs = []
+    header, lines = None, []
+
+    with open(ref_genome_file, 'rb') as ref_handle:
+        for line in itertools.chain(ref_handle, [b'>']):
+            if line.startswith(b'>'):
+                if header is not None:
+                    contigs.append(((header[1:].split() or [b''])[0], header,
+                                    numpy.frombuffer(b''.join(lines), dtype=numpy.uint8)))
+
+                header, lines = line.rstrip(b'\r\n'), []
+
+            else:
+                lines.append(line.strip())
+
+    return [contig for contig in contigs if contig[0]]
+
+
+def pileup_batch(lines, offsets, counts, insertions, min_quality=13):
+    """
+    Add the alignments of a batch of SAM records to the pileup counts. The bases and deletions of every read are
+    gathered first, then counted for the whole batch at once.
+
+    lines - list of SAM records as bytes
+    offsets - dictionary of the position of each contig in the concatenated genome
+    counts - matrix holding the count of each base and of deletions at each position of the concatenated genome
+    insertions - dictionary of the counts of each sequence inserted after a position, keyed by the name of the
+                 contig and the position in it, -1 for the sequences inserted before its first base
+    min_quality - lowest quality of a base counted
+    """
+
+    match_starts, match_bases, match_qualities, deletion_starts, deletion_lengths = [], [], [], [], []
+
+    for line in lines:
+        if line.startswith(b'@'):
+            continue
+
+        fields, flag, position = split_record(line, 11)
+
+        # Leave out the unmapped, secondary, QC failed and duplicate reads as mpileup does
+        if flag & 0x704 or fields[5] == b'*' or fields[2] not in offsets:
+            continue
+
+        start = offsets[fields[2]]
+        position += start - 1
+        sequence, quality = fields[9], fields[10].rstrip(b'\r\n')
+        query = 0
+
+        if quality == b'*':
+            quality = b'~' * len(sequence)
+
+        for length, operation in _CIGAR.findall(fields[5]):
+            length = int(length)
+
+            if operation in b'M=X':
+                match_starts.append(position)
+                match_bases.append(sequence[query:query + length])
+                match_qualities.append(quality[query:query + length])
+                position += length
+                query += length
+
+            elif operation == b'I':
+                # Keep the insertions of each contig apart, so one before the first base of a contig is not taken
+                # for one after the last base of the contig before it
+                inserted = insertions.setdefault((fields[2], position - 1 - start), {})
+                inserted[sequence[query:query + length]] = inserted.get(sequence[query:query + length], 0) + 1
+                query += length
+
+            elif operation == b'D':
+                deletion_starts.append(position)
+                deletion_lengths.append(length)
+                position += length
+
+            elif operation == b'N':
+                position += length
+
+            elif operation == b'S':
+                query += length
+
+    flat_counts = counts.reshape(-1)
+
+    def block_positions(starts, lengths):
+        """Returns every position covered by blocks of the given starts and lengths"""
+
+        lengths = numpy.array(lengths, dtype=numpy.int64)
+
+        return numpy.repeat(numpy.array(starts, dtype=numpy.int64) - numpy.cumsum(lengths) + lengths, lengths) + \
+            numpy.arange(lengths.sum())
+
+    def add_counts(keys):
+        """Increment the counts at the given flat indexes, which may repeat"""
+
+        # Tally dense batches over the whole genome, and sparse ones by sorting the few indexes they touch
+        if len(keys) >= len(flat_counts):
+            flat_counts[:] += numpy.bincount(keys, minlength=len(flat_counts)).astype(counts.dtype)
+
+        else:
+            keys, key_counts = numpy.unique(keys, return_counts=True)
+            flat_counts[keys] += key_counts.astype(counts.dtype)
+
+    if match_starts:
+        keys = block_positions(match_starts, [len(bases) for bases in match_bases])
+        keys *= counts.shape[1]
+        keys += _PILEUP_COLUMNS[numpy.frombuffer(b''.join(match_bases), dtype=numpy.uint8)]
+
+        kept = numpy.frombuffer(b''.join(match_qualities), dtype=numpy.uint8) >= 33 + min_quality
+
+        add_counts(keys if kept.all() else keys[kept])
+
+    if deletion_starts:
+        add_counts(block_positions(deletion_starts, deletion_lengths) * counts.shape[1] + 5)
+
+
+def pileup_sequence(reference, counts, insertions, min_depth=3, min_frequency=0.5):
+    """
+    Call the majority consensus of a contig from its pileup counts. Positions without enough depth or without a
+    majority keep the reference base, as bcftools consensus does for positions without a variant.
+
+    reference - array of the bases of the contig
+    counts - matrix holding the count of each base and of deletions at each position of the contig
+    insertions - dictionary of the counts of each sequence inserted after a position of the contig, -1 for the
+                 sequences inserted before its first base
+    min_depth - lowest number of reads covering a position for it to be called
+    min_frequency - lowest fraction of the reads covering a position which must agree for it to be called
+
+    Returns the consensus sequence as bytes
+    """
+
+    # Unknown bases count towards neither the depth nor the majority
+    calls = counts[:, [0, 1, 2, 3, 5]]
+    depth = calls.sum(axis=1)
+    best = calls.argmax(axis=1)
+
+    called = (depth >= max(min_depth, 1)) & (calls[numpy.arange(len(calls)), best] >= min_frequency * depth)
+    bases = numpy.where(called, numpy.frombuffer(b'ACGT-', dtype=numpy.uint8)[best], reference)
+    kept = bases != ord('-')
+
+    pieces = []
+    previous = 0
+
+    for position in sorted(insertions):
+        inserted = insertions[position]
+
+        # Leave out the sequences inserted past the end of the contig
+        if not -1 <= position < len(depth):
+            continue
+
+        # The sequences inserted before the first base are weighed against the depth of that base, and the most common
+        # sequence alone must reach the minimum frequency, as a base must
+        covered = depth[max(position, 0)]
+
+        if covered < max(min_depth, 1) or max(inserted.values()) < min_frequency * covered:
+            continue
+
+        # Insert the most common sequence after the base at this position
+        pieces.append(bases[previous:position + 1][kept[previous:position + 1]].tobytes())
+        pieces.append(max(sorted(inserted), key=inserted.get).upper())
+        previous = position + 1
+
+    pieces.append(bases[previous:][kept[previous:]].tobytes())
+
+    return b''.join(pieces)
+
+
+def pileup_consensus(read_file, ref_genome_file, prefix_id='', verbose=False, index_prefix=None, min_depth=3,
+                     min_frequency=0.5, min_quality=13, batch_size=100000):
+    """
+    Generate a majority consensus by counting the bases of the aligned reads at each position of the reference,
+    without sorting, indexing or calling the variants. Reads which are not yet aligned are aligned with Bowtie2 and
+    its output is counted as it streams in.
+
+    read_file - file containing the aligned reads in SAM format, or the NGS reads in BAM or FASTQ format, or - to
+                stream BAM reads from stdin
+    ref_genome_file - file containing the reference genome in FASTA format
+    prefix_id - prefix of all temp files
+    verbose - verbosity of subprocess
+    index_prefix - prefix of a prebuilt index of the reference genome, built on demand if not given
+    min_depth - lowest number of reads covering a position for it to be called
+    min_frequency - lowest fraction of the reads covering a position which must agree for it to be called
+    min_quality - lowest quality of a base counted
+    batch_size - number of alignments counted at once
+
+    Returns the consensus FASTA file
+    """
+
+    # Ensure the passed files are in the appropriate formats
+    read_ext = '.bam' if read_file == '-' else file_extension(read_file)
+
+    if read_ext not in ('.sam', '.bam') and not re.match(r'\.((fq)|(fastq))', read_ext):
+        raise ValueError('The read file is not in SAM, BAM or FASTQ format')
+
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(ref_genome_file)[1]):
+        raise ValueError('The reference genome file is not in FASTA format')
+
+    if min_depth < 0 or not 0 <= min_frequency <= 1:
+        raise ValueError('The minimum depth must not be negative and the minimum frequency must be between 0 and 1')
+
+    ofile = scratch_file(prefix_id + 'consensus.fa', large=False)
+
+    status('Generating the consensus from the pileup')
+
+    # Lay the contigs end to end so one matrix holds the counts of the whole genome
+    contigs = read_reference(ref_genome_file)
+    starts = numpy.cumsum([0] + [len(reference) for _, _, reference in contigs])
+    offsets = dict((name, start) for (name, _, _), start in zip(contigs, starts))
+
+    counts = numpy.zeros((starts[-1], 6), dtype=numpy.int32)
+    insertions = {}
+
+    def pileup(sam_handle):
+        """Count every alignment read from a handle"""
+
+        for lines in iter(lambda: list(itertools.islice(sam_handle, batch_size)), []):
+            pileup_batch(lines, offsets, counts, insertions, min_quality)
+
+    if read_ext == '.sam':
+        with open(read_file, 'rb') as sam_handle:
+            pileup(sam_handle)
+
+    else:
+        # Create an index file from the reference genome unless one was provided
+        if index_prefix is None:
+            index_prefix = build_index(ref_genome_file, prefix_id, verbose)
+
+        # Feed BAM input through bam2fq and count the alignments as Bowtie2 writes them
+        commands = [['samtools', 'bam2fq', read_file]] if read_ext == '.bam' else []
+        commands.append(['bowtie2', '-p', str(tuned_threads('bowtie2', read_file)), '-x', index_prefix,
+                         '-U', '-' if read_ext == '.bam' else read_file])
+
+        read_fd, write_fd = os.pipe()
+        failures = []
+
+        with open(os.devnull, 'w') as null_handle, os.fdopen(read_fd, 'rb') as sam_handle:
+            err_handle = sys.stderr if verbose else null_handle
+
+            enter_scope = inherit_scope()
+
+            def align():
+                """Run the alignment, closing the pipe once it ends"""
+
+                # The aligner belongs to the stage, so the task graph can stop it
+                enter_scope()
+
+                try:
+                    with os.fdopen(write_fd, 'wb') as write_handle:
+                        run_pipeline(commands, stdout=write_handle, stderr=err_handle)
+
+                except (EnvironmentError, CalledProcessError) as e:
+                    failures.append(e)
+
+            aligner = threading.Thread(target=align)
+            aligner.start()
+
+            try:
+                pileup(sam_handle)
+
+            except ValueError:
+                sam_handle.close()
+                aligner.join()
+
+                # A malformed record is most likely the last output of an aligner which failed, whose failure is the
+                # one worth reporting, unless it only died of the pipe closed here
+                if failures and getattr(failures[0], 'returncode', None) != -13:
+                    raise failures[0]
+
+                raise
+
+            finally:
+                # Close the pipe so the aligner stops rather than blocks if the count failed
+                sam_handle.close()
+                aligner.join()
+
+        if failures:
+            raise failures[0]
+
+    # Split the insertions between the contigs they were found in
+    contig_insertions = dict((name, {}) for name, _, _ in contigs)
+
+    for (name, position), inserted in insertions.items():
+        contig_insertions[name][position] = inserted
+
+    # Write the consensus of each contig with the line width of bcftools consensus
+    with open(ofile, 'wb') as ofile_handle:
+        for (name, header, reference), start in zip(contigs, starts):
+            sequence = pileup_sequence(reference, counts[start:start + len(reference)], contig_insertions[name],
+                                       min_depth, min_frequency)
+
+            ofile_handle.write(header + b'\n')
+
+            for line_start in range(0, len(sequence), 60):
+                ofile_handle.write(sequence[line_start:line_start + 60] + b'\n')
+
+    return ofile
+
+
+@contextlib.contextmanager
+def output_handle(output_file):
+    """
+    Open the destination of the consensus for binary writing
+
+    output_file - file to write to, or - for stdout
+
+    Yields the open handle
+    """
+
+    if output_file == '-':
+        # Leave stdout open once the consensus is written
+        handle = getattr(sys.stdout, 'buffer', sys.stdout)
+        yield handle
+        handle.flush()
+
+    else:
+        with open(output_file, 'wb') as handle:
+            yield handle
+
+
+def copy_file(source_file, destination_handle):
+    """
+    Copy a file into an open handle, letting the kernel move the data with copy_file_range or sendfile where the
+    platform and file types allow it
+
+    source_file - the file to copy
+    destination_handle - handle opened for binary writing
+    """
+
+    # Anything buffered must reach the file descriptor before the kernel appends to it
+    destination_handle.flush()
+
+    with open(source_file, 'rb') as source_handle:
+        size = os.fstat(source_handle.fileno()).st_size
+        offset = 0
+
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+
+            try:
+                while offset < size:
+                    if method == 'copy_file_range':
+                        sent = os.copy_file_range(source_handle.fileno(), destination_handle.fileno(), size - offset,
+                                                  offset)
+
+                    else:
+                        sent = os.sendfile(destination_handle.fileno(), source_handle.fileno(), offset, size - offset)
+
+                    if sent == 0:
+                        break
+
+                    offset += sent
+
+                return
+
+            except (EnvironmentError, io.UnsupportedOperation):
+                # Not supported between these file types, so try the next method from where this one stopped
+                continue
+
+        source_handle.seek(offset)
+        shutil.copyfileobj(source_handle, destination_handle)
+
+
+# Translation table converting lower case ASCII letters to upper case
+_UPPERCASE = bytes(bytearray(code - 32 if 97 <= code <= 122 else code for code in range(256)))
+
+
+def format_consensus(consensus_file, prefix_id='', output_file=None, chunk_size=1 << 20):
+    """
+    Edit the consenses file to ensure it is formatted correctly. The file is processed in large chunks, with the
+    sequence upper-cased through a translation table and the headers copied as they are.
+
+    consensus_file - Consensus file to format
+    prefix_id - prefix of all temp files
+    output_file - file to write the formatted consensus to, - for stdout, or None for a temp file
+    chunk_size - number of bytes processed at a time
+
+    Returns the formatted consensus file
+    """
+
+    # Ensure the files are in the appropriate format
+    if not re.match(r'\.((fa)|(fna)|(fasta))', os.path.splitext(consensus_file)[1]):
+        raise ValueError('The consensus file is not in FASTA format')
+
+    formatted_file = scratch_file(prefix_id + 'formatted_consensus.fa', large=False)
+
+    if output_file is not None:
+        formatted_file = output_file
+
+    status('Formatting the consensus')
+
+    # Format the consensus reads
+    with open(consensus_file, 'rb') as consensus_handle, output_handle(formatted_file) as formatted_handle:
+        # Headers and lines may span the boundary between chunks, so carry the parser's state across them
+        in_header = False
+        line_start = True
+
+        for chunk in iter(lambda: consensus_handle.read(chunk_size), b''):
+            position = 0
+
+            while position < len(chunk):
+                if in_header:
+                    end = chunk.find(b'\n', position) + 1 or len(chunk)
+                    formatted_handle.write(chunk[position:end])
+
+                    in_header = chunk[end - 1:end] != b'\n'
+
+                elif line_start and chunk[position:position + 1] == b'>':
+                    in_header = True
+                    continue
+
+                else:
+                    # Translate everything up to the start of the next header at once
+                    end = chunk.find(b'\n>', position) + 1 or len(chunk)
+                    formatted_handle.write(chunk[position:end].translate(_UPPERCASE))
+
+                line_start = chunk[end - 1:end] == b'\n'
+                position = end
+
+    return formatted_file
+
+
+def probe_output(command, stdin=None):
+    """
+    Run a utility to see what it prints, stopping it if it does not finish in time
+
+    command - argument list of the process
+    stdin - handle the utility reads as its stdin, or None to inherit stdin
+
+    Returns the stdout and stderr of the utility as text, or None if it had to be stopped
+    """
+
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    stopped = threading.Event()
+
+    def stop():
+        """Stop the utility, which may have finished in the meantime"""
+
+        stopped.set()
+
+        try:
+            process.kill()
+
+        except EnvironmentError:
+            pass
+
+    timer = threading.Timer(_PROBE_TIMEOUT, stop)
+    timer.start()
+
+    try:
+        output = process.communicate()[0]
+
+    finally:
+        timer.cancel()
+
+    return None if stopped.is_set() else output.decode('utf-8', 'replace')
+
+
+def tool_version(tool):
+    """
+    Retrieve the version of an external utility
+
+    tool - name of the utility
+
+    Returns the first line the utility prints when asked for its version, or None if it cannot be run or does not
+    respond
+    """
+
+    if tool not in _tool_versions:
+        try:
+            output = probe_output([tool, '--version'])
+
+        except EnvironmentError:
+            # The stage will report the missing utility itself
+            output = None
+
+        lines = [line.strip() for line in output.splitlines()] if output is not None else []
+        _tool_versions[tool] = next((line for line in lines if line), '') if output is not None else None
+
+    return _tool_versions[tool]
+
+
+def required_tools(args):
+    """
+    Determine the utilities a run will use
+
+    args - the user's arguments
+
+    Returns a dictionary of the subcommands used of each utility
+    """
+
+    tools = {'samtools': ['bam2fq', 'faidx'], 'bowtie2': [], 'bowtie2-build': []}
+
+    if not args['disable_ec']:
+        tools['karect'] = []
+
+    if args['engine'] != 'pileup':
+        tools['samtools'] += ['view', 'sort', 'index', 'mpileup'] + \
+            (['merge'] if args['update'] or args['shards'] else [])
+        tools['bcftools'] = ['call', 'concat']
+
+    return tools
+
+
+def find_tool(tool):
+    """
+    Find a utility in the PATH
+
+    tool - name of the utility
+
+    Returns the path of the utility, or None if it is not installed
+    """
+
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, tool)
+
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+
+    return None
+
+
+def probe_subcommand(path, subcommand, options):
+    """
+    Check a subcommand of a utility from the usage it prints when run without arguments
+
+    path - path of the utility
+    subcommand - name of the subcommand
+    options - options the subcommand must accept
+
+    Returns a list of the problems found, empty if the subcommand is usable
+    """
+
+    # samtools sort and view read stdin unless it is a terminal, so only a terminal gets them to print their usage.
+    # The terminal is sent an end of input at once, so a subcommand reading it finds no input instead of waiting.
+    controller, terminal = pty.openpty()
+
+    try:
+        os.write(controller, b'\x04')
+
+        try:
+            usage = probe_output([path, subcommand], stdin=terminal)
+
+        except EnvironmentError:
+            return ['cannot be run']
+
+    finally:
+        os.close(terminal)
+        os.close(controller)
+
+    # A utility waiting on the terminal or stuck otherwise would hang every run
+    if usage is None:
+        return ['does not respond']
+
+    if re.search(r'unrecognized command', usage, re.IGNORECASE):
+        return ['has no ' + subcommand + ' command']
+
+    # Only a usage message lists the options, so any other output is given the benefit of the doubt
+    if 'usage' not in usage.lower():
+        return []
+
+    return [subcommand + ' does not accept ' + option for option in options
+            if not re.search(r'(^|[\s,\[])' + re.escape(option) + r'(?![\w-])', usage, re.MULTILINE)]
+
+
+def preflight(args, cache_file=None):
+    """
+    Check that every utility a run will use is installed, recent enough and has the subcommands and options the run
+    uses, so a broken toolchain fails the run before any compute is spent on it. The findings are cached by the path
+    and modification time of each utility so later runs only probe the utilities which changed.
+
+    args - the user's arguments
+    cache_file - JSON file caching the findings, defaults to toolchain.json in the user's cache directory
+
+    Raises a ValueError listing every problem found
+    """
+
+    if cache_file is None:
+        cache_file = user_cache_file('toolchain.json')
+
+    try:
+        with open(cache_file) as cache_handle:
+            cache = json.load(cache_handle)
+
+    except (EnvironmentError, ValueError):
+        cache = {}
+
+    problems = []
+
+    for tool, subcommands in sorted(required_tools(args).items()):
+        path = find_tool(tool)
+
+        if path is None:
+            problems.append('The ' + tool + ' utility is not installed in your PATH')
+            continue
+
+        minimum, options = _TOOLCHAIN[tool]
+        mtime = os.path.getmtime(path)
+        entry = cache.get(path)
+
+        if entry is None or entry['mtime'] != mtime:
+            _tool_versions.pop(tool, None)
+            entry = cache[path] = {'mtime': mtime, 'version': tool_version(tool), 'subcommands': {}}
+
+        # Reuse the probed version for the stage manifests
+        _tool_versions[tool] = entry['version']
+
+        # Probe a utility which did not respond again on the next run rather than caching what may be a passing stall
+        if entry['version'] is None:
+            problems.append('The ' + tool + ' utility cannot be run or does not respond')
+            del cache[path]
+            continue
+
+        # The first number with a dot is the version, skipping those that are part of the path of the utility
+        version = re.search(r'(?<![\w.-])(\d+)\.(\d+)', entry['version'] or '')
+
+        if minimum is not None and version is not None and tuple(int(part) for part in version.groups()) < minimum:
+            problems.append('The ' + tool + ' utility is version ' + version.group(0) + ' but at least ' +
+                            '.'.join(str(part) for part in minimum) + ' is required')
+
+        for subcommand in subcommands:
+            found = entry['subcommands'].get(subcommand)
+
+            if found is None:
+                found = probe_subcommand(path, subcommand, options[subcommand])
+
+                if found != ['does not respond']:
+                    entry['subcommands'][subcommand] = found
+
+            problems += ['The ' + tool + ' utility ' + problem for problem in found]
+
+    # A cache which cannot be written only costs the next run its probes
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+
+        with open(cache_file + '.tmp', 'w') as cache_handle:
+            json.dump(cache, cache_handle, indent=2, sort_keys=True)
+
+        os.rename(cache_file + '.tmp', cache_file)
+
+    except EnvironmentError:
+        pass
+
+    if problems:
+        raise ValueError('The utilities cannot run the pipeline:\n' + '\n'.join(problems))
+
+
+def file_signature(path, previous=None):
+    """
+    Describe the contents of a file. The digest is only recomputed if the size or modification time of the file
+    differs from the previous signature.
+
+    path - the file to describe
+    previous - a signature previously computed for the same path
+
+    Returns a dictionary containing the size, modification time and SHA-256 digest of the file
+    """
+
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    if previous and previous['size'] == signature['size'] and previous['mtime'] == signature['mtime']:
+        signature['sha256'] = previous['sha256']
+
+    else:
+        signature['sha256'] = file_digest(path)
+
+    return signature
+
+
+def count_reads(read_file):
+    """
+    Count the reads in a FASTQ file
+
+    read_file - file containing the reads in FASTQ format, optionally gzip compressed
+
+    Returns the number of reads
+    """
+
+    lines = 0
+
+    with (gzip.open if read_file.endswith('.gz') else open)(read_file, 'rb') as read_handle:
+        for block in iter(lambda: read_handle.read(1 << 20), b''):
+            lines += block.count(b'\n')
+
+    return lines // 4
+
+
+def describe_files(paths):
+    """
+    Describe the files read or written by a stage for the profile report
+
+    paths - the files to describe
+
+    Returns a list of dictionaries holding the path, size and, for FASTQ files, the number of reads of each file
+    """
+
+    descriptions = []
+
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+
+        description = {'path': path, 'size': os.path.getsize(path)}
+
+        if re.match(r'\.((fq)|(fastq))', file_extension(path)):
+            description['reads'] = count_reads(path)
+
+        descriptions.append(description)
+
+    return descriptions
+
+
+def start_profiling():
+    """
+    Start recording the resource usage of every stage run by this process
+
+    Returns the list the stage records are appended to
+    """
+
+    _profile['stages'] = []
+
+    return _profile['stages']
+
+
+def write_profile(report_file, report):
+    """
+    Write a profile report
+
+    report_file - file to write the report to in JSON format
+    report - dictionary holding the report
+    """
+
+    with open(report_file, 'w') as report_handle:
+        json.dump(report, report_handle, indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def profile_stage(stage, inputs, tools, interval=0.1):
+    """
+    Record the wall time, CPU time, peak RSS and I/O of a stage and the process trees it starts while profiling is
+    enabled. Only the processes started through start_process by the stage and the threads it inherits its scope to
+    are measured, so stages running at the same time are not charged for each other's utilities. Memory, I/O and CPU
+    time are sampled with psutil while the stage runs. The CPU time of a stage which ran alone is instead taken from
+    the accounting of the terminated child processes, which also counts processes too short lived to be sampled.
+
+    stage - name of the stage
+    inputs - files read by the stage
+    tools - external utilities used by the stage
+    interval - time in seconds between samples of the process tree
+
+    Yields the record of the stage, or None if profiling is disabled. The stage should store its result in the
+    record's output field so the output can be described.
+    """
+
+    if _profile['stages'] is None:
+        yield None
+        return
+
+    record = {'stage': stage, 'inputs': describe_files(inputs),
+              'tools': dict((tool, tool_version(tool)) for tool in tools)}
+
+    # Latest CPU time and I/O counters of every process seen so far, kept after they exit
+    cpu_times = {}
+    io_counters = {}
+    peak_rss = [0]
+    finished = threading.Event()
+    profiled = []
+
+    def sample():
+        """Sample the memory, CPU time and I/O of the stage's process trees until the stage finishes"""
+
+        while not finished.wait(interval):
+            rss = 0
+
+            # A process reaped by the stage is gone, and its process ID may already belong to another one
+            for process in [process for process in profiled if process.returncode is None]:
+                try:
+                    parent = psutil.Process(process.pid)
+                    tree = [parent] + parent.children(recursive=True)
+
+                except psutil.Error:
+                    continue
+
+                for child in tree:
+                    try:
+                        rss += child.memory_info().rss
+
+                        times = child.cpu_times()
+                        cpu_times[child.pid] = times.user + times.system
+
+                        counters = child.io_counters()
+                        io_counters[child.pid] = (counters.read_bytes, counters.write_bytes)
+
+                    except (psutil.Error, AttributeError):
+                        # The process exited or the platform does not report I/O
+                        continue
+
+            peak_rss[0] = max(peak_rss[0], rss)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+
+    # Note which stages overlap, as the accounting of the terminated child processes covers those of them all
+    with _profile['lock']:
+        record['shared'] = bool(_profile['running'])
+
+        for other in _profile['running']:
+            other['shared'] = True
+
+        _profile['running'].append(record)
+
+    previous = getattr(_scope, 'profiled', None)
+    _scope.profiled = profiled
+
+    start_times = os.times()
+    start_wall = time.time()
+    sampler.start()
+
+    try:
+        yield record
+
+    finally:
+        finished.set()
+        sampler.join()
+
+        end_times = os.times()
+        _scope.profiled = previous
+
+        with _profile['lock']:
+            _profile['running'] = [other for other in _profile['running'] if other is not record]
+
+        record['wall_time'] = time.time() - start_wall
+        record['cpu_time'] = sum(cpu_times.values()) if record['shared'] else \
+            sum(end_times[2:4]) - sum(start_times[2:4])
+        record['peak_rss'] = peak_rss[0]
+        record['read_bytes'] = sum(read for read, _ in io_counters.values())
+        record['write_bytes'] = sum(write for _, write in io_counters.values())
+        record['outputs'] = describe_files([record.pop('output')] if 'output' in record else [])
+
+        _profile['stages'].append(record)
+
+
+@contextlib.contextmanager
+def monitor_stage(stage, inputs):
+    """
+    Let the metrics exporter watch a stage while it runs, if metrics are being exported
+
+    stage - name of the stage
+    inputs - files read by the stage, starting with the reads
+    """
+
+    with _metrics['lock']:
+        stages = _metrics['stages']
+
+        if stages is not None:
+            stages[stage] = {'inputs': [os.path.realpath(path) for path in inputs if os.path.isfile(path)],
+                             'start': time.time(), 'read': {}, 'outputs': set(), 'previous': None}
+
+    try:
+        yield
+
+    finally:
+        if stages is not None:
+            with _metrics['lock']:
+                stages.pop(stage, None)
+
+
+def record_size(path, sample_size=1 << 20):
+    """
+    Estimate the mean size of the records of a FASTQ or SAM file from its start
+
+    path - the FASTQ or SAM file
+    sample_size - number of bytes read from the start of the file
+
+    Returns the mean size of a record in bytes, or None if it is not known
+    """
+
+    extension = file_extension(path)
+
+    if extension not in ('.fq', '.fastq', '.sam'):
+        return None
+
+    try:
+        with open(path, 'rb') as read_handle:
+            lines = read_handle.read(sample_size).split(b'\n')[:-1]
+
+    except EnvironmentError:
+        return None
+
+    if extension == '.sam':
+        records = [line for line in lines if not line.startswith(b'@')]
+
+    else:
+        records = [b'\n'.join(lines[start:start + 4]) for start in range(0, len(lines) - len(lines) % 4, 4)]
+
+    return sum(len(record) + 1 for record in records) / float(len(records)) if records else None
+
+
+def sample_stages(record_sizes):
+    """
+    Measure the throughput of each watched stage from the files its processes hold open, so the stages themselves
+    do no counting. The read position of a process in an input file shows how far the stage has read, and the files
+    the same process writes are the outputs of the stage.
+
+    record_sizes - dictionary caching the mean record size of each text file
+
+    Returns a list of the name and a dictionary of the metrics of each running stage
+    """
+
+    open_files = []
+    parent = psutil.Process()
+
+    for process in [parent] + parent.children(recursive=True):
+        try:
+            open_files += [(process.pid, entry.path, getattr(entry, 'position', 0), getattr(entry, 'mode', 'r'))
+                           for entry in process.open_files()]
+
+        except psutil.Error:
+            continue
+
+    now = time.time()
+    samples = []
+
+    # The stages come and go from the threads running them, so sample those running at this moment
+    with _metrics['lock']:
+        watched = sorted(_metrics['stages'].items())
+
+    for stage, watch in watched:
+        readers = set(pid for pid, path, _, _ in open_files if path in watch['inputs'])
+
+        for pid, path, position, mode in open_files:
+            if path in watch['inputs']:
+                watch['read'][path] = max(watch['read'].get(path, 0), position)
+
+            elif pid in readers and mode != 'r':
+                watch['outputs'].add(path)
+
+        outputs = [path for path in watch['outputs'] if os.path.isfile(path)]
+        reads = watch['inputs'][0] if watch['inputs'] else None
+
+        metrics = {'elapsed_seconds': now - watch['start'],
+                   'input_read_bytes': sum(watch['read'].values()),
+                   'output_bytes': sum(os.path.getsize(path) for path in outputs)}
+
+        # Count the records of the text output, or of the text input for stages whose output is binary
+        for path, size in [(path, os.path.getsize(path)) for path in outputs] + [(reads, watch['read'].get(reads))]:
+            if path is not None and size:
+                record_sizes[path] = record_sizes.get(path) or record_size(path)
+
+                if record_sizes[path]:
+                    metrics['records'] = int(size / record_sizes[path])
+                    break
+
+        if watch['previous'] is not None:
+            elapsed = now - watch['previous'][0]
+            metrics['bytes_per_second'] = (metrics['input_read_bytes'] - watch['previous'][1]) / elapsed
+
+            if 'records' in metrics and watch['previous'][2] is not None:
+                metrics['records_per_second'] = (metrics['records'] - watch['previous'][2]) / elapsed
+
+        watch['previous'] = (now, metrics['input_read_bytes'], metrics.get('records'))
+
+        if reads is not None:
+            metrics['input_size_bytes'] = os.path.getsize(reads)
+            metrics['progress_ratio'] = min(1.0, watch['read'].get(reads, 0) / float(metrics['input_size_bytes'] or 1))
+
+            if metrics.get('bytes_per_second'):
+                metrics['eta_seconds'] = max(0, metrics['input_size_bytes'] - watch['read'].get(reads, 0)) / \
+                    metrics['bytes_per_second']
+
+        samples.append((stage, metrics))
+
+    return samples
+
+
+def write_metrics(metrics_file, samples):
+    """
+    Write the metrics of the running stages in the OpenMetrics text format, replacing the file atomically so a
+    collector never reads it half written
+
+    metrics_file - the metrics file, such as one in the directory of node_exporter's textfile collector
+    samples - the name and metrics of each running stage, as returned by sample_stages()
+    """
+
+    lines = []
+
+    for name, description in _STAGE_METRICS:
+        lines += ['# HELP grapple_stage_' + name + ' ' + description, '# TYPE grapple_stage_' + name + ' gauge']
+        lines += ['grapple_stage_' + name + '{stage="' + stage + '"} ' +
+                  ('%.3f' % metrics[name]).rstrip('0').rstrip('.') for stage, metrics in samples if name in metrics]
+
+    with open(metrics_file + '.tmp', 'w') as metrics_handle:
+        metrics_handle.write('\n'.join(lines + ['# EOF']) + '\n')
+
+    os.rename(metrics_file + '.tmp', metrics_file)
+
+
+@contextlib.contextmanager
+def export_metrics(metrics_file=None, progress=False, interval=10.0):
+    """
+    Periodically publish the throughput of the running stages while the context runs
+
+    metrics_file - file to write the metrics to in the OpenMetrics text format, or None
+    progress - whether the throughput is also reported in stderr
+    interval - time in seconds between updates
+    """
+
+    if metrics_file is None and not progress:
+        yield
+        return
+
+    _metrics['stages'] = {}
+    record_sizes = {}
+    finished = threading.Event()
+
+    def export():
+        """Publish the metrics until the context ends"""
+
+        while not finished.wait(interval):
+            # A failed update is reported rather than ending the exporter, so the next one can still be published
+            try:
+                samples = sample_stages(record_sizes)
+
+                if metrics_file is not None:
+                    write_metrics(metrics_file, samples)
+
+            except Exception as e:
+                status('The metrics could not be published: ' + str(e))
+                continue
+
+            if progress:
+                for stage, metrics in samples:
+                    message = 'The ' + stage + ' stage has read ' + \
+                        str(int(100 * metrics.get('progress_ratio', 0))) + '% of the reads'
+
+                    if 'records_per_second' in metrics:
+                        message += ', ' + str(int(metrics['records_per_second'])) + ' records/s'
+
+                    if 'bytes_per_second' in metrics:
+                        message += ', ' + '%.1f' % (metrics['bytes_per_second'] / 1000000.0) + ' MB/s'
+
+                    if 'eta_seconds' in metrics:
+                        message += ', ' + str(int(metrics['eta_seconds'])) + ' s left'
+
+                    status(message)
+
+    exporter = threading.Thread(target=export)
+    exporter.daemon = True
+    exporter.start()
+
+    try:
+        yield
+
+    finally:
+        finished.set()
+        exporter.join()
+
+        _metrics['stages'] = None
+
+        # Leave no running stages behind for the collector
+        if metrics_file is not None:
+            write_metrics(metrics_file, [])
+
+
+def run_stage(run_dir, stage, inputs, parameters, tools, function, *args):
+    """
+    Run a stage of the pipeline, recording a manifest of the run in the run directory. If a manifest from an earlier
+    run shows the same inputs, parameters and tool versions and its outputs are intact, the stage is skipped. The
+    resource usage of the stage is recorded if profiling is enabled.
+
+    run_dir - directory holding the stage manifests, or None to always run the stage
+    stage - name of the stage
+    inputs - files read by the stage
+    parameters - dictionary of the parameters affecting the output of the stage
+    tools - external utilities used by the stage
+    function - function implementing the stage
+    args - arguments passed to the function
+
+    Returns the value returned by the function, or recorded from the earlier run
+    """
+
+    if run_dir is not None:
+        manifest_file = os.path.join(run_dir, stage + '.json')
+
+        try:
+            with open(manifest_file) as manifest_handle:
+                previous = json.load(manifest_handle)
+
+        except (EnvironmentError, ValueError):
+            previous = {'inputs': {}, 'outputs': {}}
+
+        manifest = {
+            'stage': stage,
+            'inputs': dict((path, file_signature(path, previous['inputs'].get(path))) for path in inputs),
+            'parameters': parameters,
+            'tools': dict((tool, tool_version(tool)) for tool in tools)
+        }
+
+        # Compare the outputs the earlier run recorded against what is currently on disk
+        intact = bool(previous['outputs'])
+
+        for path, signature in previous['outputs'].items():
+            if not os.path.isfile(path) or file_signature(path, signature)['sha256'] != signature['sha256']:
+                intact = False
+                break
+
+        if intact and all(previous.get(key) == manifest[key] for key in ('inputs', 'parameters', 'tools')):
+            status('Skipping the ' + stage + ' stage since its outputs are up to date')
+
+            if _profile['stages'] is not None:
+                _profile['stages'].append({'stage': stage, 'skipped': True})
+
+            return previous['result']
+
+    with profile_stage(stage, inputs, tools) as record, monitor_stage(stage, inputs):
+        result = function(*args)
+
+        if record is not None:
+            record['output'] = result
+
+    # Index files are written alongside their file, and an index prefix names only its companions, so both are part
+    # of the output as well
+    outputs = []
+
+    if isinstance(result, str) and result != '-':
+        directory = os.path.dirname(result) or '.'
+        companions = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                      if name.startswith(os.path.basename(result) + '.')] if os.path.isdir(directory) else []
+        outputs = [path for path in [result] + companions if os.path.isfile(path)]
+
+    # Report what the stage wrote so the intermediate encodings can be compared on this machine
+    written_bytes = sum(os.path.getsize(path) for path in outputs)
+
+    if outputs:
+        status('The ' + stage + ' stage wrote ' + str(written_bytes) + ' bytes')
+
+    if record is not None:
+        record['written_bytes'] = written_bytes
+
+    if run_dir is not None:
+        manifest['outputs'] = dict((path, file_signature(path)) for path in outputs)
+        manifest['result'] = result
+
+        # Write the manifest atomically so an interrupted run never leaves a manifest that looks valid
+        with open(manifest_file + '.tmp', 'w') as manifest_handle:
+            json.dump(manifest, manifest_handle, indent=2, sort_keys=True)
+
+        os.rename(manifest_file + '.tmp', manifest_file)
+
+    return result
+
+
+def kill_processes(processes):
+    """
+    Kill the processes a task graph started which are still running, along with the processes they started, leaving
+    the other children of this process alone
+
+    processes - set of the processes started by the tasks of the graph
+    """
+
+    for process in list(processes):
+        # A finished process may already have been reaped, and its process ID reused
+        if process.poll() is not None:
+            continue
+
+        try:
+            tree = psutil.Process(process.pid)
+            members = tree.children(recursive=True) + [tree]
+
+        except psutil.Error:
+            continue
+
+        for member in members:
+            try:
+                member.kill()
+
+            except psutil.Error:
+                pass
+
+
+def run_graph(tasks, threads=None):
+    """
+    Run a graph of tasks, starting each task in its own thread once the tasks it depends on have finished and enough
+    of the thread budget is free. Independent tasks therefore overlap, while together never using more threads than
+    the budget. If a task fails, or the run is interrupted, the processes started by the tasks still running are
+    killed.
+
+    tasks - list of (name, dependencies, threads, function) tuples, where threads is the number of threads the task
+        needs, 0 for a task which barely uses any, or None for every free thread, and the function is called with
+        the results of its dependencies in order
+    threads - size of the thread budget, defaults to the threads the utilities may use
+
+    Returns a dictionary of the result of each task
+    """
+
+    budget = threads or thread_count()
+    waiting = list(tasks)
+    running = {}
+    results = {}
+    failures = []
+    processes = set()
+    condition = threading.Condition()
+    enter_scope = inherit_scope()
+
+    def run_task(name, dependencies, granted, function):
+        # The task runs in the workspace and budget of the job. The utilities it runs size themselves to the threads
+        # granted to it, and are registered with the graph so only they are killed on a failure.
+        enter_scope()
+        _scope.threads = granted or 1
+        _scope.processes = processes
+
+        try:
+            result = function(*[results[dependency] for dependency in dependencies])
+
+        except BaseException as e:
+            with condition:
+                failures.append(e)
+                del running[name]
+                condition.notify()
+
+        else:
+            with condition:
+                results[name] = result
+                del running[name]
+                condition.notify()
+
+    workers = []
+
+    try:
+        with condition:
+            while waiting or running:
+                if failures:
+                    # Stop starting tasks and take down the processes of those still running so they end quickly
+                    waiting = []
+                    kill_processes(processes)
+
+                for task in list(waiting):
+                    name, dependencies, needed, function = task
+
+                    if not all(dependency in results for dependency in dependencies):
+                        continue
+
+                    # A task never needs more than the whole budget, so each task fits once enough others end
+                    free = budget - sum(running.values())
+                    granted = free if needed is None else min(needed, budget)
+
+                    if needed == 0 or 0 < granted <= free:
+                        running[name] = granted
+                        waiting.remove(task)
+
+                        worker = threading.Thread(target=run_task, args=(name, dependencies, granted, function))
+                        worker.daemon = True
+                        worker.start()
+                        workers.append(worker)
+
+                if waiting and not running and not failures:
+                    raise ValueError('The tasks ' + ', '.join(task[0] for task in waiting) +
+                                     ' depend on tasks which are not in the graph')
+
+                if running:
+                    # Wake up regularly so an interrupt is noticed while the tasks run
+                    condition.wait(0.1)
+
+    except BaseException:
+        kill_processes(processes)
+
+        for worker in workers:
+            worker.join()
+
+        raise
+
+    if failures:
+        raise failures[0]
+
+    return results
+
+
+def failure_message(e):
+    """
+    Describe the failure of an external utility in terms of the pipeline
+
+    e - the CalledProcessError raised for the failed process
+
+    Returns the error message for the stage the process belongs to
+    """
+
+    if e.cmd[0] == 'samtools':
+        if e.cmd[1] == 'bam2fq':
+            return 'The reads could not be converted to FASTQ format'
+
+        elif e.cmd[1] == 'view':
+            return 'The reads could not be converted from SAM format to BAM format'
+
+        elif e.cmd[1] == 'sort':
+            return 'The read file could not be sorted'
+
+        elif e.cmd[1] == 'index':
+            return 'The sorted reads could not be indexed'
+
+        elif e.cmd[1] == 'mpileup':
+            return 'The reads could not be processed by mpileup before being called'
+
+        elif e.cmd[1] == 'faidx':
+            return 'The reference genome could not be indexed'
+
+    elif e.cmd[0] == 'karect':
+        return 'The reads could not be corrected'
+
+    elif e.cmd[0] == 'bowtie2-build':
+        return 'An index could not be constructed from the reference genome provided'
+
+    elif e.cmd[0] == 'bowtie2':
+        return 'The reads could not be aligned to the reference genome'
+
+    elif e.cmd[0] == 'bcftools':
+        if e.cmd[1] == 'call':
+            return 'The variants could not be called'
+
+        elif e.cmd[1] == 'concat':
+            return 'The variants of each region could not be concatenated'
+
+    return 'The command "' + ' '.join(e.cmd) + '" failed'
+
+
+def assemble(read_file, ref_genome_file, args, prefix_id='', index_prefix=None, run_dir=None, output_file=None):
+    """
+    Run the reads through every stage of the pipeline. The stages form a graph in which the reference is indexed
+    while the reads are converted and corrected.
+
+    read_file - file containing the NGS reads in BAM, CRAM, SAM or FASTQ format, optionally gzip compressed, or - for
+                BAM reads on stdin
+    ref_genome_file - file containing the reference genome in FASTA format
+    args - the user's arguments
+    prefix_id - prefix of all temp files
+    index_prefix - prefix of a prebuilt index of the reference genome, built on demand if not given
+    run_dir - directory in which the stages record their manifests so an interrupted run can be resumed
+    output_file - file to write the consensus to, - for stdout, or None to leave it in a temp file
+
+    Returns the formatted consensus file
+    """
+
+    # Route the reads by their contents, so FASTQ reads skip the conversion
+    read_file, file_format = typed_reads(read_file, prefix_id)
+
+    # Each task is called with the results of the tasks it depends on. The reads are passed along the chain of
+    # stages, starting from the read file itself.
+    tasks = [('read_file', [], 0, lambda: read_file)]
+    reads = 'read_file'
+
+    # Index the reference for the aligner and the variant caller alongside the stages preparing the reads
+    if index_prefix is None:
+        tasks.append(('build_index', [], 1,
+                      lambda: run_stage(run_dir, 'build_index', [ref_genome_file], {}, ['bowtie2-build'], build_index,
+                                        ref_genome_file, prefix_id, args['verbose'])))
+
+    else:
+        tasks.append(('build_index', [], 0, lambda: index_prefix))
+
+    if args['engine'] != 'pileup':
+        tasks.append(('index_reference', [], 1, lambda: index_reference(ref_genome_file, args['verbose'])))
+
+    # FASTQ reads are used as they are, and the streamed alignment reads BAM files itself
+    if not (file_format in ('fastq', 'fastq.gz') or
+            file_format == 'bam' and args['stream'] and args['disable_ec'] and not args['trim'] and
+            not args['max_depth'] and not args['shards']):
+        # Convert the input file containing the reads to FASTQ format, decoding CRAM against the reference
+        cram_ref = ref_genome_file if file_format == 'cram' else None
+        tasks.append(('bam_to_fq', [reads], 1,
+                      lambda source: run_stage(run_dir, 'bam_to_fq', [source] + ([cram_ref] if cram_ref else []),
+                                               {'encoding': args['intermediates']}, ['samtools'], bam_to_fq, source,
+                                               prefix_id, args['verbose'], args['intermediates'], cram_ref)))
+        reads = 'bam_to_fq'
+
+    # Trim and filter the reads before the correction and alignment spend time on them
+    if args['trim']:
+        trimming = [args['trim_window'], args['trim_quality'], args['min_length'], args['max_n']]
+        tasks.append(('trim_reads', [reads], 1,
+                      lambda source: run_stage(run_dir, 'trim_reads', [source],
+                                               {'encoding': args['intermediates'], 'trimming': trimming}, [],
+                                               trim_reads, source, prefix_id, args['verbose'], args['intermediates'],
+                                               *trimming)))
+        reads = 'trim_reads'
+
+    # Cap the depth of ultra deep samples, whose extra reads would only slow down the correction and alignment
+    if args['max_depth']:
+        tasks.append(('downsample_reads', [reads], 1,
+                      lambda source: run_stage(run_dir, 'downsample_reads', [source, ref_genome_file],
+                                               {'encoding': args['intermediates'], 'max_depth': args['max_depth'],
+                                                'seed': args['seed']}, [], downsample_reads, source, ref_genome_file,
+                                               args['max_depth'], prefix_id, args['intermediates'], args['seed'])))
+        reads = 'downsample_reads'
+
+    # Correct the reads if error correction has not been disabled
+    if not args['disable_ec']:
+        # Transform the command line arguments into values Karect can use
+        ploidy = 'haploid' if args['ploidy'] == 'n' else 'diploid'
+
+        if args['mode'] == 'equal':
+            mode = 'edit'
+
+        elif args['mode'] == 'indel':
+            mode = 'insdel'
+
+        else:
+            mode = 'hamming'
+
+        # Run Karect
+        tasks.append(('read_correction', [reads], None,
+                      lambda source: run_stage(run_dir, 'read_correction', [source],
+                                               {'ploidy': ploidy, 'mode': mode, 'chunked': args['chunked_ec'],
+                                                'cluster': args['cluster_ec']}, ['karect'], read_correction, source,
+                                               ploidy, mode, args['verbose'], args['chunked_ec'], args['cluster_ec'])))
+        reads = 'read_correction'
+
+    if not args['stream'] and not args['shards']:
+        # Align the reads
+        tasks.append(('read_alignment', [reads, 'build_index'], None,
+                      lambda source, index: run_stage(run_dir, 'read_alignment', [source, ref_genome_file], {},
+                                                      ['bowtie2'], read_alignment, source, ref_genome_file, prefix_id,
+                                                      args['verbose'], index)))
+        reads = 'read_alignment'
+
+    if args['engine'] == 'pileup':
+        # Count the alignments straight into a consensus. When streaming, the reads are aligned as they are counted.
+        tasks.append(('consensus', [reads, 'build_index'], None,
+                      lambda source, index: run_stage(run_dir, 'pileup_consensus', [source, ref_genome_file],
+                                                      {'min_depth': args['min_depth'],
+                                                       'min_frequency': args['min_frequency']},
+                                                      ['samtools', 'bowtie2'] if args['stream'] else [],
+                                                      pileup_consensus, source, ref_genome_file, prefix_id,
+                                                      args['verbose'], index, args['min_depth'],
+                                                      args['min_frequency'])))
+
+    else:
+        if args['stream']:
+            # Align, sort and index the reads without writing the intermediates to disk
+            tasks.append(('sorted_reads', [reads, 'build_index'], None,
+                          lambda source, index: run_stage(run_dir, 'stream_alignment', [source, ref_genome_file],
+                                                          {'encoding': args['intermediates']},
+                                                          ['samtools', 'bowtie2'], stream_alignment, source,
+                                                          ref_genome_file, prefix_id, args['verbose'], index,
+                                                          args['intermediates'])))
+
+        elif args['shards']:
+            # Align the reads in shards, sorting each shard as it is aligned
+            tasks.append(('sorted_reads', [reads, 'build_index'], None,
+                          lambda source, index: run_stage(run_dir, 'shard_alignment', [source, ref_genome_file],
+                                                          {'encoding': args['intermediates'],
+                                                           'shards': args['shards']}, ['samtools', 'bowtie2'],
+                                                          shard_alignment, source, ref_genome_file, prefix_id,
+                                                          args['verbose'], index, args['shards'],
+                                                          args['intermediates'])))
+
+        else:
+            # Convert the aligned reads to BAM format from SAM format
+            tasks.append(('sam_to_bam', [reads], 1,
+                          lambda source: run_stage(run_dir, 'sam_to_bam', [source],
+                                                   {'encoding': args['intermediates']}, ['samtools'], sam_to_bam,
+                                                   source, prefix_id, args['verbose'], args['intermediates'])))
+
+            # Sort and index the aligned reads
+            tasks.append(('sorted_reads', ['sam_to_bam'], None,
+                          lambda source: run_stage(run_dir, 'sort_and_index', [source],
+                                                   {'encoding': args['intermediates']}, ['samtools'], sort_and_index,
+                                                   source, prefix_id, args['verbose'], args['intermediates'])))
+
+        if args['update']:
+            # Merge the reads into those of earlier runs and call the variants again where the new reads landed
+            tasks.append(('consensus', ['sorted_reads', 'index_reference'], None,
+                          lambda source, _: run_stage(run_dir, 'update_variants', [source, ref_genome_file], {},
+                                                      ['samtools', 'bcftools'], update_variants, source,
+                                                      ref_genome_file, args['update'], prefix_id, args['verbose'],
+                                                      args['region_size'])))
+
+        else:
+            # Call the variants and generate a consensus
+            tasks.append(('consensus', ['sorted_reads', 'index_reference'], None,
+                          lambda source, _: run_stage(run_dir, 'call_variants', [source, ref_genome_file], {},
+                                                      ['samtools', 'bcftools'], call_variants, source,
+                                                      ref_genome_file, prefix_id, args['verbose'],
+                                                      args['region_size'])))
+
+    consensus = run_graph(tasks)['consensus']
+
+    # The pileup consensus keeps the case of the reference, so clean up its formatting, writing it straight to its
+    # destination unless it is kept in the run directory. The variant callers write theirs formatted.
+    if args['engine'] == 'pileup' and (run_dir is None or output_file is None):
+        return run_stage(run_dir, 'format_consensus', [consensus], {}, [], format_consensus, consensus, prefix_id,
+                         output_file)
+
+    elif args['engine'] == 'pileup':
+        consensus = run_stage(run_dir, 'format_consensus', [consensus], {}, [], format_consensus, consensus, prefix_id)
+
+    if output_file is None:
+        return consensus
+
+    write_consensus(consensus, output_file)
+
+    return output_file
+
+
+def scratch_directory(large=True):
+    """
+    Find the directory of the workspace of the current run
+
+    large - whether the directory is the one for the files growing with the reads rather than with the reference
+
+    Returns the directory, which is the system temp directory outside a workspace
+    """
+
+    directories = getattr(_scope, 'workspace', None) or {}
+
+    return directories.get('large' if large else 'small') or tempfile.gettempdir()
+
+
+def scratch_file(name, large=True):
+    """
+    Place an intermediate file in the workspace of the current run
+
+    name - name of the intermediate file
+    large - whether the file grows with the reads rather than with the reference
+
+    Returns the path of the intermediate file
+    """
+
+    return os.path.join(scratch_directory(large), name)
+
+
+def scratch_size(read_file, args):
+    """
+    Estimate the scratch space a run needs for its large intermediate files
+
+    read_file - the read file, or - for stdin
+    args - the user's arguments
+
+    Returns the estimated size in bytes, or 0 if the size of the reads is unknown
+    """
+
+    if read_file == '-' or not os.path.isfile(read_file):
+        return 0
+
+    fastq = read_format(read_file) in ('fastq', 'fastq.gz')
+
+    # Streamed stages only write the sorted reads to disk, the rest keep their outputs until the run ends. The
+    # pileup engine counts the alignments without sorting them.
+    stages = [] if args['stream'] else ['shard'] if args['shards'] else ['align']
+
+    if args['engine'] != 'pileup':
+        stages.append('sort')
+
+    if not fastq and (not args['stream'] or args['trim'] or args['max_depth'] or not args['disable_ec'] or
+                      args['shards']):
+        stages.append('convert')
+
+    if args['trim']:
+        stages.append('trim')
+
+    if args['max_depth']:
+        stages.append('downsample')
+
+    if not args['disable_ec']:
+        stages.append('correct')
+
+        # The chunks are corrected into copies which are only removed once they are joined
+        if args['chunked_ec']:
+            stages.append('chunk')
+
+    return os.path.getsize(read_file) * sum(_SCRATCH_FACTOR[stage] for stage in stages)
+
+
+def check_space(directory, needed):
+    """
+    Ensure a directory has room for the intermediate files of a run
+
+    directory - directory the intermediate files are written to
+    needed - the estimated size of the intermediate files in bytes
+    """
+
+    free = psutil.disk_usage(directory).free
+
+    if free < needed:
+        raise ValueError('The run needs about ' + str(round(needed / 1e9, 1)) + ' GB of scratch space but only ' +
+                         str(round(free / 1e9, 1)) + ' GB is free in ' + directory)
+
+
+@contextlib.contextmanager
+def workspace(run_dir=None, scratch_dir=None, small_dir=None, needed=0):
+    """
+    Give a run a private directory for its intermediate files, which is removed when the run succeeds, fails or is
+    interrupted. The files of a resumable run are kept in its run directory instead. The workspace belongs to the
+    thread entering it and the threads the run starts, so runs in other threads keep their own.
+
+    run_dir - directory in which the intermediate files are kept so the run can be resumed, or None
+    scratch_dir - directory in which the large intermediate files are placed, such as a fast local disk, or None for
+                  the system temp directory
+    small_dir - directory in which the small intermediate files are placed, such as a tmpfs, or None to keep them
+                with the large ones
+    needed - the estimated size of the large intermediate files in bytes
+
+    Yields the prefix of all temp files of the run
+    """
+
+    previous = getattr(_scope, 'workspace', None)
+    directories = {}
+    created = []
+
+    try:
+        if run_dir:
+            # Keep every intermediate file in the run directory under stable names so a later run can pick up where
+            # this one stopped
+            if not os.path.isdir(run_dir):
+                os.makedirs(run_dir)
+
+            check_space(run_dir, needed)
+            directories['large'] = directories['small'] = os.path.abspath(run_dir)
+
+        else:
+            # A directory of its own keeps the files of concurrent runs apart, including those of utilities which
+            # name their outputs after their inputs
+            check_space(scratch_dir or tempfile.gettempdir(), needed)
+            created.append(tempfile.mkdtemp(prefix='grapple_', dir=scratch_dir))
+            directories['large'] = directories['small'] = created[-1]
+
+            if small_dir:
+                created.append(tempfile.mkdtemp(prefix='grapple_', dir=small_dir))
+                directories['small'] = created[-1]
+
+        _scope.workspace = directories
+
+        yield ''
+
+    finally:
+        _scope.workspace = previous
+
+        for directory in created:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def write_consensus(consensus_file, output_file='-'):
+    """
+    Copy the consensus to its final destination
+
+    consensus_file - the formatted consensus file
+    output_file - file to write the consensus to, or - for stdout
+    """
+
+    with output_handle(output_file) as ofile_handle:
+        copy_file(consensus_file, ofile_handle)
+
+
+def read_batch(batch_file):
+    """
+    Read the samples listed in a batch manifest. Each non-empty line not starting with # holds the path of a read
+    file, optionally followed by the path of its consensus file, separated by whitespace. Without an output path, the
+    consensus is written next to the read file, its extension replaced by .consensus.fa.
+
+    batch_file - the batch manifest
+
+    Returns a list of (read file, consensus file) pairs
+    """
+
+    samples = []
+
+    with open(batch_file) as batch_handle:
+        for line in batch_handle:
+            fields = line.split()
+
+            if not fields or fields[0].startswith('#'):
+                continue
+
+            if len(fields) > 2:
+                raise ValueError('The batch manifest line "' + line.strip() + '" has more than two fields')
+
+            stem = fields[0][:len(fields[0]) - len(file_extension(fields[0]))]
+            output_file = fields[1] if len(fields) == 2 else stem + '.consensus.fa'
+            samples.append((fields[0], output_file))
+
+    if not samples:
+        raise ValueError('The batch manifest does not list any samples')
+
+    return samples
+
+
+def assemble_sample(job):
+    """
+    Assemble one sample of a batch in a worker process. Failures are reported rather than raised so one bad sample
+    does not abort the batch.
+
+    job - tuple of the sample number, read file, consensus file, reference genome file, index prefix and the user's
+          arguments
+
+    Returns a tuple of the sample number, read file, consensus file, an error message or None on success, and the
+    profile of each stage or None if profiling is disabled
+    """
+
+    number, read_file, output_file, ref_genome_file, index_prefix, args = job
+
+    stages = start_profiling() if args['profile'] else None
+
+    try:
+        if not os.path.isfile(read_file):
+            raise IOError()
+
+        # Give each sample a run directory of its own inside the batch's run directory
+        run_dir = os.path.join(args['resume'], str(number)) if args['resume'] else None
+
+        # Give each sample a metrics file of its own
+        metrics_file = None
+
+        if args['metrics']:
+            metrics_file = os.path.splitext(args['metrics'])[0] + '_' + str(number + 1) + \
+                os.path.splitext(args['metrics'])[1]
+
+        with workspace(run_dir, args['scratch'], args['small_scratch'], scratch_size(read_file, args)) as prefix_id:
+            with export_metrics(metrics_file, args['progress'], args['metrics_interval']):
+                assemble(read_file, ref_genome_file, args, prefix_id, index_prefix, run_dir, output_file)
+
+    except ValueError as e:
+        return number, read_file, output_file, str(e), stages
+
+    except EnvironmentError:
+        return number, read_file, output_file, 'The read file could not be read or a required utility is missing', \
+            stages
+
+    except CalledProcessError as e:
+        return number, read_file, output_file, failure_message(e), stages
+
+    # Report any other failure too, as an exception escaping the worker would abort the rest of the batch
+    except Exception as e:
+        return number, read_file, output_file, str(e) or type(e).__name__, stages
+
+    return number, read_file, output_file, None, stages
+
+
+def run_batch(samples, ref_genome_file, args, index_prefix, jobs):
+    """
+    Assemble many samples against one reference genome in a pool of worker processes which split the machine's
+    cores and memory between them.
+
+    samples - list of (read file, consensus file) pairs
+    ref_genome_file - file containing the reference genome in FASTA format, with its FASTA index already built
+    args - the user's arguments
+    index_prefix - prefix of the prebuilt index of the reference genome
+    jobs - number of samples assembled concurrently
+
+    Returns the number of samples that failed
+    """
+
+    jobs = max(1, min(jobs, len(samples)))
+
+    # Divide the usable cores and memory evenly between the workers instead of letting each one claim every core
+    threads = max(1, thread_count() // jobs)
+    memory = memory_limit() / jobs
+
+    # Give each worker a disjoint slice of the CPUs if pinning was requested
+    cpu_queue = None
+
+    if args['pin_cpus']:
+        cpus = detect_resources()['cpus']
+        cpu_queue = multiprocessing.Queue()
+
+        for job in range(jobs):
+            cpu_queue.put(cpus[job * threads:(job + 1) * threads] or cpus)
+
+    status('Assembling ' + str(len(samples)) + ' samples, ' + str(jobs) + ' at a time with ' + str(threads) +
+           ' threads each')
+
+    job_list = [(number, read_file, output_file, ref_genome_file, index_prefix, args)
+                for number, (read_file, output_file) in enumerate(samples)]
+
+    pool = multiprocessing.Pool(jobs, initializer=limit_resources, initargs=(threads, memory, cpu_queue))
+    failures = 0
+    profiles = []
+
+    try:
+        for number, read_file, output_file, message, stages in pool.imap_unordered(assemble_sample, job_list):
+            profiles.append({'number': number + 1, 'inputs': describe_files([read_file]), 'jobs': jobs,
+                             'threads': threads, 'stages': stages})
+
+            if message is None:
+                status('Sample ' + str(number + 1) + ' (' + read_file + ') was assembled into ' + output_file)
+
+            else:
+                failures += 1
+                status('Sample ' + str(number + 1) + ' (' + read_file + ') failed: ' + message)
+
+        pool.close()
+
+    finally:
+        # Stop any sample still running if the batch was interrupted
+        pool.terminate()
+        pool.join()
+
+    if args['profile']:
+        write_profile(args['profile'], {'samples': sorted(profiles, key=lambda profile: profile['number'])})
+
+    return failures
+
+
+def sample_reads(ref_genome_file, read_file, reads, read_length=100, error_rate=0.01, seed=0):
+    """
+    Simulate reads from the reference genome with substitution errors
+
+    ref_genome_file - file containing the reference genome in FASTA format
+    read_file - FASTQ file to write the reads to
+    reads - number of reads
+    read_length - length of each read
+    error_rate - probability of each base being substituted
+    seed - seed of the random choices
+
+    Returns the FASTQ file
+    """
+
+    genome = numpy.concatenate([bases for _, _, bases in read_reference(ref_genome_file)])
+
+    if len(genome) < read_length:
+        raise ValueError('The reference genome is shorter than the simulated reads')
+
+    random = numpy.random.RandomState(seed)
+    starts = random.randint(0, len(genome) - read_length + 1, reads)
+    sequences = genome[starts[:, None] + numpy.arange(read_length)]
+
+    # Substitute a random base where an error falls
+    errors = random.random_sample(sequences.shape) < error_rate
+    sequences[errors] = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)[random.randint(0, 4, errors.sum())]
+
+    quality = b'I' * read_length
+
+    with open(read_file, 'wb') as ofile_handle:
+        for number, sequence in enumerate(sequences):
+            ofile_handle.write(b'@read_' + str(number).encode() + b'\n' + sequence.tobytes() + b'\n+\n' + quality +
+                               b'\n')
+
+    return read_file
+
+
+def autotune(ref_genome_file, profile_file=None, read_counts=None, verbose=False):
+    """
+    Time Bowtie2, samtools sort and Karect at a range of thread counts on reads simulated from the reference genome,
+    and record the fastest setting of each utility for each input size class in the machine's tuning profile, which
+    later runs load to choose their thread counts. Utilities which are not installed are skipped.
+
+    ref_genome_file - file containing the reference genome in FASTA format
+    profile_file - JSON file holding the tuning profile of each machine, defaults to autotune.json in the user's cache
+        directory
+    read_counts - number of reads simulated for each input size class, defaults to _AUTOTUNE_READS
+    verbose - verbosity of subprocess
+
+    Returns the tuning profile of this machine
+    """
+
+    if profile_file is None:
+        profile_file = user_cache_file('autotune.json')
+
+    # Powers of two up to the budget, along with the physical cores and the budget itself
+    threads = thread_count()
+    candidates = sorted(set([2 ** power for power in range(int(math.log(threads, 2)) + 1)] +
+                            [min(threads, psutil.cpu_count(logical=False) or threads), threads]))
+
+    installed = dict((tool, find_tool(tool) is not None) for tool in ('bowtie2', 'bowtie2-build', 'samtools', 'karect'))
+    tuning = {}
+
+    def measure(tool, read_file, run):
+        """Time a utility at every candidate thread count and record the fastest"""
+
+        seconds = {}
+
+        for candidate in candidates:
+            start = time.time()
+            run(candidate)
+            seconds[str(candidate)] = time.time() - start
+
+        fastest = min(candidates, key=lambda candidate: seconds[str(candidate)])
+        tuning.setdefault(tool, {})[str(size_class(read_file))] = {'threads': fastest, 'seconds': seconds}
+
+        status(tool + ' is fastest on ' + str(os.path.getsize(read_file)) + ' bytes with ' + str(fastest) +
+               (' thread' if fastest == 1 else ' threads'))
+
+    with workspace() as prefix_id, open(os.devnull, 'w') as null_handle:
+        err_handle = sys.stderr if verbose else null_handle
+
+        if installed['bowtie2'] and installed['bowtie2-build']:
+            index_prefix = build_index(ref_genome_file, prefix_id, verbose)
+
+        for reads in read_counts or _AUTOTUNE_READS:
+            read_file = sample_reads(ref_genome_file, scratch_file(prefix_id + 'autotune_' + str(reads) + '.fq'),
+                                     reads)
+
+            status('Timing the utilities on ' + str(reads) + ' simulated reads')
+
+            if installed['bowtie2'] and installed['bowtie2-build']:
+                aligned_reads = scratch_file(prefix_id + 'autotune_' + str(reads) + '.sam')
+
+                def align(candidate):
+                    """Align the reads with the given number of threads"""
+
+                    with open(aligned_reads, 'w') as ofile_handle:
+                        run_command(['bowtie2', '-p', str(candidate), '-x', index_prefix, '-U', read_file],
+                                    stdout=ofile_handle, stderr=err_handle)
+
+                measure('bowtie2', read_file, align)
+
+                # Sort the alignments of the last run
+                if installed['samtools']:
+                    converted_reads = scratch_file(prefix_id + 'autotune_' + str(reads) + '.bam')
+                    sorted_reads = scratch_file(prefix_id + 'autotune_' + str(reads) + '_sorted.bam')
+
+                    run_command(['samtools', 'view', '-b', '-o', converted_reads, aligned_reads],
+                                stdout=null_handle, stderr=err_handle)
+
+                    measure('samtools sort', converted_reads, lambda candidate: run_command(
+                        ['samtools', 'sort', '-o', sorted_reads] + sort_options(candidate) +
+                        ['-T', scratch_file(prefix_id + 'autotune_sorting'), converted_reads],
+                        stdout=null_handle, stderr=err_handle))
+
+            if installed['karect']:
+                measure('karect', read_file, lambda candidate: os.remove(
+                    run_karect(read_file, 'haploid', 'edit', candidate, memory_limit(), verbose)))
+
+    if not tuning:
+        raise ValueError('None of the utilities to tune are installed in your PATH')
+
+    # Keep the profiles of the other machines sharing the file
+    try:
+        with open(profile_file) as profile_handle:
+            profiles = json.load(profile_handle)
+
+    except (EnvironmentError, ValueError):
+        profiles = {}
+
+    profiles[socket.gethostname()] = tuning
+
+    if not os.path.isdir(os.path.dirname(profile_file)):
+        os.makedirs(os.path.dirname(profile_file))
+
+    with open(profile_file + '.tmp', 'w') as profile_handle:
+        json.dump(profiles, profile_handle, indent=2, sort_keys=True)
+
+    os.rename(profile_file + '.tmp', profile_file)
+
+    _tuning['threads'] = tuning
+
+    return tuning
+
+
+def configure(**options):
+    """
+    Build the arguments of a run from options named after the long command line options, checking their types,
+    choices and combinations the same way the command line does
+
+    options - the options differing from the command line defaults
+
+    Returns the dictionary of every argument
+    """
+
+    unknown = set(options) - set(_FLAG_OPTIONS) - set(_VALUE_OPTIONS)
+
+    if unknown:
+        raise ValueError('Unknown options: ' + ', '.join(sorted(unknown)))
+
+    # Parse the options as their command line, so they are converted and checked exactly as it is
+    command_line = ['--' + name for name in _FLAG_OPTIONS if options.get(name)] + \
+        ['--' + name + '=' + str(options[name]) for name in _VALUE_OPTIONS if options.get(name) is not None]
+
+    args = vars(build_parser(raise_errors=True).parse_args(command_line))
+
+    # An option given as None is left unset rather than given its default
+    args.update((name, None) for name in _VALUE_OPTIONS if name in options and options[name] is None)
+
+    if (args['threads'] is not None and args['threads'] < 1) or (args['memory'] is not None and args['memory'] <= 0):
+        raise ValueError('The thread and memory budgets must be positive')
+
+    # A sample's reads are merged in place, which can neither be repeated by a resumed run nor shared by a batch
+    if args['update'] and (args['resume'] or args['batch'] or args['engine'] == 'pileup'):
+        raise ValueError('A sample cannot be updated in a resumed run, a batch or with the pileup engine')
+
+    # Each shard is already piped into its own sort, and the pileup engine does not sort the alignments at all
+    if args['shards'] and (args['stream'] or args['engine'] == 'pileup'):
+        raise ValueError('The reads cannot be aligned in shards when streaming or with the pileup engine')
+
+    if args['serve'] and (args['resume'] or args['batch']):
+        raise ValueError('A server cannot resume a run or assemble a batch')
+
+    return args
+
+
+@contextlib.contextmanager
+def pipeline_errors():
+    """Raise the failures of the context as a PipelineError describing them in terms of the pipeline"""
+
+    try:
+        yield
+
+    except PipelineError:
+        raise
+
+    except ValueError as e:
+        raise PipelineError(str(e), e)
+
+    except EnvironmentError as e:
+        raise PipelineError(_ENVIRONMENT_ERROR, e)
+
+    except CalledProcessError as e:
+        raise PipelineError(failure_message(e), e)
+
+
+class Pipeline(object):
+    """
+    Assemble samples against one reference genome from Python. Its indexes can be prepared once and kept until the
+    pipeline is closed, so later samples do not pay for them. Failures are raised as a PipelineError.
+
+    with grapple.Pipeline(ref='ref.fa', disable_ec=True) as pipeline:
+        result = pipeline.run('reads.bam', 'consensus.fa')
+    """
+
+    # The profile and throughput metrics belong to the whole process, so runs reporting them take turns
+    _reporting = threading.Lock()
+
+    def __init__(self, **options):
+        """
+        Configure the pipeline
+
+        options - options named after the long command line options, such as ref, disable_ec or threads
+        """
+
+        with pipeline_errors():
+            self.args = configure(**options)
+
+            if not self.args['ref']:
+                raise ValueError('A reference genome was not provided so the pipeline cannot execute')
+
+            elif not os.path.isfile(self.args['ref']):
+                raise IOError()
+
+        self._reference = None
+        self._cache = None
+        self._index_dir = None
+        self._checked = self.args['skip_preflight']
+
+        # Runs of this pipeline may overlap, but prepare its reference once
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def prepare(self):
+        """
+        Build the Bowtie2 index and FASTA index of the reference unless they are already prepared, taking them from
+        the reference cache if the pipeline has one. They are kept until the pipeline is closed.
+
+        Returns the prepared reference genome file and the prefix of its Bowtie2 index
+        """
+
+        with pipeline_errors(), self._lock, resource_budget(self.args['threads'], self.args['memory']):
+            self.check()
+
+            if self._reference is None:
+                if self.args['cache']:
+                    # Hold on to the cache entry so it is not evicted while the pipeline uses it
+                    self._cache = cached_reference(self.args['ref'], self.args['cache'],
+                                                   int(self.args['cache_size'] * 1000000000), self.args['verbose'])
+                    self._reference = self._cache.__enter__()
+
+                else:
+                    self._index_dir = tempfile.mkdtemp(prefix='grapple_', dir=self.args['scratch'])
+                    index_prefix = build_index(self.args['ref'], verbose=self.args['verbose'],
+                                               index_prefix=os.path.join(self._index_dir, 'bt2_index'))
+                    index_reference(self.args['ref'], self.args['verbose'])
+
+                    self._reference = self.args['ref'], index_prefix
+
+        return self._reference
+
+    def check(self):
+        """Check the utilities the pipeline uses before its first run, unless the check was skipped"""
+
+        with pipeline_errors():
+            if not self._checked:
+                preflight(self.args)
+                self._checked = True
+
+    def run(self, read_file='-', output_file='-', run_dir=None):
+        """
+        Assemble a sample. Unless the reference is prepared or cached, it is indexed alongside the first stages.
+
+        read_file - file containing the NGS reads in BAM, CRAM, SAM or FASTQ format, or - for BAM reads on stdin
+        output_file - file to write the consensus to, or - for stdout
+        run_dir - directory in which the stages record their manifests so an interrupted run can be resumed
+
+        Returns a dictionary of the read file, the consensus file, the wall time of the run in seconds and, if
+        profiling is enabled, the profile of each stage
+        """
+
+        reporting = self.args['profile'] or self.args['metrics'] or self.args['progress']
+
+        # The workspace and resource budget of the run are its own, so other runs in the process are not disturbed
+        with pipeline_errors(), self._reporting if reporting else threading.Lock(), \
+                resource_budget(self.args['threads'], self.args['memory']):
+            if read_file != '-' and not os.path.isfile(read_file):
+                raise IOError()
+
+            self.check()
+
+            ref_genome_file, index_prefix = self.prepare() if self.args['cache'] else \
+                self._reference or (self.args['ref'], None)
+
+            start = time.time()
+
+            # The workspace and every intermediate file in it are removed however the run ends
+            with workspace(run_dir, self.args['scratch'], self.args['small_scratch'],
+                           scratch_size(read_file, self.args)) as prefix_id:
+                if read_file == '-' and run_dir:
+                    # A resumed run must be able to compare the input against the earlier run, so keep a copy
+                    read_file = scratch_file(prefix_id + 'stdin_dump.bam')
+                    with open(read_file, 'wb') as ifile_handle:
+                        shutil.copyfileobj(getattr(sys.stdin, 'buffer', sys.stdin), ifile_handle, 1 << 20)
+
+                stages = start_profiling() if self.args['profile'] else None
+
+                try:
+                    with export_metrics(self.args['metrics'], self.args['progress'], self.args['metrics_interval']):
+                        assemble(read_file, ref_genome_file, self.args, prefix_id, index_prefix, run_dir,
+                                 output_file)
+
+                finally:
+                    # Report the stages that ran even if a later one failed
+                    if self.args['profile']:
+                        write_profile(self.args['profile'], {'inputs': describe_files([read_file]),
+                                                             'threads': thread_count(), 'stages': stages})
+
+        return {'input': read_file, 'consensus': output_file, 'seconds': time.time() - start, 'stages': stages}
+
+    def close(self):
+        """Release the prepared reference"""
+
+        if self._cache is not None:
+            self._cache.__exit__(None, None, None)
+
+        if self._index_dir is not None:
+            shutil.rmtree(self._index_dir, ignore_errors=True)
+
+        self._reference = self._cache = self._index_dir = None
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Answer the jobs sent over a connection to the server. Each job is a line holding a JSON object with the input
+    file and optionally the output file, which defaults to the input with a .consensus.fa extension. Each answer is a
+    line holding the result of the job, or its error.
+    """
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                job = json.loads(line.decode('utf-8'))
+                read_file = job['input']
+                stem = read_file[:len(read_file) - len(file_extension(read_file))]
+                output_file = job.get('output') or stem + '.consensus.fa'
+
+                # The server's own stdin and stdout are no place for a job's reads or consensus
+                if '-' in (read_file, output_file):
+                    raise ValueError()
+
+            except (AttributeError, KeyError, TypeError, ValueError):
+                answer = {'error': 'The job is not a JSON object holding the paths of its input and output files'}
+
+            else:
+                try:
+                    # Queue the job behind those already sent to the server
+                    answer = self.server.jobs.apply(self.server.pipeline.run, (read_file, output_file))
+
+                except PipelineError as e:
+                    answer = {'error': str(e)}
+
+            self.wfile.write((json.dumps(answer) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server listening on a Unix socket for the jobs of one pipeline, which runs them one at a time in order"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_file, pipeline):
+        """
+        Start listening
+
+        socket_file - path of the Unix socket
+        pipeline - the pipeline running the jobs
+        """
+
+        # Replace the socket left behind by a server which did not shut down, but never one which is still listening
+        if os.path.exists(socket_file):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(socket_file)
+
+            except socket.error:
+                os.remove(socket_file)
+
+            else:
+                raise ValueError('Another server is already listening on ' + socket_file)
+
+            finally:
+                probe.close()
+
+        socketserver.UnixStreamServer.__init__(self, socket_file, JobHandler)
+
+        self.pipeline = pipeline
+        self.jobs = multiprocessing.pool.ThreadPool(1)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        self.jobs.terminate()
+        os.remove(self.server_address)
+
+
+def serve(pipeline, socket_file):
+    """
+    Run the jobs sent to a Unix socket until interrupted
+
+    pipeline - the pipeline running the jobs
+    socket_file - path of the Unix socket
+    """
+
+    server = JobServer(socket_file, pipeline)
+    status('Serving jobs on ' + socket_file)
+
+    try:
+        server.serve_forever()
+
+    finally:
+        server.server_close()
+
+
+def submit_job(socket_file, read_file, output_file=None):
+    """
+    Send a job to a server and wait for it to finish
+
+    socket_file - path of the server's Unix socket
+    read_file - file containing the NGS reads in BAM, CRAM, SAM or FASTQ format
+    output_file - file to write the consensus to, defaults to the read file with a .consensus.fa extension
+
+    Returns the result of the job, as returned by Pipeline.run()
+    """
+
+    # The server resolves paths against its own working directory
+    job = {'input': os.path.abspath(read_file), 'output': output_file and os.path.abspath(output_file)}
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        client.connect(socket_file)
+        client.sendall((json.dumps(job) + '\n').encode('utf-8'))
+
+        answer = json.loads(client.makefile('rb').readline().decode('utf-8'))
+
+    finally:
+        client.close()
+
+    if 'error' in answer:
+        raise PipelineError(answer['error'])
+
+    return answer
+
+
+def main(args):
+    """Executes the pipeline according to the user's arguments."""
+
+    try:
+        args = configure(**args)
+
+        # Apply the user's resource budget, which otherwise comes from the affinity mask and cgroup limits
+        limit_resources(args['threads'], args['memory'])
+
+        if args['autotune']:
+            # Tune against the user's reference, or the lambda reference shipped with the tests
+            ref_genome_file = args['ref'] or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files',
+                                                          'lambda_ref.fa')
+
+            if not os.path.isfile(ref_genome_file):
+                raise IOError()
+
+            autotune(ref_genome_file, verbose=args['verbose'])
+
+            status('The thread counts have been tuned for this machine')
+
+        # Start the pipeline if the user provided a reference genome
+        elif args['ref']:
+            # Ensure the reference file exists
+            if not os.path.isfile(args['ref']):
+                raise IOError()
+
+            elif args['serve']:
+                with Pipeline(**args) as pipeline:
+                    # Prepare the reference before the first job arrives so every job finds it ready
+                    pipeline.prepare()
+                    serve(pipeline, args['serve'])
+
+            elif args['batch']:
+                samples = read_batch(args['batch'])
+                jobs = args['jobs'] or max(1, thread_count() // 4)
+
+                # Prepare the reference once for every sample, which also builds the FASTA index up front so
+                # concurrent samples do not race to create it
+                with Pipeline(**args) as pipeline:
+                    ref_genome_file, index_prefix = pipeline.prepare()
+                    failures = run_batch(samples, ref_genome_file, args, index_prefix, jobs)
+
+                if failures:
+                    error(str(failures) + ' of ' + str(len(samples)) + ' samples could not be assembled')
+
+                status('Every sample has been successfully assembled!')
+
+            else:
+                if args['pin_cpus']:
+                    # Pin the pipeline and therefore every utility it runs to as many CPUs as it has threads
+                    psutil.Process().cpu_affinity(detect_resources()['cpus'][:thread_count()])
+
+                # Determine if the user has provided an input file or wishes to use stdin. Let samtools read stdin
+                # itself so the conversion overlaps with the input arriving. The consensus is written to the output
+                # file if the user provided one, or to stdout otherwise.
+                with Pipeline(**args) as pipeline:
+                    pipeline.run(args['input'] or '-', args['output'] or '-', args['resume'])
+
+                status('The reference genome has been successfully assembled!')
+
+        else:
+            # Raise an exception since no reference was provided
+            raise ValueError('A reference genome was not provided so the pipeline cannot execute')
+
+    except KeyboardInterrupt:
+        # Exit the script cleanly if interrupted by user
+        error('')
+
+    except ValueError as e:
+        # Print the error message before exiting the script
+        error(e)
+
+    except EnvironmentError:
+        # Inform the user something is wrong with the execution environment
+        error(_ENVIRONMENT_ERROR)
+
+    except CalledProcessError as e:
+        # Print an error message depending on which process failed
+        error(failure_message(e))
+
+    except PipelineError as e:
+        # The pipeline has already described the failure
+        error(e)
+
+
+class OptionParser(argparse.ArgumentParser):
+    """Parser of the user's arguments which raises a ValueError for invalid arguments instead of exiting"""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def build_parser(raise_errors=False):
+    """
+    Build the parser of the user's arguments
+
+    raise_errors - raise a ValueError for invalid arguments instead of printing the usage and exiting
+
+    Returns the parser
+    """
+
+    # Setup a parser object for user args
+    parser = (OptionParser if raise_errors else argparse.ArgumentParser)(
+        prog='grapple', description='Genome Reference Assembly Pipeline', add_help=False)
+
+    parser.add_argument('-b', '--batch', help='Specify a manifest listing many read files to assemble against '
+                                              'the same reference, one per line and optionally followed by the '
+                                              'output file of its consensus')
+
+    parser.add_argument('-c', '--cache', help='Specify a directory in which prepared reference genome indexes are '
+                                              'kept between runs. If this flag is not present, the reference is '
+                                              'indexed on every run')
+
+    parser.add_argument('-d', '--disable_ec', action='store_true', help='Disable error correction')
+
+    parser.add_argument('-h', '--help', action='help', help='Display this help screen')
+
+    parser.add_argument('-i', '--input', help='Specify an input file of NGS reads in BAM, CRAM, SAM or FASTQ '
+                                              'format, the FASTQ optionally gzip compressed. The format is detected '
+                                              'from the contents of the file. If this flag is not present, BAM reads '
+                                              'are read from stdin instead')
+
+    parser.add_argument('-j', '--jobs', type=int, help='Specify how many samples of a batch are assembled at once. '
+                                                        'The cores are divided evenly between them. Default value = '
+                                                        'one job per four cores')
+
+    parser.add_argument('-o', '--output', help='Specify an output file for the resulting genome in FASTA format. If '
+                                               'this flag is not present, stdout is used instead')
+
+    parser.add_argument('-r', '--ref', help='The reference genome used to align the read in FASTA format')
+
+    parser.add_argument('-p', '--profile', help='Specify a file in which to write a JSON report of the wall time, '
+                                                'CPU time, peak memory and I/O of each stage along with the sizes '
+                                                'of their inputs and outputs')
+
+    parser.add_argument('-R', '--resume', help='Specify a run directory in which the intermediate files and a '
+                                               'manifest for each stage are kept. Rerunning with the same directory '
+                                               'skips every stage whose inputs, parameters and tools are unchanged')
+
+    parser.add_argument('-s', '--stream', action='store_true', help='Connect the conversion, alignment and sorting '
+                                                                    'stages with pipes instead of writing their '
+                                                                    'intermediate files to disk')
+
+    parser.add_argument('-u', '--update', help='Specify a directory in which the aligned reads and variants of a '
+                                               'sample are kept so later runs with new reads of the same sample only '
+                                               'align the new reads and call the variants again where they landed')
+
+    parser.add_argument('-V', '--version', action='version', version='Grapple 0.2.3',
+                        help='Show the current version of the software.')
+
+    parser.add_argument('-v', '--verbose', action='store_true', help='Output more information about each subprocess '
+                                                                     'being executed')
+
+    parser.add_argument('--ploidy', choices=['n', '2n'], default='n', help='Specify the ploidy of the cells from which '
+                                                                           'the reads came from. If error correction '
+                                                                           'is disabled, this option is ignored. '
+                                                                           'Default value = n')
+
+    parser.add_argument('--mode', choices=['equal', 'indel', 'subs'], default='equal',
+                        help='Specify the type of errors that should be favoured during read correction '
+                             'The equal option weighs all types of errors equally. If error correction is disabled, '
+                             'this option is ignored. Default value = equal')
+
+    parser.add_argument('--chunked_ec', action='store_true',
+                        help='Split the reads into chunks sized against the memory budget and correct them with '
+                             'concurrent Karect processes, one per four threads, for reads too large to correct at '
+                             'once. If error correction is disabled, this option is ignored')
+
+    parser.add_argument('--cluster_ec', action='store_true',
+                        help='Cluster the reads by the k-mer they start with before splitting them into chunks so '
+                             'the correction of each chunk stays closer to that of the whole. This option only '
+                             'applies with --chunked_ec')
+
+    parser.add_argument('--region_size', type=int, help='Specify the length in bases of the regions whose variants '
+                                                        'are called concurrently. If this flag is not present, each '
+                                                        'contig of the reference is called as one region, or as '
+                                                        'regions of 100000 bases when updating a sample')
+
+    parser.add_argument('--shards', type=int, help='Specify a number of shards to split the reads into, which are '
+                                                   'aligned by concurrent Bowtie2 processes, sorted as they are '
+                                                   'aligned and merged. If this flag is not present, the reads are '
+                                                   'aligned by one process and sorted afterwards')
+
+    parser.add_argument('--autotune', action='store_true',
+                        help='Time Bowtie2, samtools sort and Karect at a range of thread counts on reads simulated '
+                             'from the reference, or the lambda reference of the tests if none is given, and record '
+                             'the fastest setting of each for this machine. Later runs use them, within the thread '
+                             'budget, instead of every thread')
+
+    parser.add_argument('--threads', type=int, help='Specify the number of threads the utilities may use. If this '
+                                                    'flag is not present, it is derived from the CPU affinity and '
+                                                    'cgroup CPU quota of the process')
+
+    parser.add_argument('--memory', type=float, help='Specify the memory in GB the utilities may use. If this flag is '
+                                                     'not present, it is derived from the available memory and the '
+                                                     'cgroup memory limit of the process')
+
+    parser.add_argument('--pin_cpus', action='store_true', help='Pin the utilities to as many CPUs as they have '
+                                                                'threads, giving each sample of a batch its own CPUs')
+
+    parser.add_argument('--cache_size', type=float, default=10, help='Specify the maximum size of the reference cache '
+                                                                     'in GB. The least recently used references are '
+                                                                     'removed once it is exceeded. Default value = 10')
+
+    parser.add_argument('--trim', action='store_true', help='Trim the low quality tails of the reads and filter out '
+                                                            'short reads and reads with many unknown bases before '
+                                                            'they are corrected and aligned')
+
+    parser.add_argument('--trim_window', type=int, default=4, help='Specify the number of bases averaged when '
+                                                                   'trimming. Default value = 4')
+
+    parser.add_argument('--trim_quality', type=int, default=20, help='Specify the lowest mean quality of a window '
+                                                                     'kept when trimming. Default value = 20')
+
+    parser.add_argument('--min_length', type=int, default=36, help='Specify the shortest read kept after trimming. '
+                                                                   'Default value = 36')
+
+    parser.add_argument('--max_n', type=float, default=0.1, help='Specify the highest fraction of unknown bases in a '
+                                                                 'read kept after trimming. Default value = 0.1')
+
+    parser.add_argument('--engine', choices=['bcftools', 'pileup'], default='bcftools',
+                        help='Specify how the consensus is generated. The bcftools option sorts and indexes the '
+                             'aligned reads and calls their variants, while the pileup option counts the bases of the '
+                             'alignments at each position and takes the majority, without sorting or indexing. '
+                             'Default value = bcftools')
+
+    parser.add_argument('--min_depth', type=int, default=3, help='Specify the lowest depth at which the pileup engine '
+                                                                 'calls a position. Positions with less coverage '
+                                                                 'keep the reference base. Default value = 3')
+
+    parser.add_argument('--min_frequency', type=float, default=0.5,
+                        help='Specify the lowest fraction of the reads at a position which must agree for the pileup '
+                             'engine to call it. Default value = 0.5')
+
+    parser.add_argument('--max_depth', type=float, help='Specify the mean depth of coverage of the reference to keep. '
+                                                        'Reads beyond it are randomly discarded before they are '
+                                                        'corrected and aligned. If this flag is not present, every '
+                                                        'read is kept')
+
+    parser.add_argument('--seed', type=int, default=0, help='Specify the seed used to choose the reads kept when '
+                                                            'downsampling. Default value = 0')
+
+    parser.add_argument('--intermediates', choices=['plain', 'uncompressed', 'fast', 'gzip'], default='plain',
+                        help='Specify how the intermediate files are encoded, trading CPU time for I/O. The plain '
+                             'option keeps the FASTQ files as text and compresses the BAM files as usual, '
+                             'uncompressed writes uncompressed BAM files, fast gzips the FASTQ files and compresses '
+                             'the BAM files at the fastest level, and gzip gzips the FASTQ files. Default value = '
+                             'plain')
+
+    parser.add_argument('--skip_preflight', action='store_true',
+                        help='Skip checking that the utilities are installed, recent enough and accept the '
+                             'subcommands and options the run uses before it starts. The findings are cached by the '
+                             'path and modification time of each utility')
+
+    parser.add_argument('--scratch', help='Specify the directory in which the large intermediate files of each run '
+                                          'are kept, such as a fast local disk. The files are removed once the run '
+                                          'ends. Default value = the system temp directory')
+
+    parser.add_argument('--small_scratch', help='Specify the directory in which the small intermediate files of each '
+                                                'run are kept, such as a tmpfs. If this flag is not present, they are '
+                                                'kept with the large ones')
+
+    parser.add_argument('--metrics', help='Specify a file in which to publish the throughput, progress and estimated '
+                                          'time left of the running stages in the OpenMetrics text format, such as '
+                                          'a .prom file for the textfile collector of node_exporter. Each sample of a '
+                                          'batch gets a file of its own, numbered like the samples')
+
+    parser.add_argument('--progress', action='store_true', help='Report the throughput, progress and estimated time '
+                                                                'left of the running stages in stderr')
+
+    parser.add_argument('--metrics_interval', type=float, default=10, help='Specify the time in seconds between '
+                                                                           'updates of the metrics. Default value = '
+                                                                           '10')
+
+    parser.add_argument('--serve', help='Specify a Unix socket on which to keep running and assemble the samples '
+                                        'sent to it against the reference, which is prepared once. Each job is a '
+                                        'line holding a JSON object with its "input" and "output" files and is '
+                                        'answered with a line holding its consensus file and timing')
+
+    return parser
+
+
+if __name__ == '__main__':
     # Retrieve the arguments and pass them to the main function
-    main(vars(parser.parse_args()))
\ No newline at end of file
+    main(vars(build_parser().parse_args()))
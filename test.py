@@ -2,14 +2,69 @@
 
 """Contains unit tests for Grapple."""
 
+import fcntl
+import gzip
+import json
 import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from subprocess import CalledProcessError
 from unittest import TestCase
 
+import benchmark
 import grapple
 
 
+def installed(*tools):
+    """Returns whether every one of the utilities is installed in the PATH"""
+
+    return all(grapple.find_tool(tool) for tool in tools)
+
+
+def differing_bases(first, second, window=10, anchor=20):
+    """
+    Count the bases by which two sequences differ. After each difference, the sequences are realigned at the
+    smallest shift that brings them back into agreement, so an indel counts as its length rather than as every
+    base after it.
+
+    first - the first sequence
+    second - the second sequence
+    window - largest indel looked for
+    anchor - number of bases which must agree after a difference
+
+    Returns the number of differing bases
+    """
+
+    # The smallest shifts are tried first, so each difference is counted at its shortest
+    shifts = sorted(((first_shift, second_shift) for first_shift in range(window + 1)
+                     for second_shift in range(window + 1) if first_shift or second_shift),
+                    key=lambda shift: (max(shift), sum(shift)))
+
+    first_position, second_position, differences = 0, 0, 0
+
+    while first_position < len(first) and second_position < len(second):
+        if first[first_position] == second[second_position]:
+            first_position += 1
+            second_position += 1
+            continue
+
+        for first_shift, second_shift in shifts:
+            if first[first_position + first_shift:first_position + first_shift + anchor] == \
+                    second[second_position + second_shift:second_position + second_shift + anchor]:
+                break
+
+        differences += max(first_shift, second_shift)
+        first_position += first_shift
+        second_position += second_shift
+
+    return differences + max(len(first) - first_position, len(second) - second_position)
+
+
 class TestError(TestCase):
     """Tests involving error()"""
 
@@ -20,75 +75,1492 @@ class TestError(TestCase):
             grapple.error('')
 
 
-class TestBamToFq(TestCase):
-    """Tests involving bam_to_fq()"""
+class TestEvictCache(TestCase):
+    """Test cases for evict_cache()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Cache holding two complete entries of 10 bytes, the first one being the least recently used
+        self._cache_dir = tempfile.mkdtemp()
+
+        for age, name in enumerate(['old', 'new']):
+            os.makedirs(os.path.join(self._cache_dir, name))
+
+            with open(os.path.join(self._cache_dir, name, 'reference.fa'), 'w') as handle:
+                handle.write('A' * 10)
+
+            stamp = os.path.join(self._cache_dir, name, 'complete')
+            open(stamp, 'w').close()
+            os.utime(stamp, (age, age))
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._cache_dir)
+
+    def test_within_cap(self):
+        """Should not remove anything when the cache fits within its cap"""
+
+        grapple.evict_cache(self._cache_dir, 20)
+
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, 'old')))
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, 'new')))
+
+    def test_least_recently_used(self):
+        """Should remove the least recently used entry first when the cache exceeds its cap"""
+
+        grapple.evict_cache(self._cache_dir, 15)
+
+        self.assertFalse(os.path.isdir(os.path.join(self._cache_dir, 'old')))
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, 'new')))
+
+    def test_lock_file(self):
+        """Should remove the lock file of an evicted entry along with the entry"""
+
+        grapple.evict_cache(self._cache_dir, 15)
+
+        self.assertFalse(os.path.exists(os.path.join(self._cache_dir, 'old.lock')))
+
+    def test_relock_evicted(self):
+        """Should take the lock again on a new lock file when the entry was evicted while waiting for it"""
+
+        lock_file = os.path.join(self._cache_dir, 'old.lock')
+
+        with open(lock_file, 'a') as stale_handle:
+            os.remove(lock_file)
+
+            with grapple.lock_entry(lock_file, fcntl.LOCK_SH) as entry_lock:
+                self.assertTrue(os.path.samestat(os.fstat(entry_lock.fileno()), os.stat(lock_file)))
+                self.assertFalse(os.path.samestat(os.fstat(entry_lock.fileno()), os.fstat(stale_handle.fileno())))
+
+    def test_locked_entry(self):
+        """Should not remove an entry that is in use by another run"""
+
+        with open(os.path.join(self._cache_dir, 'old.lock'), 'w') as lock_handle:
+            fcntl.flock(lock_handle, fcntl.LOCK_SH)
+
+            grapple.evict_cache(self._cache_dir, 15)
+
+        self.assertTrue(os.path.isdir(os.path.join(self._cache_dir, 'old')))
+        self.assertFalse(os.path.isdir(os.path.join(self._cache_dir, 'new')))
+
+
+class TestCachedReference(TestCase):
+    """Test cases for cached_reference()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Available reference file
+        self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+        self._cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._cache_dir)
+
+    @unittest.skipUnless(installed('bowtie2-build', 'samtools'),
+                         'bowtie2 and samtools are needed to index the reference')
+    def test_warm_cache(self):
+        """Should reuse the same prepared reference on a second run"""
+
+        with grapple.cached_reference(self._ref_file, self._cache_dir) as (reference, index_prefix):
+            cold_mtime = os.path.getmtime(reference + '.fai')
+
+        with grapple.cached_reference(self._ref_file, self._cache_dir) as (warm_reference, warm_index_prefix):
+            self.assertEqual((reference, index_prefix), (warm_reference, warm_index_prefix))
+            self.assertEqual(cold_mtime, os.path.getmtime(reference + '.fai'))
+
+    def test_invalid_ref_file(self):
+        """Should raise an exception when the reference file is in the wrong format"""
+
+        with self.assertRaises(ValueError):
+            with grapple.cached_reference(os.path.join('test_files', 'lambda_reads.fq'), self._cache_dir):
+                pass
+
+    def test_absent_ref_file(self):
+        """Should raise an exception when the reference file doesn't exist"""
+
+        with self.assertRaises(IOError):
+            with grapple.cached_reference('this_file_does_not_exist.fa', self._cache_dir):
+                pass
+
+
+class TestRunStage(TestCase):
+    """Test cases for run_stage()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._run_dir = tempfile.mkdtemp()
+
+        # Input file of the stage
+        self._input_file = os.path.join(self._run_dir, 'input.txt')
+
+        with open(self._input_file, 'w') as handle:
+            handle.write('grapple')
+
+        self._calls = []
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._run_dir)
+
+    def _stage(self, read_file):
+        """Stage copying its input in upper case"""
+
+        self._calls.append(read_file)
+        ofile = os.path.join(self._run_dir, 'output.txt')
+
+        with open(read_file) as ifile_handle, open(ofile, 'w') as ofile_handle:
+            ofile_handle.write(ifile_handle.read().upper())
+
+        return ofile
+
+    def _run(self, parameters=None):
+        """Run the stage in the run directory"""
+
+        return grapple.run_stage(self._run_dir, 'upper', [self._input_file], parameters or {}, [], self._stage,
+                                 self._input_file)
+
+    def test_no_run_dir(self):
+        """Should always run the stage when no run directory is given"""
+
+        grapple.run_stage(None, 'upper', [self._input_file], {}, [], self._stage, self._input_file)
+        grapple.run_stage(None, 'upper', [self._input_file], {}, [], self._stage, self._input_file)
+
+        self.assertEqual(len(self._calls), 2)
+
+    def test_resume(self):
+        """Should skip the stage and return the same result when nothing has changed"""
+
+        result = self._run()
+
+        self.assertEqual(self._run(), result)
+        self.assertEqual(len(self._calls), 1)
+
+    def test_changed_input(self):
+        """Should run the stage again when its input has changed"""
+
+        self._run()
+
+        with open(self._input_file, 'w') as handle:
+            handle.write('grapple pipeline')
+
+        self._run()
+
+        self.assertEqual(len(self._calls), 2)
+
+    def test_changed_parameters(self):
+        """Should run the stage again when its parameters have changed"""
+
+        self._run({'mode': 'edit'})
+        self._run({'mode': 'insdel'})
+
+        self.assertEqual(len(self._calls), 2)
+
+    def test_missing_output(self):
+        """Should run the stage again when its output has been removed"""
+
+        os.remove(self._run())
+        self._run()
+
+        self.assertEqual(len(self._calls), 2)
+
+    def test_written_bytes(self):
+        """Should profile the bytes the stage wrote, including the files written alongside its output"""
+
+        stages = grapple.start_profiling()
+
+        try:
+            with open(os.path.join(self._run_dir, 'output.txt.idx'), 'w') as handle:
+                handle.write('index')
+
+            self._run()
+
+        finally:
+            grapple._profile['stages'] = None
+
+        self.assertEqual(stages[0]['written_bytes'], len('GRAPPLE') + len('index'))
+
+
+class TestRunGraph(TestCase):
+    """Test cases for run_graph()"""
+
+    def test_dependencies(self):
+        """Should pass the results of the dependencies to each task"""
+
+        tasks = [('sum', ['one', 'two'], 1, lambda one, two: one + two),
+                 ('one', [], 1, lambda: 1),
+                 ('two', [], 1, lambda: 2)]
+
+        self.assertEqual(grapple.run_graph(tasks, 1), {'one': 1, 'two': 2, 'sum': 3})
+
+    def test_overlap(self):
+        """Should run independent tasks at the same time while they fit the thread budget"""
+
+        barrier = threading.Event()
+
+        # Each task only ends once the other has started, so the graph only completes if they overlap
+        tasks = [('first', [], 1, lambda: barrier.wait(5) and barrier.is_set()),
+                 ('second', [], 1, lambda: barrier.set() or True)]
+
+        self.assertEqual(grapple.run_graph(tasks, 2), {'first': True, 'second': True})
+
+    def test_thread_grant(self):
+        """Should give each task its share of the thread budget"""
+
+        tasks = [('small', [], 1, grapple.thread_count),
+                 ('large', ['small'], None, lambda _: grapple.thread_count())]
+
+        self.assertEqual(grapple.run_graph(tasks, 4), {'small': 1, 'large': 4})
+
+    def test_failure(self):
+        """Should raise the failure of a task without starting the tasks depending on it"""
+
+        started = []
+
+        tasks = [('failing', [], 1, lambda: grapple.subprocess.check_call(['false'])),
+                 ('dependent', ['failing'], 1, lambda _: started.append(True))]
+
+        self.assertRaises(CalledProcessError, grapple.run_graph, tasks, 2)
+        self.assertEqual(started, [])
+
+    def test_kill(self):
+        """Should kill the processes of the tasks still running when a task fails, leaving other processes alone"""
+
+        bystander = subprocess.Popen(['sleep', '30'])
+        started = threading.Event()
+
+        def sleeping():
+            """Start a long process and wait for it"""
+
+            process = grapple.start_process(['sleep', '30'])
+            started.set()
+
+            return process.wait()
+
+        def failing():
+            """Fail once the other task's process is running"""
+
+            started.wait(5)
+            raise ValueError('failed')
+
+        try:
+            start = time.time()
+
+            self.assertRaises(ValueError, grapple.run_graph, [('sleeping', [], 1, sleeping),
+                                                              ('failing', [], 1, failing)], 2)
+            self.assertLess(time.time() - start, 10)
+            self.assertIsNone(bystander.poll())
+
+        finally:
+            bystander.kill()
+            bystander.wait()
+
+    def test_missing_dependency(self):
+        """Should raise an exception for a task depending on a task which is not in the graph"""
+
+        self.assertRaises(ValueError, grapple.run_graph, [('orphan', ['missing'], 1, lambda _: None)], 1)
+
+
+class TestProfileStage(TestCase):
+    """Test cases for profile_stage()"""
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        # Disable profiling again
+        grapple._profile['stages'] = None
+
+    def test_disabled(self):
+        """Should not record anything when profiling is disabled"""
+
+        with grapple.profile_stage('sleep', [], []) as record:
+            self.assertIsNone(record)
+
+    def test_process_tree(self):
+        """Should record the time and memory used by the processes the stage runs"""
+
+        stages = grapple.start_profiling()
+
+        with grapple.profile_stage('allocate', [], []) as record:
+            record['output'] = os.path.join('test_files', 'lambda_ref.fa')
+
+            grapple.run_command([sys.executable, '-c', 'import time; block = bytearray(64 << 20); time.sleep(1)'])
+
+        self.assertEqual(len(stages), 1)
+        self.assertEqual(stages[0]['stage'], 'allocate')
+        self.assertGreaterEqual(stages[0]['wall_time'], 1)
+        self.assertGreater(stages[0]['peak_rss'], 64 << 20)
+        self.assertEqual(stages[0]['outputs'][0]['size'], os.path.getsize(os.path.join('test_files', 'lambda_ref.fa')))
+
+    def test_overlap(self):
+        """Should only charge each of two overlapping stages for the processes it started"""
+
+        stages = grapple.start_profiling()
+
+        def stage(name, size):
+            """Profile a stage allocating the given number of bytes alongside the other stage"""
+
+            with grapple.profile_stage(name, [], []):
+                grapple.run_command([sys.executable, '-c', 'import time; block = bytearray(' + str(size) + '); '
+                                                           'block[::4096] = b"x" * len(block[::4096]); time.sleep(1)'])
+
+        threads = [threading.Thread(target=stage, args=('large', 96 << 20)),
+                   threading.Thread(target=stage, args=('small', 0))]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        records = dict((record['stage'], record) for record in stages)
+
+        self.assertTrue(records['large']['shared'] and records['small']['shared'])
+        self.assertGreater(records['large']['peak_rss'], 96 << 20)
+        self.assertLess(records['small']['peak_rss'], 64 << 20)
+
+
+class TestSampleStages(TestCase):
+    """Test cases for sample_stages()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._read_dir = tempfile.mkdtemp()
+        self._read_file = os.path.join(self._read_dir, 'reads.fq')
+        self._copy_file = os.path.join(self._read_dir, 'copy.fq')
+
+        with open(self._read_file, 'wb') as read_handle:
+            read_handle.write(b'@read\nACGTACGTAC\n+\nIIIIIIIIII\n' * 1000)
+
+        grapple._metrics['stages'] = {}
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        grapple._metrics['stages'] = None
+        shutil.rmtree(self._read_dir)
+
+    def test_progress(self):
+        """Should measure how far a stage has read its input and how many records it has written"""
+
+        script = ('import sys, time\nsource = open(sys.argv[1], "rb")\ndestination = open(sys.argv[2], "wb")\n'
+                  'destination.write(source.read(9000))\ndestination.flush()\nprint("")\nsys.stdout.flush()\n'
+                  'time.sleep(5)\n')
+
+        with grapple.monitor_stage('copy', [self._read_file]):
+            process = subprocess.Popen([sys.executable, '-c', script, self._read_file, self._copy_file],
+                                       stdout=subprocess.PIPE)
+
+            try:
+                # Wait for the copy to reach its pause
+                process.stdout.readline()
+                samples = grapple.sample_stages({})
+
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+
+        stage, metrics = samples[0]
+
+        self.assertEqual(stage, 'copy')
+        self.assertEqual(metrics['input_size_bytes'], 30000)
+        self.assertEqual(metrics['output_bytes'], 9000)
+        self.assertEqual(metrics['records'], 300)
+        self.assertGreater(metrics['progress_ratio'], 0)
+
+
+class TestWriteMetrics(TestCase):
+    """Test cases for write_metrics()"""
+
+    def test_format(self):
+        """Should write a gauge of each metric labelled with its stage, ending with an EOF marker"""
+
+        metrics_dir = tempfile.mkdtemp()
+        metrics_file = os.path.join(metrics_dir, 'grapple.prom')
+
+        try:
+            grapple.write_metrics(metrics_file, [('bam_to_fq', {'records': 250, 'progress_ratio': 0.25})])
+
+            with open(metrics_file) as metrics_handle:
+                lines = metrics_handle.read().splitlines()
+
+        finally:
+            shutil.rmtree(metrics_dir)
+
+        self.assertIn('# TYPE grapple_stage_records gauge', lines)
+        self.assertIn('grapple_stage_records{stage="bam_to_fq"} 250', lines)
+        self.assertIn('grapple_stage_progress_ratio{stage="bam_to_fq"} 0.25', lines)
+        self.assertEqual(lines[-1], '# EOF')
+
+
+class TestExportMetrics(TestCase):
+    """Test cases for export_metrics()"""
+
+    def test_failed_update(self):
+        """Should keep publishing the metrics after an update fails"""
+
+        metrics_dir = tempfile.mkdtemp()
+        metrics_file = os.path.join(metrics_dir, 'grapple.prom')
+        sample_stages = grapple.sample_stages
+        published = threading.Event()
+        calls = []
+
+        def failing_sample(record_sizes):
+            """Fail the first update and report a running stage afterwards"""
+
+            calls.append(record_sizes)
+
+            if len(calls) == 1:
+                raise OSError('The stage finished while it was sampled')
+
+            if len(calls) > 2:
+                published.set()
+
+            return [('bam_to_fq', {'records': 250})]
+
+        grapple.sample_stages = failing_sample
+
+        try:
+            with grapple.export_metrics(metrics_file, interval=0.01):
+                self.assertTrue(published.wait(5))
+
+                with open(metrics_file) as metrics_handle:
+                    self.assertIn('grapple_stage_records{stage="bam_to_fq"} 250', metrics_handle.read())
+
+        finally:
+            grapple.sample_stages = sample_stages
+            shutil.rmtree(metrics_dir)
+
+
+class TestCountReads(TestCase):
+    """Test cases for count_reads()"""
+
+    def test_valid_file(self):
+        """Should count four lines per read"""
+
+        with tempfile.NamedTemporaryFile(suffix='.fq') as read_handle:
+            read_handle.write(b'@first\nACGT\n+\nIIII\n@second\nTTGA\n+\nIIII\n')
+            read_handle.flush()
+
+            self.assertEqual(grapple.count_reads(read_handle.name), 2)
+
+    def test_compressed_file(self):
+        """Should count the reads of a gzip compressed file"""
+
+        read_dir = tempfile.mkdtemp()
+        read_file = os.path.join(read_dir, 'reads.fq.gz')
+
+        try:
+            with gzip.open(read_file, 'wb') as read_handle:
+                read_handle.write(b'@first\nACGT\n+\nIIII\n')
+
+            self.assertEqual(grapple.count_reads(read_file), 1)
+
+        finally:
+            shutil.rmtree(read_dir)
+
+
+class TestSimulateReads(TestCase):
+    """Test cases for benchmark.simulate_reads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Available reference file
+        self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+        self._read_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._read_dir)
+
+    def _simulate(self, name, **kwargs):
+        """Simulate reads into a file and return the number of reads and the contents of the file"""
+
+        read_file = os.path.join(self._read_dir, name)
+        count = benchmark.simulate_reads(self._ref_file, read_file, **kwargs)
+
+        with open(read_file) as read_handle:
+            return count, read_handle.read()
+
+    def test_depth(self):
+        """Should generate enough reads to reach the requested depth"""
+
+        count, reads = self._simulate('reads.fq', read_length=100, depth=10, error_rate=0)
+
+        self.assertEqual(count, 4850)
+        self.assertEqual(reads.count('\n'), count * 4)
+
+    def test_seed(self):
+        """Should generate the same reads from the same seed"""
+
+        self.assertEqual(self._simulate('first.fq', depth=1, seed=1), self._simulate('second.fq', depth=1, seed=1))
+        self.assertNotEqual(self._simulate('first.fq', depth=1, seed=1), self._simulate('second.fq', depth=1, seed=2))
+
+
+class TestCompare(TestCase):
+    """Test cases for benchmark.compare()"""
+
+    def test_tolerance(self):
+        """Should report only the timings exceeding their baseline by more than the tolerance"""
+
+        baseline = {'pipeline': 1.0, 'stages': {'bam_to_fq': 0.2, 'read_alignment': 0.5}}
+        results = {'pipeline': 1.1, 'stages': {'bam_to_fq': 0.3, 'read_alignment': 0.55}}
+
+        regressions = benchmark.compare(results, baseline, 0.2)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('bam_to_fq'))
+
+    def test_calibration(self):
+        """Should scale the baseline by the speed of the machine it was taken on"""
+
+        baseline = {'pipeline': 1.0, 'stages': {}, 'calibration': 0.01}
+
+        self.assertEqual(benchmark.compare({'pipeline': 1.9, 'stages': {}, 'calibration': 0.02}, baseline, 0), [])
+        self.assertEqual(len(benchmark.compare({'pipeline': 1.9, 'stages': {}, 'calibration': 0.01}, baseline, 0)), 1)
+
+    def test_stub_bam(self):
+        """Should package the reads for the stand-ins as a file detected as BAM"""
+
+        read_dir = tempfile.mkdtemp()
+
+        try:
+            read_file = os.path.join(read_dir, 'reads.fq')
+            bam_file = os.path.join(read_dir, 'reads.bam')
+
+            benchmark.simulate_reads(os.path.join('test_files', 'lambda_ref.fa'), read_file, depth=1)
+            benchmark.fastq_to_bam(read_file, bam_file, True)
+
+            self.assertEqual(grapple.read_format(bam_file), 'bam')
+
+        finally:
+            shutil.rmtree(read_dir)
+
+
+class TestReadBatch(TestCase):
+    """Test cases for read_batch()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        handle, self._batch_file = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        os.remove(self._batch_file)
+
+    def _write(self, text):
+        """Write the batch manifest"""
+
+        with open(self._batch_file, 'w') as handle:
+            handle.write(text)
+
+    def test_valid_file(self):
+        """Should read every sample, defaulting the consensus file and skipping comments and blank lines"""
+
+        self._write('# Samples\nfirst.bam\tfirst.fa\n\nsecond.bam\nthird.fastq.gz\n')
+
+        self.assertEqual(grapple.read_batch(self._batch_file),
+                         [('first.bam', 'first.fa'), ('second.bam', 'second.consensus.fa'),
+                          ('third.fastq.gz', 'third.consensus.fa')])
+
+    def test_extra_fields(self):
+        """Should raise an exception when a line has more than two fields"""
+
+        self._write('first.bam first.fa extra\n')
+
+        with self.assertRaises(ValueError):
+            grapple.read_batch(self._batch_file)
+
+    def test_empty_file(self):
+        """Should raise an exception when no samples are listed"""
+
+        self._write('# No samples\n')
+
+        with self.assertRaises(ValueError):
+            grapple.read_batch(self._batch_file)
+
+    def test_absent_file(self):
+        """Should raise an exception when the manifest does not exist"""
+
+        with self.assertRaises(IOError):
+            grapple.read_batch('this_file_does_not_exist.txt')
+
+
+class TestAssembleSample(TestCase):
+    """Test cases for assemble_sample()"""
+
+    def test_absent_file(self):
+        """Should report a failure rather than raise an exception when the read file does not exist"""
+
+        args = {'resume': None, 'profile': None}
+        job = (0, 'this_file_does_not_exist.bam', 'consensus.fa', os.path.join('test_files', 'lambda_ref.fa'),
+               None, args)
+
+        number, read_file, output_file, message, stages = grapple.assemble_sample(job)
+
+        self.assertEqual((number, read_file, output_file), job[:3])
+        self.assertIsNotNone(message)
+
+    def test_unexpected_error(self):
+        """Should report a failure rather than raise an exception when the assembly fails unexpectedly"""
+
+        args = {'resume': None, 'profile': None, 'metrics': None, 'progress': False, 'metrics_interval': 10.0,
+                'scratch': None, 'small_scratch': None}
+        job = (0, os.path.join('test_files', 'lambda_ref.fa'), 'consensus.fa',
+               os.path.join('test_files', 'lambda_ref.fa'), None, args)
+        assemble = grapple.assemble
+        scratch_size = grapple.scratch_size
+
+        def failing_assemble(*arguments):
+            """Fail with an exception none of the expected handlers catch"""
+
+            raise KeyError()
+
+        grapple.assemble = failing_assemble
+        grapple.scratch_size = lambda read_file, args: 0
+
+        try:
+            number, read_file, output_file, message, stages = grapple.assemble_sample(job)
+
+        finally:
+            grapple.assemble = assemble
+            grapple.scratch_size = scratch_size
+
+        self.assertEqual((number, read_file, output_file), job[:3])
+        self.assertEqual(message, 'KeyError')
+
+
+class TestConfigure(TestCase):
+    """Test cases for configure()"""
+
+    def test_defaults(self):
+        """Should fill in the options not given with the command line defaults"""
+
+        args = grapple.configure(ref='ref.fa', threads='4')
+
+        self.assertEqual(args['ref'], 'ref.fa')
+        self.assertEqual(args['threads'], 4)
+        self.assertEqual(args['ploidy'], 'n')
+        self.assertFalse(args['disable_ec'])
+
+    def test_invalid_options(self):
+        """Should raise an exception for unknown options, values of the wrong type and invalid choices"""
+
+        self.assertRaises(ValueError, grapple.configure, reference='ref.fa')
+        self.assertRaises(ValueError, grapple.configure, threads='many')
+        self.assertRaises(ValueError, grapple.configure, ploidy='3n')
+        self.assertRaises(ValueError, grapple.configure, threads=0)
+
+    def test_every_option(self):
+        """Should take every option of the command line, and only those"""
+
+        self.assertEqual(sorted(grapple.configure()), sorted(grapple._FLAG_OPTIONS + grapple._VALUE_OPTIONS))
+
+    def test_unset_option(self):
+        """Should leave an option given as None unset and take flags as truth values"""
+
+        args = grapple.configure(ploidy=None, trim=1, stream=0)
+
+        self.assertIsNone(args['ploidy'])
+        self.assertIs(args['trim'], True)
+        self.assertIs(args['stream'], False)
+
+
+class TestPipeline(TestCase):
+    """Test cases for Pipeline"""
+
+    def test_absent_reference(self):
+        """Should raise a PipelineError when the reference genome does not exist"""
+
+        self.assertRaises(grapple.PipelineError, grapple.Pipeline, ref='this_file_does_not_exist.fa')
+
+    def test_absent_file(self):
+        """Should raise a PipelineError holding its cause when the read file does not exist"""
+
+        with grapple.Pipeline(ref=os.path.join('test_files', 'lambda_ref.fa')) as pipeline:
+            with self.assertRaises(grapple.PipelineError) as context:
+                pipeline.run('this_file_does_not_exist.bam', 'consensus.fa')
+
+        self.assertIsInstance(context.exception.cause, EnvironmentError)
+
+
+class TestJobServer(TestCase):
+    """Test cases for JobServer"""
+
+    class FakePipeline(object):
+        """Pipeline recording its jobs instead of running them"""
+
+        def __init__(self):
+            self.jobs = []
+
+        def run(self, read_file, output_file):
+            if not os.path.isfile(read_file):
+                raise grapple.PipelineError('The read file does not exist')
+
+            self.jobs.append((read_file, output_file))
+
+            return {'input': read_file, 'consensus': output_file, 'seconds': 0, 'stages': None}
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._dir = tempfile.mkdtemp()
+        self._socket = os.path.join(self._dir, 'grapple.sock')
+        self._pipeline = self.FakePipeline()
+        self._server = grapple.JobServer(self._socket, self._pipeline)
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+        shutil.rmtree(self._dir)
+
+    def test_job(self):
+        """Should run the job with absolute paths and answer with its result"""
+
+        read_file = os.path.join(self._dir, 'reads.bam')
+        open(read_file, 'w').close()
+
+        result = grapple.submit_job(self._socket, os.path.relpath(read_file))
+
+        self.assertEqual(result['consensus'], os.path.join(self._dir, 'reads.consensus.fa'))
+        self.assertEqual(self._pipeline.jobs, [(read_file, result['consensus'])])
+
+    def test_failure(self):
+        """Should raise the error of a failed job"""
+
+        self.assertRaises(grapple.PipelineError, grapple.submit_job, self._socket, 'this_file_does_not_exist.bam')
+
+    def test_listening(self):
+        """Should refuse to replace the socket of a server which is still listening"""
+
+        self.assertRaises(ValueError, grapple.JobServer, self._socket, self._pipeline)
+
+
+class TestPreflight(TestCase):
+    """Test cases for preflight()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._dir = tempfile.mkdtemp()
+        self._log = os.path.join(self._dir, 'probes.log')
+        self._path = os.environ['PATH']
+        self._args = grapple.configure(disable_ec=True)
+
+        # Stand-ins printing their version and the usage of their subcommands
+        usage = ' $1 [-b] [-f FILE] [-l INT] [-m INT] [-o FILE] [-r REG] [-T PREFIX] [-u] [-v] [-O TYPE]'
+
+        for tool, version in (('samtools', '1.9'), ('bcftools', '1.9'), ('bowtie2', '2.3.5'),
+                              ('bowtie2-build', '2.3.5')):
+            self._install(tool, version, 'Usage: ' + tool + usage)
+
+        os.environ['PATH'] = self._dir
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        os.environ['PATH'] = self._path
+        grapple._tool_versions.clear()
+        shutil.rmtree(self._dir)
+
+    def _install(self, tool, version, usage):
+        """
+        Install a stand-in for a utility which logs each time it is run. Like samtools, its sort and view read
+        stdin instead of printing their usage unless stdin is a terminal.
+        """
+
+        path = os.path.join(self._dir, tool)
+
+        with open(path, 'w') as tool_handle:
+            tool_handle.write('#!/bin/sh\necho "$0 $1" >> ' + self._log + '\nif [ "$1" = --version ]; then echo "' +
+                              tool + ' ' + version + '"; elif [ "$1" = sort -o "$1" = view ] && [ ! -t 0 ]; then ' +
+                              'cat > /dev/null; else echo "' + usage + '"; fi\n')
+
+        os.chmod(path, 0o755)
+
+    def _preflight(self):
+        """Run the preflight check, returning how many times the utilities were run"""
+
+        open(self._log, 'w').close()
+        grapple.preflight(self._args, os.path.join(self._dir, 'toolchain.json'))
+
+        with open(self._log) as log_handle:
+            return len(log_handle.readlines())
+
+    def test_cache(self):
+        """Should only probe the utilities again once they change"""
+
+        self.assertGreater(self._preflight(), 0)
+        self.assertEqual(self._preflight(), 0)
+
+        os.utime(os.path.join(self._dir, 'samtools'), (0, 0))
+
+        self.assertEqual(self._preflight(), 1 + len(grapple.required_tools(self._args)['samtools']))
+
+    def test_missing_tool(self):
+        """Should fail when a utility is not installed"""
+
+        os.remove(os.path.join(self._dir, 'bcftools'))
+
+        with self.assertRaises(ValueError) as context:
+            self._preflight()
+
+        self.assertIn('bcftools utility is not installed', str(context.exception))
+
+    def test_old_version(self):
+        """Should fail when a utility is older than the pipeline supports"""
+
+        self._install('bowtie2', '1.2.3', 'Usage: bowtie2')
+
+        with self.assertRaises(ValueError) as context:
+            self._preflight()
+
+        self.assertIn('bowtie2 utility is version 1.2', str(context.exception))
+
+    def test_missing_option(self):
+        """Should fail when a subcommand does not accept an option the pipeline uses"""
+
+        self._install('samtools', '1.10',
+                      'Usage: samtools $1 [-b] [-f FILE] [-l INT] [-m INT] [-o FILE] [-r REG] [-T PREFIX]')
+
+        with self.assertRaises(ValueError) as context:
+            self._preflight()
+
+        self.assertIn('mpileup does not accept -u', str(context.exception))
+
+    def test_missing_sort_option(self):
+        """Should fail when samtools sort does not accept an option the pipeline uses"""
+
+        self._install('samtools', '1.10', 'Usage: samtools $1 [-b] [-f FILE] [-m INT] [-o FILE] [-r REG] [-T PREFIX] '
+                                          '[-u]')
+
+        with self.assertRaises(ValueError) as context:
+            self._preflight()
+
+        self.assertIn('sort does not accept -l', str(context.exception))
+
+    def test_unresponsive_tool(self):
+        """Should stop and report a subcommand which never exits, and probe it again on the next run"""
+
+        path = os.path.join(self._dir, 'bcftools')
+
+        with open(path, 'w') as tool_handle:
+            tool_handle.write('#!/bin/sh\necho "$0 $1" >> ' + self._log + '\nif [ "$1" = --version ]; then ' +
+                              'echo "bcftools 1.9"; else while :; do :; done; fi\n')
+
+        probe_timeout = grapple._PROBE_TIMEOUT
+        grapple._PROBE_TIMEOUT = 0.5
+
+        try:
+            for _ in range(2):
+                with self.assertRaises(ValueError) as context:
+                    self._preflight()
+
+                self.assertIn('bcftools utility does not respond', str(context.exception))
+
+        finally:
+            grapple._PROBE_TIMEOUT = probe_timeout
+
+        with open(self._log) as log_handle:
+            self.assertEqual(len([line for line in log_handle if 'bcftools' in line]),
+                             len(grapple.required_tools(self._args)['bcftools']))
+
+
+class TestFileExtension(TestCase):
+    """Test cases for file_extension()"""
+
+    def test_extensions(self):
+        """Should include the format of gzip compressed files in their extension"""
+
+        self.assertEqual(grapple.file_extension(os.path.join('runs', 'reads.fq')), '.fq')
+        self.assertEqual(grapple.file_extension(os.path.join('runs.1', 'reads.fastq.gz')), '.fastq.gz')
+        self.assertEqual(grapple.file_extension('reads.bam'), '.bam')
+
+
+class TestBamLevel(TestCase):
+    """Test cases for bam_level()"""
+
+    def test_policies(self):
+        """Should translate each encoding policy into the compression options of samtools"""
+
+        self.assertEqual(grapple.bam_level('plain', 'view'), [])
+        self.assertEqual(grapple.bam_level('uncompressed', 'view'), ['-u'])
+        self.assertEqual(grapple.bam_level('uncompressed', 'sort'), ['-l', '0'])
+        self.assertEqual(grapple.bam_level('fast', 'view'), ['-1'])
+        self.assertEqual(grapple.bam_level('fast', 'sort'), ['-l', '1'])
+
+
+class TestReadFormat(TestCase):
+    """Test cases for read_format() and typed_reads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._test_dir)
+
+    def _write(self, name, data, compress=False):
+        """Write a read file in the test directory"""
+
+        path = os.path.join(self._test_dir, name)
+
+        with (gzip.open if compress else open)(path, 'wb') as handle:
+            handle.write(data)
+
+        return path
+
+    def test_formats(self):
+        """Should identify each format from the contents of the file regardless of its extension"""
+
+        fastq = b'@read\nACGT\n+\nIIII\n'
+
+        self.assertEqual(grapple.read_format(self._write('reads.dat', b'BAM\x01\x00\x00', True)), 'bam')
+        self.assertEqual(grapple.read_format(self._write('reads.bam', b'CRAM\x03\x00')), 'cram')
+        self.assertEqual(grapple.read_format(self._write('reads.bam', b'@HD\tVN:1.6\n')), 'sam')
+        self.assertEqual(grapple.read_format(self._write('reads.bam', fastq)), 'fastq')
+        self.assertEqual(grapple.read_format(self._write('reads.bam', fastq, True)), 'fastq.gz')
+        self.assertEqual(grapple.read_format('-'), 'bam')
+
+    def test_unknown_format(self):
+        """Should not identify a reference genome or an empty file as reads"""
+
+        self.assertIsNone(grapple.read_format(os.path.join('test_files', 'lambda_ref.fa')))
+        self.assertIsNone(grapple.read_format(self._write('reads.fq', b'')))
+
+        with self.assertRaises(ValueError) as context:
+            grapple.typed_reads(os.path.join('test_files', 'lambda_ref.fa'))
+
+        self.assertIn('BAM, CRAM, SAM or FASTQ', str(context.exception))
+
+    def test_absent_file(self):
+        """Should raise an exception when the file does not exist"""
+
+        with self.assertRaises(IOError):
+            grapple.read_format('this_file_does_not_exist.bam')
+
+    def test_link(self):
+        """Should link the reads under the extension of their format only when their own does not match"""
+
+        fastq = self._write('reads.fastq.gz', b'@read\nACGT\n+\nIIII\n', True)
+        self.assertEqual(grapple.typed_reads(fastq), (fastq, 'fastq.gz'))
+
+        misnamed = self._write('reads.bam', b'@read\nACGT\n+\nIIII\n', True)
+        prefix = os.path.join(self._test_dir, 'run_')
+        link, file_format = grapple.typed_reads(misnamed, prefix)
+
+        self.assertEqual((link, file_format), (prefix + 'input_reads.fq.gz', 'fastq.gz'))
+        self.assertEqual(os.path.realpath(link), os.path.realpath(misnamed))
+
+
+class TestBamToFq(TestCase):
+    """Tests involving bam_to_fq()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Available test file
+        self._test_file = os.path.join('test_files', 'lambda_iontorrent.bam')
+
+    def test_valid_file(self):
+        """Should not raise an exception when a valid bam file is used"""
+
+        try:
+            grapple.bam_to_fq(self._test_file)
+
+        except Exception as e:
+            self.fail(e)
+
+    def test_invalid_file(self):
+        """Should raise an exception when the wrong type of file is used"""
+
+        with self.assertRaises(ValueError) as context:
+            grapple.bam_to_fq(os.path.join('test_files', 'lambda_ref.fa'))
+
+        self.assertIn('BAM, CRAM or SAM', str(context.exception))
+
+    def test_absent_file(self):
+        """Should raise an exception when the file does not exist"""
+
+        with self.assertRaises(CalledProcessError):
+            grapple.bam_to_fq('this_file_does_not_exist.bam')
+
+    def test_no_file(self):
+        """Should raise an exception when no file is given"""
+
+        with self.assertRaises(ValueError):
+            grapple.bam_to_fq('')
+
+    def test_none_file(self):
+        """Should raise an exception when None is given"""
+
+        with self.assertRaises(AttributeError):
+            grapple.bam_to_fq(None)
+
+    def test_bad_prefix(self):
+        """Should raise an exception when a type that cannot be converted to a string is used as the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.bam_to_fq(self._test_file, prefix_id=0)
+
+    def test_none_prefix(self):
+        """Should raise an exception when None is used as the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.bam_to_fq(self._test_file, prefix_id=None)
+
+    def test_compressed_stub(self):
+        """Should gzip compress the FASTQ in process under a compressing encoding, using stand-in utilities"""
+
+        stub_dir = tempfile.mkdtemp()
+        environment = dict(os.environ)
+
+        try:
+            benchmark.install_stubs(stub_dir)
+
+            read_file = os.path.join(stub_dir, 'reads.fq')
+            bam_file = os.path.join(stub_dir, 'reads.bam')
+
+            benchmark.simulate_reads(os.path.join('test_files', 'lambda_ref.fa'), read_file, depth=1)
+            benchmark.fastq_to_bam(read_file, bam_file, True)
+
+            with grapple.workspace(scratch_dir=stub_dir):
+                fastq_file = grapple.bam_to_fq(bam_file, encoding='fast')
+
+                with gzip.open(fastq_file, 'rb') as fastq_handle, open(read_file, 'rb') as read_handle:
+                    self.assertEqual(fastq_handle.read(), read_handle.read())
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+            shutil.rmtree(stub_dir)
+
+
+class TestTrimBatch(TestCase):
+    """Test cases for trim_batch()"""
+
+    def test_trimming(self):
+        """Should cut each read at its first low quality window and drop the short and unknown reads"""
+
+        sequences = [b'ACGTACGTAC', b'NNNNNNNNNN', b'ACG', b'ACGTACGTAC', b'ACNTACGTAC']
+        qualities = [b'IIIIII####', b'IIIIIIIIII', b'III', b'IIIIIIIIII', b'IIIIIIIIII']
+
+        lengths = grapple.trim_batch(sequences, qualities, window=4, min_quality=20, min_length=3, max_n=0.1)
+
+        self.assertEqual(list(lengths), [5, 0, 3, 10, 10])
+
+    def test_blocks(self):
+        """Should trim a batch larger than the matrix size in blocks with the same result"""
+
+        sequences = [b'ACGTACGTAC', b'NNNNNNNNNN', b'ACG', b'ACGTACGTAC', b'ACNTACGTAC']
+        qualities = [b'IIIIII####', b'IIIIIIIIII', b'III', b'IIIIIIIIII', b'IIIIIIIIII']
+        trim_cells = grapple._TRIM_CELLS
+        grapple._TRIM_CELLS = 20
+
+        try:
+            lengths = grapple.trim_batch(sequences, qualities, window=4, min_quality=20, min_length=3, max_n=0.1)
+
+        finally:
+            grapple._TRIM_CELLS = trim_cells
+
+        self.assertEqual(list(lengths), [5, 0, 3, 10, 10])
+
+    def test_empty_batch(self):
+        """Should handle a batch without any bases"""
+
+        self.assertEqual(list(grapple.trim_batch([b''], [b''])), [0])
+
+
+class TestTrimReads(TestCase):
+    """Test cases for trim_reads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._read_dir = tempfile.mkdtemp()
+        self._read_file = os.path.join(self._read_dir, 'reads.fq')
+
+        with open(self._read_file, 'wb') as read_handle:
+            read_handle.write(b'@good\nACGTACGTAC\n+\nIIIIIIIIII\n@tail\nACGTACGTAC\n+\nIIIIII####\n'
+                              b'@unknown\nNNNNNNNNNN\n+\nIIIIIIIIII\n')
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._read_dir)
+
+    def _trim(self, read_file, encoding='plain'):
+        """Trim the reads in batches smaller than the file and return the trimmed reads"""
+
+        trimmed_file = grapple.trim_reads(read_file, encoding=encoding, min_length=3, batch_size=2)
+
+        try:
+            with (gzip.open if trimmed_file.endswith('.gz') else open)(trimmed_file, 'rb') as trimmed_handle:
+                return trimmed_handle.read()
+
+        finally:
+            os.remove(trimmed_file)
+
+    def test_valid_file(self):
+        """Should write the trimmed reads which pass the filters"""
+
+        self.assertEqual(self._trim(self._read_file), b'@good\nACGTACGTAC\n+\nIIIIIIIIII\n@tail\nACGTA\n+\nIIIII\n')
+
+    def test_compressed_file(self):
+        """Should read and write gzip compressed reads"""
+
+        compressed_file = self._read_file + '.gz'
+
+        with open(self._read_file, 'rb') as read_handle, gzip.open(compressed_file, 'wb') as compressed_handle:
+            shutil.copyfileobj(read_handle, compressed_handle)
+
+        self.assertEqual(self._trim(compressed_file, 'gzip'), self._trim(self._read_file))
+
+    def test_invalid_file(self):
+        """Should raise an exception when the wrong type of file is used"""
+
+        with self.assertRaises(ValueError):
+            grapple.trim_reads(os.path.join('test_files', 'lambda_ref.fa'))
+
+    def test_truncated_file(self):
+        """Should raise an exception when a read is cut short"""
+
+        with open(self._read_file, 'ab') as read_handle:
+            read_handle.write(b'@cut\nACGT\n')
+
+        with self.assertRaises(ValueError):
+            with grapple.workspace():
+                grapple.trim_reads(self._read_file)
+
+
+class TestDownsampleReads(TestCase):
+    """Test cases for downsample_reads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._read_dir = tempfile.mkdtemp()
+        self._read_file = os.path.join(self._read_dir, 'reads.fq')
+        self._ref_file = os.path.join(self._read_dir, 'ref.fa')
+
+        with open(self._read_file, 'wb') as read_handle:
+            for number in range(2000):
+                read_handle.write(b'@read' + str(number).encode() + b'\nACGTACGTAC\n+\nIIIIIIIIII\n')
+
+        # A 100 base genome covered 200 times over by the reads
+        with open(self._ref_file, 'w') as ref_handle:
+            ref_handle.write('>first\n' + 'ACGTACGTAC' * 4 + '\n>second\n' + 'ACGTACGTAC' * 6 + '\n')
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._read_dir)
+
+    def _downsample(self, max_depth, seed=0):
+        """Downsample the reads in batches smaller than the file and return the kept reads"""
+
+        downsampled_file = grapple.downsample_reads(self._read_file, self._ref_file, max_depth, seed=seed,
+                                                    batch_size=150)
+
+        try:
+            with open(downsampled_file, 'rb') as downsampled_handle:
+                return downsampled_handle.read().splitlines()[::4]
+
+        finally:
+            os.remove(downsampled_file)
+
+    def test_depth(self):
+        """Should keep about as many reads as the maximum depth requires"""
+
+        headers = self._downsample(20)
+
+        self.assertTrue(150 <= len(headers) <= 250)
+        self.assertEqual(len(set(headers)), len(headers))
+
+    def test_seed(self):
+        """Should keep the same reads with the same seed"""
+
+        self.assertEqual(self._downsample(20), self._downsample(20))
+        self.assertNotEqual(self._downsample(20), self._downsample(20, seed=1))
+
+    def test_shallow_sample(self):
+        """Should keep every read of a sample shallower than the maximum depth"""
+
+        self.assertEqual(len(self._downsample(500)), 2000)
+
+    def test_invalid_depth(self):
+        """Should raise an exception when the maximum depth is not positive"""
+
+        with self.assertRaises(ValueError):
+            grapple.downsample_reads(self._read_file, self._ref_file, 0)
+
+
+class TestSplitReads(TestCase):
+    """Test cases for split_reads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._read_dir = tempfile.mkdtemp()
+        self._read_file = os.path.join(self._read_dir, 'reads.fq')
+
+        # Reads starting with alternating k-mers, so clustering has to reorder them
+        self._reads = [b'@' + str(number).encode() + b'\n' + (b'AAAA' if number % 2 else b'TTTT') +
+                       b'CGCG\n+\nIIIIIIII\n' for number in range(8)]
+
+        with open(self._read_file, 'wb') as read_handle:
+            read_handle.write(b''.join(self._reads))
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._read_dir)
+
+    def _split(self, chunk_size, cluster=False):
+        """Split the reads in batches smaller than the file and return the reads of each chunk"""
+
+        chunks = []
+
+        with grapple.workspace(scratch_dir=self._read_dir):
+            for chunk_file in grapple.split_reads(self._read_file, chunk_size, cluster=cluster, batch_size=3):
+                with open(chunk_file, 'rb') as chunk_handle:
+                    chunks.append(chunk_handle.read())
+
+        return chunks
+
+    def test_order(self):
+        """Should split the reads into chunks of the given size in their original order"""
+
+        chunks = self._split(2 * len(self._reads[0]))
+
+        self.assertEqual(chunks, [b''.join(self._reads[start:start + 2]) for start in range(0, 8, 2)])
+
+    def test_cluster(self):
+        """Should keep the reads starting with the same k-mer in the same chunk"""
+
+        chunks = self._split(4 * len(self._reads[0]), cluster=True)
+
+        self.assertEqual(chunks, [b''.join(self._reads[1::2]), b''.join(self._reads[::2])])
+
+
+class TestReadCorrection(TestCase):
+    """Tests involving read_correction()"""
+
+    def setUp(self):
+        """Setup code before tests"""
+
+        # Available test file
+        self._test_file = os.path.join('test_files', 'lambda_reads.fq')
+
+    def test_valid_file(self):
+        """Should not raise an exception when a valid FASTQ file is used"""
+
+        try:
+            grapple.read_correction(self._test_file)
+
+        except Exception as e:
+            self.fail(e)
+
+    def test_invalid_file(self):
+        """Should raise an exception when a file with the wrong format is used"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_correction(os.path.join('test_files', 'lambda_ref.fa'))
+
+    def test_absent_file(self):
+        """Should raise an exception when the file is not found"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_correction('this_file_does_not_exit.fq')
+
+    def test_none_file(self):
+        """Should raise an exception when None is passed as for the file"""
+
+        with self.assertRaises(AttributeError):
+            grapple.read_correction(None)
+
+    def test_invalid_cell_type(self):
+        """Should raise an exception when an invalid cell type is given"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_correction(self._test_file, cell_type='not_a_cell_type')
+
+    def test_none_cell_type(self):
+        """Should raise an exception when None is passed for the cell type"""
+
+        with self.assertRaises(TypeError):
+            grapple.read_correction(self._test_file, cell_type=None)
+
+    def test_invalid_match_type(self):
+        """Should raise an exception when an invalid match type is given"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_correction(self._test_file, match_type='not_a_match_type')
+
+    def test_none_match_type(self):
+        """Should raise an exception when None is given as a match type"""
+
+        with self.assertRaises(TypeError):
+            grapple.read_correction(self._test_file, match_type=None)
+
+
+class TestAlignment(TestCase):
+    """Unit tests for read_alignment()"""
+
+    def setUp(self):
+        """Setup code for tests"""
+
+        # Available test file
+        self._test_file = os.path.join('test_files', 'lambda_reads.fq')
+
+        # Available reference file
+        self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+    def test_valid_files(self):
+        """Should not raise an exception when valid files are given as input"""
+
+        try:
+            grapple.read_alignment(self._test_file, self._ref_file)
+
+        except Exception as e:
+            self.fail(e)
+
+    def test_invalid_read_file(self):
+        """Should raise an exception when the read file is formatted wrong"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_alignment(self._ref_file, self._ref_file)
+
+    def test_absent_read_file(self):
+        """Should raise an exception when the read file is absent"""
+
+        with self.assertRaises(CalledProcessError):
+            grapple.read_alignment('this_file_does_not_exist.fq', self._ref_file)
+
+    def test_none_read_file(self):
+        """Should raise an exception when None is passed as the read_file"""
+
+        with self.assertRaises(AttributeError):
+            grapple.read_alignment(None, self._ref_file)
+
+    def test_invalid_ref_file(self):
+        """Should raise an exception when the reference file is in the wrong format"""
+
+        with self.assertRaises(ValueError):
+            grapple.read_alignment(self._test_file, self._test_file)
+
+    def test_absent_ref_file(self):
+        """Should raise an exception when the reference file doesn't exist"""
+
+        with self.assertRaises(CalledProcessError):
+            grapple.read_alignment(self._test_file, 'this_file_does_not_exist.fa')
+
+    def test_none_ref_file(self):
+        """Should raise an exception when None is given as the reference file"""
+
+        with self.assertRaises(AttributeError):
+            grapple.read_alignment(self._test_file, None)
+
+    def test_bad_prefix(self):
+        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.read_alignment(self._test_file, self._ref_file, prefix_id=0)
+
+    def test_none_prefix(self):
+        """Should raise an exception when None is used as the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.read_alignment(self._test_file, self._ref_file, prefix_id=None)
+
+
+class TestSamToBam(TestCase):
+    """Test cases for sam_to_bam() conversion"""
 
     def setUp(self):
         """Setup code for test cases"""
 
-        # Available test file
-        self._test_file = os.path.join('test_files', 'lambda_iontorrent.bam')
+        # Available test files
+        self._test_file = os.path.join('test_files', 'aligned_lambda.sam')
 
     def test_valid_file(self):
-        """Should not raise an exception when a valid bam file is used"""
+        """Should not raise an exception when a valid file is to be converted"""
 
         try:
-            grapple.bam_to_fq(self._test_file)
+            grapple.sam_to_bam(self._test_file)
 
         except Exception as e:
             self.fail(e)
 
     def test_invalid_file(self):
-        """Should raise an exception when the wrong type of file is used"""
+        """Should raise an exception when a file with the wrong format is converted"""
 
         with self.assertRaises(ValueError):
-            grapple.bam_to_fq(os.path.join('test_files', 'lambda_ref.fa'))
+            grapple.sam_to_bam(os.path.join('test_files', 'lambda_ref.fa'))
 
     def test_absent_file(self):
-        """Should raise an exception when the file does not exist"""
+        """Should raise an exception when the read file does not exist"""
 
         with self.assertRaises(CalledProcessError):
-            grapple.bam_to_fq('this_file_does_not_exist.bam')
-
-    def test_no_file(self):
-        """Should raise an exception when no file is given"""
-
-        with self.assertRaises(ValueError):
-            grapple.bam_to_fq('')
+            grapple.sam_to_bam('this_file_does_not_exist.sam')
 
     def test_none_file(self):
-        """Should raise an exception when None is given"""
+        """Should raise an exception when None is passed as the read file"""
 
         with self.assertRaises(AttributeError):
-            grapple.bam_to_fq(None)
+            grapple.sam_to_bam(None)
 
     def test_bad_prefix(self):
-        """Should raise an exception when a type that cannot be converted to a string is used as the prefix"""
+        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
 
         with self.assertRaises(TypeError):
-            grapple.bam_to_fq(self._test_file, prefix_id=0)
+            grapple.sam_to_bam(self._test_file, prefix_id=0)
 
     def test_none_prefix(self):
         """Should raise an exception when None is used as the prefix"""
 
         with self.assertRaises(TypeError):
-            grapple.bam_to_fq(self._test_file, prefix_id=None)
+            grapple.sam_to_bam(self._test_file, prefix_id=None)
 
 
-class TestReadCorrection(TestCase):
-    """Tests involving read_correction()"""
+class TestSortAndIndex(TestCase):
+    """Test cases for sort_and_index()"""
 
     def setUp(self):
-        """Setup code before tests"""
+        """Setup code for test cases"""
 
-        # Available test file
-        self._test_file = os.path.join('test_files', 'lambda_reads.fq')
+        # Available test files
+        self._test_file = os.path.join('test_files', 'aligned_lambda.bam')
 
     def test_valid_file(self):
-        """Should not raise an exception when a valid FASTQ file is used"""
+        """Should not raise an exception when a valid file is provided"""
 
         try:
-            grapple.read_correction(self._test_file)
+            grapple.sort_and_index(self._test_file)
 
         except Exception as e:
             self.fail(e)
@@ -97,281 +1569,984 @@ class TestReadCorrection(TestCase):
         """Should raise an exception when a file with the wrong format is used"""
 
         with self.assertRaises(ValueError):
-            grapple.read_correction(os.path.join('test_files', 'lambda_ref.fa'))
+            grapple.sort_and_index(os.path.join('test_files', 'lambda_ref.fa'))
 
     def test_absent_file(self):
-        """Should raise an exception when the file is not found"""
+        """Should raise an exception when a read file does not exist"""
 
-        with self.assertRaises(ValueError):
-            grapple.read_correction('this_file_does_not_exit.fq')
+        with self.assertRaises(CalledProcessError):
+            grapple.sort_and_index('this_file_does_not_exist.bam')
 
     def test_none_file(self):
-        """Should raise an exception when None is passed as for the file"""
+        """Should raise an exception when None is passed as the read file"""
 
         with self.assertRaises(AttributeError):
-            grapple.read_correction(None)
+            grapple.sort_and_index(None)
+
+    def test_bad_prefix(self):
+        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.sort_and_index(self._test_file, prefix_id=0)
+
+    def test_none_prefix(self):
+        """Should raise an exception when None is used as the prefix"""
+
+        with self.assertRaises(TypeError):
+            grapple.sort_and_index(self._test_file, prefix_id=None)
+
+
+class TestDetectResources(TestCase):
+    """Test cases for detect_resources()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._root = tempfile.mkdtemp()
+        self._proc_cgroup = os.path.join(self._root, 'cgroup')
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._root)
+
+    def _write(self, path, text):
+        """Write a file under the fake cgroup root"""
+
+        path = os.path.join(self._root, path)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'w') as handle:
+            handle.write(text)
+
+    def _detect(self):
+        """Detect the resources against the fake cgroups"""
+
+        return grapple.detect_resources(self._proc_cgroup, self._root)
+
+    def test_no_cgroup(self):
+        """Should fall back to the affinity mask and available memory outside of a cgroup"""
+
+        resources = self._detect()
+
+        self.assertEqual(resources['threads'], len(resources['cpus']))
+        self.assertGreater(resources['memory'], 0)
+
+    def test_cgroup_v2(self):
+        """Should apply the CPU quota and memory limit of a cgroup v2 hierarchy"""
+
+        self._write('cgroup', '0::/pod\n')
+        self._write(os.path.join('pod', 'cpu.max'), '150000 100000\n')
+        self._write(os.path.join('pod', 'memory.max'), '3000000000\n')
+        self._write(os.path.join('pod', 'memory.current'), '1000000000\n')
+
+        resources = self._detect()
+
+        self.assertEqual(resources['threads'], min(2, len(resources['cpus'])))
+        self.assertLessEqual(resources['memory'], 2)
+
+    def test_page_cache(self):
+        """Should not count the reclaimable page cache as used memory"""
+
+        self._write('cgroup', '0::/pod\n')
+        self._write(os.path.join('pod', 'memory.max'), '3000000000\n')
+        self._write(os.path.join('pod', 'memory.current'), '2500000000\n')
+        self._write(os.path.join('pod', 'memory.stat'), 'anon 500000000\nfile 2000000000\ninactive_file 2000000000\n')
+
+        resources = self._detect()
+
+        self.assertAlmostEqual(resources['memory'], min(2.5, grapple.psutil.virtual_memory().available / 1e9), 1)
+
+    def test_cgroup_v2_unlimited(self):
+        """Should not limit the threads when the cgroup v2 quota is max"""
+
+        self._write('cgroup', '0::/\n')
+        self._write('cpu.max', 'max 100000\n')
+        self._write('memory.max', 'max\n')
+
+        resources = self._detect()
+
+        self.assertEqual(resources['threads'], len(resources['cpus']))
+
+    def test_cgroup_v1(self):
+        """Should apply the CPU quota and memory limit of a cgroup v1 hierarchy"""
+
+        self._write('cgroup', '4:cpu,cpuacct:/docker/1\n3:memory:/docker/1\n')
+        self._write(os.path.join('cpu,cpuacct', 'docker', '1', 'cpu.cfs_quota_us'), '100000\n')
+        self._write(os.path.join('cpu,cpuacct', 'docker', '1', 'cpu.cfs_period_us'), '100000\n')
+        self._write(os.path.join('memory', 'memory.limit_in_bytes'), '500000000\n')
+
+        resources = self._detect()
+
+        self.assertEqual(resources['threads'], 1)
+        self.assertLessEqual(resources['memory'], 0.5)
+
+
+class TestSortOptions(TestCase):
+    """Test cases for sort_options()"""
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        grapple.limit_resources()
+
+    def test_budget(self):
+        """Should split the memory budget between the sorting threads"""
+
+        grapple.limit_resources(4, 8)
+
+        self.assertEqual(grapple.sort_options(), ['-@', '3', '-m', '1500M'])
+
+
+class TestResourceBudget(TestCase):
+    """Test cases for resource_budget()"""
+
+    def test_scoped(self):
+        """Should limit the job on the current thread and the stages it starts, but not the other threads"""
+
+        others = []
+
+        with grapple.resource_budget(1000, 2):
+            other = threading.Thread(target=lambda: others.append(grapple.thread_count()))
+            other.start()
+            other.join()
+
+            self.assertEqual(grapple.thread_count(), 1000)
+            self.assertEqual(grapple.run_graph([('stage', [], None, grapple.memory_limit)]), {'stage': 2})
+
+        self.assertEqual(others, [grapple.detect_resources()['threads']])
+        self.assertEqual(grapple.thread_count(), grapple.detect_resources()['threads'])
+
+
+class TestTunedThreads(TestCase):
+    """Test cases for tuned_threads()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        grapple.limit_resources(8)
+        grapple._tuning['threads'] = {'bowtie2': {'4': {'threads': 2}, '9': {'threads': 16}}}
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        grapple.limit_resources()
+        grapple._tuning['threads'] = None
+
+    def test_closest_class(self):
+        """Should take the setting measured on inputs of the closest size"""
+
+        # The reference is 48 kB, so its size class is 5
+        self.assertEqual(grapple.tuned_threads('bowtie2', os.path.join('test_files', 'lambda_ref.fa')), 2)
+
+    def test_budget(self):
+        """Should not exceed the thread budget, taking the largest class for inputs of unknown size"""
+
+        self.assertEqual(grapple.tuned_threads('bowtie2', '-'), 8)
+
+    def test_untuned(self):
+        """Should use the whole budget for utilities which were not tuned"""
+
+        self.assertEqual(grapple.tuned_threads('karect'), 8)
+
+
+class TestSampleReads(TestCase):
+    """Test cases for sample_reads()"""
+
+    def test_reads(self):
+        """Should simulate reads of the given number and length"""
+
+        read_dir = tempfile.mkdtemp()
+
+        try:
+            read_file = grapple.sample_reads(os.path.join('test_files', 'lambda_ref.fa'),
+                                             os.path.join(read_dir, 'reads.fq'), 10, read_length=50)
+
+            reads = list(grapple.fastq_batches(read_file))[0]
+
+        finally:
+            shutil.rmtree(read_dir)
+
+        self.assertEqual(len(reads[0]), 10)
+        self.assertEqual(set(len(sequence) for sequence in reads[1]), set([50]))
+
+
+class TestWorkspace(TestCase):
+    """Test cases for workspace()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        self._scratch_dir = tempfile.mkdtemp()
+        self._small_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._scratch_dir)
+        shutil.rmtree(self._small_dir)
+
+    def test_cleanup(self):
+        """Should place the intermediate files in a private directory which is removed once the run ends"""
+
+        with grapple.workspace(scratch_dir=self._scratch_dir, small_dir=self._small_dir) as prefix_id:
+            large_file = grapple.scratch_file(prefix_id + 'aligned_reads.sam')
+            small_file = grapple.scratch_file(prefix_id + 'consensus.fa', large=False)
+
+            self.assertEqual(os.path.dirname(os.path.dirname(large_file)), self._scratch_dir)
+            self.assertEqual(os.path.dirname(os.path.dirname(small_file)), self._small_dir)
+
+            # The stages of the run share its workspace, while the other threads of the process keep their own
+            others = []
+            other = threading.Thread(target=lambda: others.append(grapple.scratch_file('aligned_reads.sam')))
+            other.start()
+            other.join()
+
+            self.assertEqual(grapple.run_graph([('stage', [], 1, lambda: grapple.scratch_file('aligned_reads.sam'))]),
+                             {'stage': large_file})
+            self.assertNotEqual(os.path.dirname(others[0]), os.path.dirname(large_file))
+            self.assertNotEqual(tempfile.gettempdir(), os.path.dirname(large_file))
+
+            open(large_file, 'w').close()
+
+        self.assertEqual(os.listdir(self._scratch_dir), [])
+        self.assertEqual(os.listdir(self._small_dir), [])
+        self.assertNotEqual(os.path.dirname(grapple.scratch_file('consensus.fa')), os.path.dirname(large_file))
+
+    def test_failure(self):
+        """Should remove the intermediate files when the run fails or is interrupted"""
+
+        for exception in (ValueError, KeyboardInterrupt):
+            with self.assertRaises(exception):
+                with grapple.workspace(scratch_dir=self._scratch_dir):
+                    open(grapple.scratch_file('sorted_reads.bam'), 'w').close()
+                    raise exception()
+
+            self.assertEqual(os.listdir(self._scratch_dir), [])
+
+    def test_concurrent_runs(self):
+        """Should give concurrent runs separate directories"""
+
+        with grapple.workspace(scratch_dir=self._scratch_dir):
+            first_file = grapple.scratch_file('karect_reads.fq')
+
+            with grapple.workspace(scratch_dir=self._scratch_dir):
+                self.assertNotEqual(grapple.scratch_file('karect_reads.fq'), first_file)
+
+    def test_run_dir(self):
+        """Should keep the intermediate files of a resumable run in its run directory"""
+
+        run_dir = os.path.join(self._scratch_dir, 'run')
+
+        with grapple.workspace(run_dir) as prefix_id:
+            open(grapple.scratch_file(prefix_id + 'consensus.fa', large=False), 'w').close()
+
+        self.assertEqual(os.listdir(run_dir), ['consensus.fa'])
+
+    def test_insufficient_space(self):
+        """Should raise an exception before the run starts when the scratch directory is too small"""
+
+        with self.assertRaises(ValueError):
+            with grapple.workspace(scratch_dir=self._scratch_dir, needed=1 << 62):
+                self.fail()
+
+        self.assertEqual(os.listdir(self._scratch_dir), [])
+
+
+class TestRunPipeline(TestCase):
+    """Test cases for run_pipeline()"""
+
+    def test_output(self):
+        """Should pass the output of each process into the next one"""
+
+        with tempfile.TemporaryFile() as ofile_handle:
+            grapple.run_pipeline([['echo', 'grapple'], ['tr', 'a-z', 'A-Z']], stdout=ofile_handle, stderr=None)
+            ofile_handle.seek(0)
+
+            self.assertEqual(ofile_handle.read().strip(), b'GRAPPLE')
+
+    def test_failed_process(self):
+        """Should raise an exception naming the process that failed when any process in the chain fails"""
+
+        with open(os.devnull, 'w') as null_handle:
+            with self.assertRaises(CalledProcessError) as context:
+                grapple.run_pipeline([['echo', 'grapple'], ['false'], ['cat']], stdout=null_handle, stderr=None)
+
+        self.assertEqual(context.exception.cmd, ['false'])
+
+    def test_absent_program(self):
+        """Should raise an exception when a program in the chain does not exist"""
+
+        with open(os.devnull, 'w') as null_handle:
+            with self.assertRaises(EnvironmentError):
+                grapple.run_pipeline([['echo', 'grapple'], ['this_program_does_not_exist']], stdout=null_handle,
+                                     stderr=None)
+
+
+class TestStreamAlignment(TestCase):
+    """Test cases for stream_alignment()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Available test files
+        self._bam_file = os.path.join('test_files', 'lambda_iontorrent.bam')
+        self._fq_file = os.path.join('test_files', 'lambda_reads.fq')
+
+        # Available reference file
+        self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools'), 'bowtie2 and samtools are needed to align')
+    def test_valid_bam_file(self):
+        """Should not raise an exception when a valid BAM file is streamed"""
+
+        try:
+            grapple.stream_alignment(self._bam_file, self._ref_file)
+
+        except Exception as e:
+            self.fail(e)
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools'), 'bowtie2 and samtools are needed to align')
+    def test_valid_fq_file(self):
+        """Should not raise an exception when a valid FASTQ file is streamed"""
+
+        try:
+            grapple.stream_alignment(self._fq_file, self._ref_file)
+
+        except Exception as e:
+            self.fail(e)
+
+    def test_invalid_read_file(self):
+        """Should raise an exception when the read file is formatted wrong"""
+
+        with self.assertRaises(ValueError):
+            grapple.stream_alignment(self._ref_file, self._ref_file)
+
+    @unittest.skipUnless(installed('samtools'), 'samtools is needed to report the absent file')
+    def test_absent_read_file(self):
+        """Should raise an exception when the read file is absent"""
+
+        with self.assertRaises(CalledProcessError):
+            grapple.stream_alignment('this_file_does_not_exist.bam', self._ref_file)
+
+    def test_invalid_ref_file(self):
+        """Should raise an exception when the reference file is in the wrong format"""
+
+        with self.assertRaises(ValueError):
+            grapple.stream_alignment(self._bam_file, self._bam_file)
+
+
+class TestShardAlignment(TestCase):
+    """Test cases for shard_alignment()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
+
+        # Available test files
+        self._fq_file = os.path.join('test_files', 'lambda_reads.fq')
+        self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools'), 'bowtie2 and samtools are needed to align')
+    def test_valid_file(self):
+        """Should not raise an exception when a valid FASTQ file is aligned in shards"""
+
+        try:
+            grapple.shard_alignment(self._fq_file, self._ref_file, shards=3)
+
+        except Exception as e:
+            self.fail(e)
+
+    def test_invalid_read_file(self):
+        """Should raise an exception when the read file is formatted wrong"""
+
+        with self.assertRaises(ValueError):
+            grapple.shard_alignment(self._ref_file, self._ref_file)
+
+    def test_invalid_shards(self):
+        """Should raise an exception when the number of shards is not positive"""
+
+        with self.assertRaises(ValueError):
+            grapple.shard_alignment(self._fq_file, self._ref_file, shards=0)
+
+    def test_stub_utilities(self):
+        """Should deal the reads into the shards in turn and merge the sorted shards, using stand-in utilities"""
+
+        stub_dir = tempfile.mkdtemp()
+        environment = dict(os.environ)
+
+        try:
+            benchmark.install_stubs(stub_dir)
+
+            read_file = os.path.join(stub_dir, 'reads.fq')
+            count = benchmark.simulate_reads(self._ref_file, read_file, depth=1)
+
+            with open(read_file, 'rb') as read_handle:
+                lines = read_handle.read().splitlines(True)
+
+            reads = [b''.join(lines[start:start + 4]) for start in range(0, len(lines), 4)]
+
+            with grapple.workspace(scratch_dir=stub_dir):
+                # The stand-in aligner and sort pass the reads through, so each shard keeps the order it was dealt
+                sorted_reads = grapple.shard_alignment(read_file, self._ref_file, shards=3, batch_size=7)
+
+                with open(sorted_reads, 'rb') as sorted_handle:
+                    self.assertEqual(sorted_handle.read(), b''.join(reads[0::3] + reads[1::3] + reads[2::3]))
+
+                self.assertTrue(os.path.isfile(sorted_reads + '.bai'))
+                self.assertEqual([name for name in os.listdir(os.path.dirname(sorted_reads)) if 'shard' in name], [])
+
+            self.assertEqual(len(reads), count)
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+            shutil.rmtree(stub_dir)
+
+
+class TestReferenceRegions(TestCase):
+    """Test cases for reference_regions()"""
+
+    def setUp(self):
+        """Setup code for test cases"""
 
-    def test_invalid_cell_type(self):
-        """Should raise an exception when an invalid cell type is given"""
+        # Reference with a FASTA index describing two contigs of 25 and 10 bases
+        self._ref_dir = tempfile.mkdtemp()
+        self._ref_file = os.path.join(self._ref_dir, 'reference.fa')
 
-        with self.assertRaises(ValueError):
-            grapple.read_correction(self._test_file, cell_type='not_a_cell_type')
+        with open(self._ref_file + '.fai', 'w') as handle:
+            handle.write('first\t25\t7\t60\t61\nsecond\t10\t40\t60\t61\n')
 
-    def test_none_cell_type(self):
-        """Should raise an exception when None is passed for the cell type"""
+    def tearDown(self):
+        """Cleanup code for test cases"""
 
-        with self.assertRaises(TypeError):
-            grapple.read_correction(self._test_file, cell_type=None)
+        shutil.rmtree(self._ref_dir)
 
-    def test_invalid_match_type(self):
-        """Should raise an exception when an invalid match type is given"""
+    def test_contigs(self):
+        """Should return one region per contig when no region size is given"""
 
-        with self.assertRaises(ValueError):
-            grapple.read_correction(self._test_file, match_type='not_a_match_type')
+        self.assertEqual(grapple.reference_regions(self._ref_file), ['first', 'second'])
 
-    def test_none_match_type(self):
-        """Should raise an exception when None is given as a match type"""
+    def test_region_size(self):
+        """Should split the contigs longer than the region size into consecutive regions"""
 
-        with self.assertRaises(TypeError):
-            grapple.read_correction(self._test_file, match_type=None)
+        self.assertEqual(grapple.reference_regions(self._ref_file, region_size=10),
+                         ['first:1-10', 'first:11-20', 'first:21-25', 'second'])
 
 
-class TestAlignment(TestCase):
-    """Unit tests for read_alignment()"""
+class TestCallVariants(TestCase):
+    """Test cases for call_variants()"""
 
     def setUp(self):
-        """Setup code for tests"""
+        """Setup code for test cases"""
 
         # Available test file
-        self._test_file = os.path.join('test_files', 'lambda_reads.fq')
+        self._test_file = os.path.join('test_files', 'sorted_lambda.bam')
 
         # Available reference file
         self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
 
     def test_valid_files(self):
-        """Should not raise an exception when valid files are given as input"""
+        """Should not raise an exception when supplying valid files"""
 
         try:
-            grapple.read_alignment(self._test_file, self._ref_file)
+            grapple.call_variants(self._test_file, self._ref_file)
 
         except Exception as e:
             self.fail(e)
 
     def test_invalid_read_file(self):
-        """Should raise an exception when the read file is formatted wrong"""
+        """Should raise an exception when supplying a read file with the wrong format"""
 
         with self.assertRaises(ValueError):
-            grapple.read_alignment(self._ref_file, self._ref_file)
+            grapple.call_variants(self._ref_file, self._ref_file)
 
     def test_absent_read_file(self):
-        """Should raise an exception when the read file is absent"""
+        """Should raise an exception when supplying a read file that doesn't exist"""
 
         with self.assertRaises(CalledProcessError):
-            grapple.read_alignment('this_file_does_not_exist.fq', self._ref_file)
+            grapple.call_variants('this_file_does_not_exist.bam', self._ref_file)
 
     def test_none_read_file(self):
-        """Should raise an exception when None is passed as the read_file"""
+        """Should raise an exception when None is used as the read file"""
 
         with self.assertRaises(AttributeError):
-            grapple.read_alignment(None, self._ref_file)
+            grapple.call_variants(None, self._ref_file)
 
     def test_invalid_ref_file(self):
-        """Should raise an exception when the reference file is in the wrong format"""
+        """Should raise an exception when the reference file is not in the right format"""
 
         with self.assertRaises(ValueError):
-            grapple.read_alignment(self._test_file, self._test_file)
+            grapple.call_variants(self._test_file, os.path.join('test_files', 'lambda_reads.fq'))
 
     def test_absent_ref_file(self):
         """Should raise an exception when the reference file doesn't exist"""
 
         with self.assertRaises(CalledProcessError):
-            grapple.read_alignment(self._test_file, 'this_file_does_not_exist.fa')
+            grapple.call_variants(self._test_file, 'this_file_does_not_exist.fa')
 
     def test_none_ref_file(self):
-        """Should raise an exception when None is given as the reference file"""
+        """Should raise an exception when None is passed as the reference file"""
 
         with self.assertRaises(AttributeError):
-            grapple.read_alignment(self._test_file, None)
+            grapple.call_variants(self._test_file, None)
+
+    def test_invalid_region_size(self):
+        """Should raise an exception when the region size is not positive"""
+
+        with self.assertRaises(ValueError):
+            grapple.call_variants(self._test_file, self._ref_file, region_size=0)
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools', 'bcftools'),
+                         'bowtie2, samtools and bcftools are needed to align the reads and call the variants')
+    def test_regions(self):
+        """Should generate the same consensus when the contig is called in several regions as when it is one region"""
+
+        self.assertGreater(len(grapple.reference_regions(self._ref_file, 10000)), 1)
+
+        with grapple.workspace():
+            read_file = grapple.sort_and_index(grapple.sam_to_bam(grapple.read_alignment(
+                os.path.join('test_files', 'lambda_reads.fq'), self._ref_file)))
+
+            with open(grapple.call_variants(read_file, self._ref_file, 'whole_')) as whole_handle, \
+                    open(grapple.call_variants(read_file, self._ref_file, 'split_', region_size=10000)) as split_handle:
+                self.assertEqual(split_handle.read(), whole_handle.read())
 
     def test_bad_prefix(self):
         """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
 
         with self.assertRaises(TypeError):
-            grapple.read_alignment(self._test_file, self._ref_file, prefix_id=0)
+            grapple.call_variants(self._test_file, self._ref_file, prefix_id=0)
 
     def test_none_prefix(self):
         """Should raise an exception when None is used as the prefix"""
 
         with self.assertRaises(TypeError):
-            grapple.read_alignment(self._test_file, self._ref_file, prefix_id=None)
+            grapple.call_variants(self._test_file, self._ref_file, prefix_id=None)
 
 
-class TestSamToBam(TestCase):
-    """Test cases for sam_to_bam() conversion"""
+class TestApplyVariants(TestCase):
+    """Test cases for apply_variants()"""
 
     def setUp(self):
         """Setup code for test cases"""
 
-        # Available test files
-        self._test_file = os.path.join('test_files', 'aligned_lambda.sam')
+        self._dir = tempfile.mkdtemp()
+        self._ref_file = os.path.join(self._dir, 'ref.fa')
+        self._variant_file = os.path.join(self._dir, 'variants.vcf')
+        self._consensus_file = os.path.join(self._dir, 'consensus.fa')
 
-    def test_valid_file(self):
-        """Should not raise an exception when a valid file is to be converted"""
+        # Reference of two contigs with lines of 10 bases, partly in lower case, and its FASTA index
+        with open(self._ref_file, 'w') as ref_handle:
+            ref_handle.write('>first description\nACGTACGTac\ngtACGTACGT\nAC\n>second\nTTTTGGGG\n')
 
-        try:
-            grapple.sam_to_bam(self._test_file)
+        with open(self._ref_file + '.fai', 'w') as index_handle:
+            index_handle.write('first\t22\t19\t10\t11\nsecond\t8\t52\t8\t9\n')
 
-        except Exception as e:
-            self.fail(e)
+    def tearDown(self):
+        """Cleanup code for test cases"""
 
-    def test_invalid_file(self):
-        """Should raise an exception when a file with the wrong format is converted"""
+        shutil.rmtree(self._dir)
+
+    def _write(self, records, compress=False):
+        """Write the variants after a VCF header"""
+
+        with (gzip.open if compress else open)(self._variant_file, 'wb') as variant_handle:
+            variant_handle.write(b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+            variant_handle.writelines(('\t'.join(record) + '\t.\t.\t.\n').encode('utf-8') for record in records)
+
+    def _apply(self, line_width=10):
+        """Apply the variants and read the consensus"""
+
+        grapple.apply_variants(self._variant_file, self._ref_file, self._consensus_file, line_width=line_width)
+
+        with open(self._consensus_file) as consensus_handle:
+            return consensus_handle.read()
+
+    def test_variants(self):
+        """Should apply SNPs, insertions and deletions across lines and contigs, skipping those that cannot apply"""
+
+        for compress in (False, True):
+            self._write([('first', '2', '.', 'C', 'T'), ('first', '5', '.', 'A', 'AGG'),
+                         ('first', '5', '.', 'A', 'C'), ('first', '9', '.', 'ACG', 'A'),
+                         ('first', '12', '.', 'T', '<DEL>'), ('second', '4', '.', 'T', 'G,C'),
+                         ('third', '1', '.', 'A', 'C')], compress)
+
+            self.assertEqual(self._apply(), '>first description\nATGTAGGCGT\nATACGTACGT\nAC\n>second\nTTTGGGGG\n')
+
+    def test_no_variants(self):
+        """Should copy the reference upper-cased and in lines of the given width"""
+
+        self._write([])
+
+        self.assertEqual(self._apply(line_width=60),
+                         '>first description\nACGTACGTACGTACGTACGTAC\n>second\nTTTTGGGG\n')
+
+    def test_mismatched_reference(self):
+        """Should raise an exception when the reference allele of a variant does not match the reference"""
+
+        self._write([('first', '1', '.', 'G', 'T')])
 
         with self.assertRaises(ValueError):
-            grapple.sam_to_bam(os.path.join('test_files', 'lambda_ref.fa'))
+            self._apply()
 
-    def test_absent_file(self):
-        """Should raise an exception when the read file does not exist"""
+    def test_unsorted_variants(self):
+        """Should raise an exception when the variants do not follow the order of the reference"""
 
-        with self.assertRaises(CalledProcessError):
-            grapple.sam_to_bam('this_file_does_not_exist.sam')
+        self._write([('second', '4', '.', 'T', 'G'), ('first', '2', '.', 'C', 'T')])
 
-    def test_none_file(self):
-        """Should raise an exception when None is passed as the read file"""
+        with self.assertRaises(ValueError):
+            self._apply()
 
-        with self.assertRaises(AttributeError):
-            grapple.sam_to_bam(None)
+    @unittest.skipUnless(installed('samtools', 'bcftools'), 'samtools and bcftools are needed to compare the consensus')
+    def test_bcftools_consensus(self):
+        """Should generate the same consensus as bcftools consensus on the lambda reference"""
 
-    def test_bad_prefix(self):
-        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
+        ref_file = os.path.join('test_files', 'lambda_ref.fa')
+        name, _, reference = grapple.read_reference(ref_file)[0]
+        reference = reference.tobytes().decode('utf-8')
+        records = []
 
-        with self.assertRaises(TypeError):
-            grapple.sam_to_bam(self._test_file, prefix_id=0)
+        # A SNP, an insertion, a deletion spanning a line break and a SNP near the end
+        for position, length, alt in ((100, 1, None), (1000, 1, 'TTG'), (20020, 5, ''), (48000, 1, None)):
+            ref_allele = reference[position - 1:position - 1 + length]
+            records.append((name.decode('utf-8'), str(position), '.', ref_allele,
+                            ('C' if ref_allele == 'A' else 'A') if alt is None else ref_allele[0] + alt))
 
-    def test_none_prefix(self):
-        """Should raise an exception when None is used as the prefix"""
+        self._write(records)
 
-        with self.assertRaises(TypeError):
-            grapple.sam_to_bam(self._test_file, prefix_id=None)
+        compressed_file = self._variant_file + '.gz'
+        expected_file = os.path.join(self._dir, 'expected.fa')
 
+        subprocess.check_call(['bcftools', 'view', '-Oz', '-o', compressed_file, self._variant_file])
+        subprocess.check_call(['bcftools', 'index', compressed_file])
+        subprocess.check_call(['bcftools', 'consensus', '-f', ref_file, '-o', expected_file, compressed_file])
 
-class TestSortAndIndex(TestCase):
-    """Test cases for sort_and_index()"""
+        grapple.apply_variants(self._variant_file, ref_file, self._consensus_file)
 
-    def setUp(self):
-        """Setup code for test cases"""
+        with open(expected_file) as expected_handle, open(self._consensus_file) as consensus_handle:
+            self.assertEqual(consensus_handle.read(), expected_handle.read().upper())
 
-        # Available test files
-        self._test_file = os.path.join('test_files', 'aligned_lambda.bam')
 
-    def test_valid_file(self):
-        """Should not raise an exception when a valid file is provided"""
+class TestOverlappingRegions(TestCase):
+    """Test cases for overlapping_regions()"""
 
-        try:
-            grapple.sort_and_index(self._test_file)
+    def test_regions(self):
+        """Should find every region an alignment spans, following the reference bases of its CIGAR"""
 
-        except Exception as e:
-            self.fail(e)
+        regions = ['first:1-100', 'first:101-200', 'first:201-250', 'second']
+        alignments = [b'@HD\tVN:1.0\n', b'spanning\t0\tfirst\t90\t60\t5S10M2D5I\t*\t0\t0\tACGT\t*\n',
+                      b'unmapped\t4\tfirst\t230\t0\t4M\t*\t0\t0\tACGT\t*\n',
+                      b'whole\t16\tsecond\t5000\t60\t4M\t*\t0\t0\tACGT\t*\n']
 
-    def test_invalid_file(self):
-        """Should raise an exception when a file with the wrong format is used"""
+        self.assertEqual(grapple.overlapping_regions(alignments, regions), set([0, 1, 3]))
 
-        with self.assertRaises(ValueError):
-            grapple.sort_and_index(os.path.join('test_files', 'lambda_ref.fa'))
+    def test_malformed_record(self):
+        """Should raise a ValueError naming the record when a SAM record is truncated or its position is not a number"""
 
-    def test_absent_file(self):
-        """Should raise an exception when a read file does not exist"""
+        for record in (b'truncated\t0\tfirst\t90\n', b'positionless\t0\tfirst\tstart\t60\t4M\t*\t0\t0\tACGT\t*\n'):
+            with self.assertRaises(ValueError) as context:
+                grapple.overlapping_regions([record], ['first'])
 
-        with self.assertRaises(CalledProcessError):
-            grapple.sort_and_index('this_file_does_not_exist.bam')
+            self.assertIn('Malformed SAM record: ' + record.split(b'\t')[0].decode(), str(context.exception))
 
-    def test_none_file(self):
-        """Should raise an exception when None is passed as the read file"""
+    def test_malformed_view(self):
+        """Should report a malformed record from samtools view rather than the pipe closed after it"""
 
-        with self.assertRaises(AttributeError):
-            grapple.sort_and_index(None)
+        tool_dir = tempfile.mkdtemp()
+        path = os.environ['PATH']
 
-    def test_bad_prefix(self):
-        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
+        try:
+            # Stand-in for samtools view writing a short record followed by more than a pipe holds, until it is stopped
+            with open(os.path.join(tool_dir, 'samtools'), 'w') as tool_handle:
+                tool_handle.write('#!/bin/sh\nprintf "short\\t0\\tfirst\\n"\nexec yes more\n')
 
-        with self.assertRaises(TypeError):
-            grapple.sort_and_index(self._test_file, prefix_id=0)
+            os.chmod(os.path.join(tool_dir, 'samtools'), 0o755)
+            os.environ['PATH'] = tool_dir + os.pathsep + path
 
-    def test_none_prefix(self):
-        """Should raise an exception when None is used as the prefix"""
+            with self.assertRaises(ValueError) as context:
+                grapple.touched_regions('reads.bam', ['first'])
 
-        with self.assertRaises(TypeError):
-            grapple.sort_and_index(self._test_file, prefix_id=None)
+            self.assertIn('Malformed SAM record: short', str(context.exception))
 
+        finally:
+            os.environ['PATH'] = path
+            shutil.rmtree(tool_dir)
 
-class TestCallVariants(TestCase):
-    """Test cases for call_variants()"""
+
+class TestUpdateVariants(TestCase):
+    """Test cases for update_variants()"""
 
     def setUp(self):
         """Setup code for test cases"""
 
-        # Available test file
-        self._test_file = os.path.join('test_files', 'sorted_lambda.bam')
+        # Available read file, aligned by the tests needing it
+        self._read_file = os.path.join('test_files', 'lambda_reads.fq')
 
         # Available reference file
         self._ref_file = os.path.join('test_files', 'lambda_ref.fa')
 
-    def test_valid_files(self):
-        """Should not raise an exception when supplying valid files"""
+        self._sample_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._sample_dir)
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools', 'bcftools'),
+                         'bowtie2, samtools and bcftools are needed to align the reads and call the variants')
+    def test_top_up(self):
+        """Should give the same consensus as calling the merged reads at once, calling only the regions with reads"""
+
+        state_file = os.path.join(self._sample_dir, 'sample.json')
+        call_variants = grapple.call_variants
+        calls = []
+
+        def merged_consensus(prefix_id):
+            """Call every region of the reads merged so far at once, keeping the consensus under its own name"""
+
+            with open(state_file) as state_handle:
+                merged_reads = os.path.join(self._sample_dir, json.load(state_handle)['reads'])
+
+            return call_variants(merged_reads, self._ref_file, prefix_id, region_size=10000)
+
+        def recording_call(*args):
+            """Record the regions a call is asked to call again and those the sample state leaves pending"""
+
+            with open(state_file) as state_handle:
+                calls.append((args[6], json.load(state_handle)['pending']))
+
+            return call_variants(*args)
+
+        # The updates look up call_variants in the module, so they can be observed through it
+        grapple.call_variants = recording_call
 
         try:
-            grapple.call_variants(self._test_file, self._ref_file)
+            with grapple.workspace():
+                self._test_file = grapple.sort_and_index(grapple.sam_to_bam(grapple.read_alignment(self._read_file,
+                                                                                                    self._ref_file)))
 
-        except Exception as e:
-            self.fail(e)
+                # Every update writes its consensus to the same scratch file, so keep the first one aside
+                first = grapple.scratch_file('kept_consensus.fa', large=False)
+                shutil.copyfile(grapple.update_variants(self._test_file, self._ref_file, self._sample_dir,
+                                                        region_size=10000), first)
+                first_expected = merged_consensus('first_')
+
+                second = grapple.update_variants(self._test_file, self._ref_file, self._sample_dir,
+                                                 region_size=10000)
+                second_expected = merged_consensus('second_')
+
+                for consensus, expected in ((first, first_expected), (second, second_expected)):
+                    self.assertNotEqual(consensus, expected)
+
+                    with open(consensus) as consensus_handle, open(expected) as expected_handle:
+                        self.assertEqual(consensus_handle.read(), expected_handle.read())
+
+                # The aligned reads are removed with the workspace
+                regions = grapple.reference_regions(self._ref_file, 10000)
+                touched = grapple.touched_regions(self._test_file, regions)
+
+        finally:
+            grapple.call_variants = call_variants
+
+        # The first update calls every region, the second only those its reads touch
+        self.assertEqual(calls, [(set(range(len(regions))), list(range(len(regions)))), (touched, sorted(touched))])
+
+        with open(state_file) as state_handle:
+            self.assertEqual(json.load(state_handle)['pending'], [])
+
+    def test_default_region_size(self):
+        """Should split a contig into regions when no region size is given so a top-up does not call all of it"""
+
+        ref_file = os.path.join(self._sample_dir, 'ref.fa')
+        read_file = os.path.join(self._sample_dir, 'reads.bam')
+        call_variants = grapple.call_variants
+        region_sizes = []
+
+        # A single contig longer than the default region size, indexed by hand
+        with open(ref_file, 'w') as ref_handle:
+            ref_handle.write('>contig\n' + 'A' * 250000 + '\n')
+
+        with open(ref_file + '.fai', 'w') as index_handle:
+            index_handle.write('contig\t250000\t8\t250000\t250001\n')
+
+        # The first update only copies the reads, so they need not be a real BAM file
+        for path in (read_file, read_file + '.bai'):
+            with open(path, 'w') as read_handle:
+                read_handle.write('reads')
+
+        def recording_call(*args):
+            """Record the region size a call is given instead of calling the variants"""
+
+            region_sizes.append(args[4])
+
+            return ref_file
+
+        grapple.call_variants = recording_call
+
+        try:
+            grapple.update_variants(read_file, ref_file, os.path.join(self._sample_dir, 'sample'))
+
+        finally:
+            grapple.call_variants = call_variants
+
+        self.assertEqual(region_sizes, [grapple._UPDATE_REGION_SIZE])
+
+        with open(os.path.join(self._sample_dir, 'sample', 'sample.json')) as state_handle:
+            self.assertEqual(len(json.load(state_handle)['regions']), 3)
 
     def test_invalid_read_file(self):
         """Should raise an exception when supplying a read file with the wrong format"""
 
         with self.assertRaises(ValueError):
-            grapple.call_variants(self._ref_file, self._ref_file)
+            grapple.update_variants(self._ref_file, self._ref_file, self._sample_dir)
 
-    def test_absent_read_file(self):
-        """Should raise an exception when supplying a read file that doesn't exist"""
 
-        with self.assertRaises(CalledProcessError):
-            grapple.call_variants('this_file_does_not_exist.bam', self._ref_file)
+class TestPileupConsensus(TestCase):
+    """Test cases for pileup_consensus()"""
 
-    def test_none_read_file(self):
-        """Should raise an exception when None is used as the read file"""
+    def setUp(self):
+        """Setup code for test cases"""
 
-        with self.assertRaises(AttributeError):
-            grapple.call_variants(None, self._ref_file)
+        self._work_dir = tempfile.mkdtemp()
+        self._ref_file = os.path.join(self._work_dir, 'ref.fa')
+        self._test_file = os.path.join(self._work_dir, 'aligned_reads.sam')
+
+        with open(self._ref_file, 'w') as ref_handle:
+            ref_handle.write('>first contig\nACGTACGTAC\nGGGGCCCC\n>second\nTTTTAAAA\n')
+
+        # Three reads carrying a substitution, an insertion and a deletion against the first contig, and reads whose
+        # only substitution on the second contig is too poorly covered once the low quality base is left out
+        with open(self._test_file, 'w') as sam_handle:
+            sam_handle.write('@HD\tVN:1.0\n')
+
+            for number in range(3):
+                sam_handle.write('read' + str(number) + '\t0\tfirst\t2\t60\t2S5M1I3M2D4M\t*\t0\t0\t'
+                                 'NNCGTAAGACGGCCC\t*\n')
+
+            sam_handle.write('unmapped\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n')
+            sam_handle.write('low\t0\tsecond\t1\t60\t8M\t*\t0\t0\tTTTTGAAA\tIIII#III\n')
+
+            for number in range(2):
+                sam_handle.write('high' + str(number) + '\t0\tsecond\t1\t60\t8M\t*\t0\t0\tTTTTGAAA\tIIIIIIII\n')
+
+    def tearDown(self):
+        """Cleanup code for test cases"""
+
+        shutil.rmtree(self._work_dir)
+
+    def _consensus(self, read_file, ref_file, **kwargs):
+        """Generate the consensus and return its sequences"""
+
+        consensus_file = grapple.pileup_consensus(read_file, ref_file, **kwargs)
+
+        try:
+            with open(consensus_file) as consensus_handle:
+                return consensus_handle.read().upper().split('>')[1:]
+
+        finally:
+            os.remove(consensus_file)
+
+    def test_valid_file(self):
+        """Should apply the majority of the substitutions, insertions and deletions in each contig"""
+
+        for batch_size in (1, 2, 100):
+            self.assertEqual(self._consensus(self._test_file, self._ref_file, batch_size=batch_size),
+                             ['FIRST CONTIG\nACGTAAGACGGCCCCCC\n', 'SECOND\nTTTTAAAA\n'])
+
+    def test_min_depth(self):
+        """Should call the positions covered by the minimum depth"""
+
+        self.assertEqual(self._consensus(self._test_file, self._ref_file, min_depth=2)[1], 'SECOND\nTTTTGAAA\n')
+
+    def test_leading_insertion(self):
+        """Should insert a sequence found before the first base of a contig at its start, not after the last base of
+        the contig before it"""
+
+        with open(self._test_file, 'w') as sam_handle:
+            for number in range(3):
+                sam_handle.write('read' + str(number) + '\t0\tsecond\t1\t60\t2I8M\t*\t0\t0\tGGTTTTAAAA\t*\n')
+
+        self.assertEqual(self._consensus(self._test_file, self._ref_file),
+                         ['FIRST CONTIG\nACGTACGTACGGGGCCCC\n', 'SECOND\nGGTTTTAAAA\n'])
+
+    def test_split_insertion(self):
+        """Should insert a sequence only when it alone is found in enough of the reads"""
+
+        with open(self._test_file, 'w') as sam_handle:
+            sam_handle.write('first\t0\tsecond\t1\t60\t4M1I4M\t*\t0\t0\tTTTTCAAAA\t*\n')
+            sam_handle.write('second\t0\tsecond\t1\t60\t4M1I4M\t*\t0\t0\tTTTTGAAAA\t*\n')
+            sam_handle.write('third\t0\tsecond\t1\t60\t8M\t*\t0\t0\tTTTTAAAA\t*\n')
+
+        self.assertEqual(self._consensus(self._test_file, self._ref_file)[1], 'SECOND\nTTTTAAAA\n')
+
+    def test_malformed_record(self):
+        """Should raise a ValueError naming the record when a SAM record is truncated or its flag is not a number"""
+
+        for record in ('truncated\t0\tsecond\t1\t60\t8M\n', 'flagless\tmapped\tsecond\t1\t60\t8M\t*\t0\t0\tTTTT\t*\n'):
+            with open(self._test_file, 'w') as sam_handle:
+                sam_handle.write(record)
+
+            with self.assertRaises(ValueError) as context:
+                self._consensus(self._test_file, self._ref_file)
+
+            self.assertIn('Malformed SAM record: ' + record.split('\t')[0], str(context.exception))
+
+    @unittest.skipUnless(installed('bowtie2', 'bowtie2-build', 'samtools', 'bcftools'),
+                         'bowtie2, samtools and bcftools are needed to run both engines')
+    def test_matches_bcftools(self):
+        """Should generate the consensus of the bcftools engine on the lambda reads but for at most 10 bases"""
+
+        ref_file = os.path.join('test_files', 'lambda_ref.fa')
+
+        with grapple.workspace():
+            aligned_reads = grapple.read_alignment(os.path.join('test_files', 'lambda_reads.fq'), ref_file)
+            consensus = ''.join(self._consensus(aligned_reads, ref_file)[0].split('\n')[1:])
+
+            sorted_reads = grapple.sort_and_index(grapple.sam_to_bam(aligned_reads))
+
+            with open(grapple.call_variants(sorted_reads, ref_file)) as expected_handle:
+                expected = ''.join(line.strip() for line in expected_handle if not line.startswith('>'))
+
+        self.assertLessEqual(differing_bases(consensus, expected), 10)
+
+    def test_invalid_read_file(self):
+        """Should raise an exception when the read file is in the wrong format"""
+
+        with self.assertRaises(ValueError):
+            grapple.pileup_consensus(self._ref_file, self._ref_file)
 
     def test_invalid_ref_file(self):
-        """Should raise an exception when the reference file is not in the right format"""
+        """Should raise an exception when the reference file is in the wrong format"""
 
         with self.assertRaises(ValueError):
-            grapple.call_variants(self._test_file, os.path.join('test_files', 'lambda_reads.fq'))
+            grapple.pileup_consensus(self._test_file, self._test_file)
 
-    def test_absent_ref_file(self):
-        """Should raise an exception when the reference file doesn't exist"""
+    def test_absent_read_file(self):
+        """Should raise an exception when the read file does not exist"""
 
-        with self.assertRaises(CalledProcessError):
-            grapple.call_variants(self._test_file, 'this_file_does_not_exist.fa')
+        with self.assertRaises(IOError):
+            grapple.pileup_consensus('this_file_does_not_exist.sam', self._ref_file)
 
-    def test_none_ref_file(self):
-        """Should raise an exception when None is passed as the reference file"""
 
-        with self.assertRaises(AttributeError):
-            grapple.call_variants(self._test_file, None)
+class TestCopyFile(TestCase):
+    """Test cases for copy_file()"""
 
-    def test_bad_prefix(self):
-        """Should raise an exception when a type that cannot be converted to a string is given for the prefix"""
+    def test_valid_file(self):
+        """Should append the whole file after anything already written to the handle"""
 
-        with self.assertRaises(TypeError):
-            grapple.call_variants(self._test_file, self._ref_file, prefix_id=0)
+        source_file = os.path.join('test_files', 'lambda_ref.fa')
 
-    def test_none_prefix(self):
-        """Should raise an exception when None is used as the prefix"""
+        with open(source_file, 'rb') as source_handle:
+            expected = b'header\n' + source_handle.read()
 
-        with self.assertRaises(TypeError):
-            grapple.call_variants(self._test_file, self._ref_file, prefix_id=None)
+        with tempfile.TemporaryFile() as destination_handle:
+            destination_handle.write(b'header\n')
+            grapple.copy_file(source_file, destination_handle)
+            destination_handle.seek(0)
+
+            self.assertEqual(destination_handle.read(), expected)
 
 
 class TestFormatConsensus(TestCase):
@@ -392,6 +2567,23 @@ class TestFormatConsensus(TestCase):
         except Exception as e:
             self.fail(e)
 
+    def test_chunk_boundaries(self):
+        """Should upper-case only the sequences when headers and lines span the boundaries between chunks"""
+
+        consensus = b'>first contig\nacgtn\nAcGt\n>second contig\nggcc\n'
+        expected = b'>first contig\nACGTN\nACGT\n>second contig\nGGCC\n'
+
+        with tempfile.NamedTemporaryFile(suffix='.fa') as consensus_handle:
+            consensus_handle.write(consensus)
+            consensus_handle.flush()
+
+            for chunk_size in range(1, len(consensus) + 1):
+                with tempfile.NamedTemporaryFile(suffix='.fa') as formatted_handle:
+                    grapple.format_consensus(consensus_handle.name, output_file=formatted_handle.name,
+                                             chunk_size=chunk_size)
+
+                    self.assertEqual(formatted_handle.read(), expected)
+
     def test_invalid_file(self):
         """Should raise an exception when the file is not in FASTA format"""
 